@@ -13,21 +13,54 @@ dashboard (cloudtrax.com).
 
 """
 
-from lib.cloudtrax import CloudTrax
+from lib.api import ApiServer
+from lib.backfill import Backfill
+from lib.changes import ChangeTracker, write_changes
+from lib.cloudtrax import CloudTraxError
 from lib.config import Config
+from lib.coordinator import Coordinator, QueueWorker
+from lib.daemon import Daemon
 from lib.database import Database
-from lib.mail import Email
+from lib.export import EXPORT_FORMATS, Exporter
+from lib.graph import Renderer, history_charts
+from lib.mail import Email, Mailer
+from lib.pipeline import Pipeline
+from lib.quota import QuotaMonitor
+from lib.report import Report
+from lib.runner import Runner
+from lib.snapshot import Snapshot, SnapshotWriter, restore
+from lib.workqueue import create_queue
 
 import argparse
+import codecs
 import datetime
 import logging
-import pygal
+import shutil
+import sys
+import tempfile
+
+# Reports that -r can produce
+REPORT_TYPES = ['usage', 'top_users', 'gateways', 'node_users']
 
 parser = argparse.ArgumentParser(description = 'Statistics scraper for the ' +
                                                'CloudTrax controller')
+parser.add_argument('--backfill',
+                    nargs = 1, 
+                    metavar = 'DIR',
+                    help = 'Load dashboard pages saved under DIR into the ' +
+                           'database')
 parser.add_argument('-c', '--config',
                     nargs = 1, 
                     help = 'Specify an alternate configuration file')
+parser.add_argument('--compact',
+                    action = 'store_true',
+                    default = False, 
+                    help = 'Roll old database records into daily totals')
+parser.add_argument('--daemon',
+                    action = 'store_true',
+                    default = False, 
+                    help = 'Keep running, polling networks and storing ' +
+                           'the output to a database')
 parser.add_argument('-d', '--database',
                     action = 'store_true',
                     default = False, 
@@ -36,6 +69,10 @@ parser.add_argument('-e', '--email',
                     action = 'store_true',
                     default = False, 
                     help = 'Email the output')
+parser.add_argument('-l', '--last',
+                    action = 'store_true',
+                    default = False, 
+                    help = 'Use the last snapshot instead of scraping again')
 parser.add_argument('-m', '--monitor',
                     action = 'store_true',
                     default = False, 
@@ -43,19 +80,301 @@ parser.add_argument('-m', '--monitor',
 parser.add_argument('-n', '--network',
                     nargs = 1, 
                     help = 'Force one network with no recursion')
+parser.add_argument('-o', '--output',
+                    choices = EXPORT_FORMATS,
+                    help = 'Stream every node and user record as it is ' +
+                           'scraped')
+parser.add_argument('--output-file',
+                    metavar = 'FILE',
+                    help = 'Write --output records to FILE instead of stdout')
 parser.add_argument('-r', '--report',
                     nargs = 1, 
                     help = 'Produce a report to email from database statistics [day|month|year]')
+parser.add_argument('--report-type',
+                    choices = REPORT_TYPES,
+                    default = 'usage',
+                    help = 'Report users and transfer by day, the busiest ' +
+                           'users, gateway usage by day or users by node')
+parser.add_argument('--top',
+                    type = int,
+                    default = 20,
+                    metavar = 'N',
+                    help = 'Number of users in a top_users report')
 parser.add_argument('-s', '--screen',
                     action = 'store_true',
                     default = False, 
                     help = 'Display the output to stdout')
+parser.add_argument('--serve',
+                    action = 'store_true',
+                    default = False, 
+                    help = 'Serve the last snapshot over HTTP, loading ' +
+                           'each new one')
 parser.add_argument('-v', '--verbose',
                     action = 'store_true',
                     default = False, 
                     help = 'Be Verbose')
+parser.add_argument('--worker',
+                    action = 'store_true',
+                    default = False, 
+                    help = 'Keep running, scraping items from the work queue')
 args = parser.parse_args()
 
+
+def email_limit(config, option):
+    """Return an optional row limit from the email configuration"""
+    value = config.get_email().get(option)
+
+    if value:
+        return int(value)
+
+    return None
+
+
+def scrape(config, callback=None):
+    """Scrape every account here, or through the work queue if configured"""
+    if config.get_queue():
+        runner = Coordinator(config, create_queue(config.get_queue()),
+                             callback)
+    else:
+        runner = Runner(config, callback)
+
+    return runner.run()
+
+
+def collect(config, snapshot, started):
+    """Scrape, or restore the last snapshot, returning the accounts and
+    the changes since the last scrape"""
+
+    callback = None
+    tracker = None
+
+    if args.database:
+        logging.info('Processing database output')
+
+        # Records of every account are written by a separate thread while
+        # we scrape, and the writer is waited on when the database is closed
+        writer = database.start_writer(started)
+        callback = writer.put
+
+    if args.output:
+        logging.info('Processing %s output', args.output)
+
+        if args.output_file:
+            output = open(args.output_file, 'wb')
+        else:
+            output = sys.stdout
+
+        exporter = Exporter(output, args.output, started, callback)
+        callback = exporter.put
+
+    try:
+        if snapshot is not None:
+            accounts = restore(config, snapshot, callback)
+        else:
+            if config.get_changes():
+                # Each network is compared with the last scrape on its way
+                # to the writer
+                tracker = ChangeTracker(config.get_changes()['state'],
+                                        callback, started)
+                callback = tracker.put
+
+            saver = None
+
+            if config.get_snapshot():
+                saver = SnapshotWriter(config.get_snapshot()['path'], started,
+                                       callback)
+                callback = saver.put
+
+            accounts = scrape(config, callback)
+
+            if saver is not None and accounts:
+                saver.close(accounts, accounts[0].checkin.get_stats())
+    finally:
+        if args.database:
+            writer.finish()
+
+        if args.output:
+            exporter.close()
+
+            if args.output_file:
+                output.close()
+
+    if not accounts:
+        raise CloudTraxError('No accounts could be scraped')
+
+    if tracker is None:
+        return (accounts, None)
+
+    tracker.save()
+
+    return (accounts, tracker.get_events())
+
+
+def account_changes(cloudtrax, events):
+    """Return the change events in the networks of an account"""
+    return [event for event in events
+            if event['network'] in cloudtrax.network['networks']]
+
+
+def store_changes(scraped):
+    """Wait for the database writer and store any changes"""
+    accounts, events = scraped
+
+    database.wait()
+
+    if events:
+        database.add_changes(events)
+
+
+def screen_report(scraped):
+    """Display the report of every account"""
+    accounts, events = scraped
+
+    logging.info('Processing screen output')
+
+    for cloudtrax in accounts:
+        if len(accounts) > 1:
+            print 'Account: %s\n' % cloudtrax.get_account()
+
+        report = Report(sys.stdout)
+        cloudtrax.write_report(report)
+
+        if events is not None:
+            write_changes(report, account_changes(cloudtrax, events))
+
+        print
+
+
+def create_renderer(config):
+    """Return a graph renderer using the configured cache"""
+    email_config = config.get_email()
+
+    return Renderer(email_config.get('graph_cache'),
+                    cache_days=email_config.get('graph_cache_days', 30))
+
+
+def render_graphs(renderer, scraped, graphs):
+    """Return the rendered graphs of every account, one after the other"""
+    accounts, events = scraped
+
+    return renderer.render([cloudtrax.graph_data(graph[0], graph[1],
+                                                 graph[2])
+                            for cloudtrax in accounts
+                            for graph in graphs], 'png').get()
+
+
+def email_bodies(config, scraped, graph_count):
+    """Return an email for every account, without its graphs"""
+    accounts, events = scraped
+
+    logging.info('Processing email output')
+
+    today = datetime.date.today()
+    emails = []
+
+    for cloudtrax in accounts:
+        email_config = config.get_email()
+
+        if len(accounts) > 1:
+            email_config = dict(email_config,
+                                subject='%s - %s' %
+                                        (email_config['subject'],
+                                         cloudtrax.get_account()))
+
+        email = Email(email_config)
+
+        users = cloudtrax.get_users()
+        usage = cloudtrax.get_usage()
+
+        # The body is built in a temporary file rather than in memory
+        html_part = tempfile.TemporaryFile()
+        report = Report(codecs.getwriter('utf-8')(html_part),
+                        email_limit(config, 'max_rows'),
+                        email_limit(config, 'page_rows'))
+
+        report.write("<h2>%s</h2>\n" % config.get_email()['title'])
+        report.write("<h3>%s</h3>\n" % today.strftime('%A, %d %B %Y'))
+        report.write('<br>\n')
+
+        alerting_nodes = len(cloudtrax.get_alerting())
+
+        if alerting_nodes > 0:
+            report.write("<b>Warning - %s nodes alerting</b><br><br>\n" % (alerting_nodes))
+
+        report.write("<b>Total users:</b> %s<br>\n" % len(users))
+        report.write('<br>\n')
+        report.write("<b>Total downloads:</b> %s <i>KB</i><br>\n" % '{:,}'.format(usage[0]))
+        report.write("<b>Total uploads:</b> %s <i>KB</i><br>\n" % '{:,}'.format(usage[1]))
+        report.write('<br>\n')
+
+        for count in range(graph_count):
+            report.write("<img src=\"cid:image%s\">" % (count + 1))
+
+        report.write('<br>')
+        report.write('<pre>')
+        cloudtrax.write_report(report)
+
+        if events is not None:
+            write_changes(report, account_changes(cloudtrax, events))
+
+        report.write('</pre>')
+
+        html_part.seek(0)
+        email.attach_html(html_part.read(), 'utf-8')
+        html_part.close()
+
+        emails.append(email)
+
+    return emails
+
+
+def send_emails(config, emails, images):
+    """Attach each account's graphs to its email and send them"""
+
+    graph_count = len(images) / max(1, len(emails))
+
+    for index, email in enumerate(emails):
+        for image in images[index * graph_count:(index + 1) * graph_count]:
+            email.attach_image(image)
+
+    return Mailer(config.get_email()).send(emails)
+
+
+def megabytes(kb):
+    """Return a kb count formatted in MB"""
+    return '%.2f' % (float(kb) / 1000)
+
+
+def history_table(report_type, interval):
+    """Return the title, header and rows of a per-user or per-node report"""
+
+    if report_type == 'top_users':
+        return ('Top %d users' % args.top,
+                ['Rank', 'Name\n(mac)', 'DL MB\n(UL MB)', 'Days'],
+                [[str(rank), '%s\n(%s)' % (name, mac),
+                  '%s\n(%s)' % (megabytes(kbdown), megabytes(kbup)),
+                  str(days)]
+                 for rank, mac, name, kbdown, kbup, days in
+                 database.get_top_users(interval, args.top)])
+
+    elif report_type == 'gateways':
+        return ('Internet usage by gateway',
+                ['Day', 'Name\n(mac)', 'GWDL MB\n(GWUL MB)', 'Running MB',
+                 'Share'],
+                [[day.strftime('%d/%m/%Y'), '%s\n(%s)' % (name, mac),
+                  '%s\n(%s)' % (megabytes(kbdown), megabytes(kbup)),
+                  megabytes(running), '%.1f%%' % share]
+                 for day, mac, name, kbdown, kbup, running, share in
+                 database.get_gateway_usage(interval)])
+
+    return ('Users by node',
+            ['Name\n(mac)', 'Days', 'Average', 'Peak\n(Day)', 'Latest'],
+            [['%s\n(%s)' % (name, mac), str(days), '%.1f' % average,
+              '%d\n(%s)' % (peak, peak_day.strftime('%d/%m/%Y')), str(users)]
+             for mac, name, days, average, peak, peak_day, users in
+             database.get_node_users(interval)])
+
+
 # Set up logging
 if args.verbose:
     logging.basicConfig(level=logging.DEBUG,
@@ -71,82 +390,143 @@ else:
     CONFIG_FILE = '/opt/cloudscraper/cloudscraper.conf'
 
 
-if (args.database or args.email or args.screen) and args.report:
+if (args.database or args.email or args.screen or args.output) and \
+   args.report:
     #TODO: We might be able to do this later...
     parser.error('You cannot scrape data and report history at the same time')
 
+if args.daemon and (args.database or args.email or args.screen or
+                    args.output or args.report or args.compact):
+    parser.error('The daemon can only be combined with quota monitoring')
+
+if args.worker and (args.database or args.email or args.screen or
+                    args.output or args.report or args.compact or
+                    args.daemon or args.monitor):
+    parser.error('A worker cannot do anything else')
+
+if args.last and not (args.database or args.email or args.screen or
+                      args.output):
+    parser.error('The last snapshot can only be stored, emailed, displayed ' +
+                 'or output')
+
+if args.backfill and (args.database or args.email or args.screen or
+                      args.output or args.report or args.compact or
+                      args.daemon or args.worker or args.monitor):
+    parser.error('A backfill cannot be combined with anything else')
+
+if args.serve and (args.database or args.email or args.screen or
+                   args.output or args.report or args.compact or
+                   args.daemon or args.worker or args.backfill or
+                   args.monitor):
+    parser.error('Serving the API cannot be combined with anything else')
+
+if args.compact and (args.database or args.email or args.screen or
+                     args.output or args.report):
+    parser.error('You cannot compact the database and scrape or report at ' +
+                 'the same time')
+
 # Parse configuration file
 config = Config(CONFIG_FILE)
 
 if args.network:
     config.set_network(args.network[0])
 
-if args.database or args.monitor or args.report:
+# The graph render pool forks its processes, which must happen before the
+# database or the scrape pipeline start any threads
+renderer = None
+
+if args.email or (args.report and args.report_type == 'usage'):
+    renderer = create_renderer(config)
+
+if args.database or args.monitor or args.report or args.compact or \
+   args.daemon or args.backfill:
     # Create the database object once
     database = Database(config.get_db())
 
-if args.database or args.email or args.screen:
-    cloudtrax = CloudTrax(config)
-    nodes = cloudtrax.get_nodes()
-    users = cloudtrax.get_users()
+# Whether every email was sent, the exit status is non-zero if not
+sent = True
 
-    msg = ""
-    msg += cloudtrax.report_summary()
-    msg += cloudtrax.report_nodes()
-    msg += cloudtrax.report_users()
+if args.worker:
+    if not config.get_queue():
+        parser.error('There is no [queue] section in the configuration')
 
-    if args.database:
-        logging.info('Processing database output')
+    logging.info('Starting worker')
 
-        database.add_records(nodes, users)
+    QueueWorker(config, create_queue(config.get_queue())).run()
 
-    if args.screen:
-        logging.info('Processing screen output')
-        print msg
+elif args.daemon:
+    logging.info('Starting daemon')
 
-    if args.email:
-        logging.info('Processing email output')
+    Daemon(config, database, args.monitor).run()
 
-        email = Email(config.get_email())
+elif args.serve:
+    if not config.get_api():
+        parser.error('There is no [api] section in the configuration')
 
-        usage = cloudtrax.get_usage()
-        today = datetime.date.today()
+    if not config.get_snapshot():
+        parser.error('There is no [snapshot] section in the configuration')
 
-        # TODO: This should be moved to the configuration file.
-        graphs = [['node', '24hr node usage', False, 'png'],
-                  ['node', '24hr internet usage', True, 'png'],
-                  ['user', '24hr internet usage', True, 'png']]
+    logging.info('Serving the API')
 
-        html_part = "<h2>%s</h2>\n" % config.get_email()['title']
-        html_part += "<h3>%s</h3>\n" % today.strftime('%A, %d %B %Y')
-        html_part += '<br>\n'
+    ApiServer(config).serve(config.get_snapshot()['path'])
 
-        alerting_nodes = len(cloudtrax.get_alerting())
+elif args.database or args.email or args.screen or args.output:
+    if args.screen and args.output and not args.output_file:
+        parser.error('--screen and --output cannot both use stdout')
 
-        if alerting_nodes > 0:
-            html_part += "<b>Warning - %s nodes alerting</b><br><br>\n" % (alerting_nodes)
+    started = datetime.datetime.now()
+    snapshot = None
 
-        html_part += "<b>Total users:</b> %s<br>\n" % len(users)
-        html_part += '<br>\n'
-        html_part += "<b>Total downloads:</b> %s <i>KB</i><br>\n" % '{:,}'.format(usage[0])
-        html_part += "<b>Total uploads:</b> %s <i>KB</i><br>\n" % '{:,}'.format(usage[1])
-        html_part += '<br>\n'
+    if args.last:
+        if not config.get_snapshot():
+            parser.error('There is no [snapshot] section in the configuration')
 
-        for count in range(len(graphs)):
-            html_part += "<img src=\"cid:image%s\">" % (count + 1)
+        snapshot = Snapshot(config.get_snapshot()['path'])
+        started = snapshot.get_started()
 
-        html_part += '<br>'
-        html_part += '<pre>'
-        html_part += msg
-        html_part += '</pre>'
+        logging.info('Using the snapshot of %s', started)
 
-        email.attach_html(html_part)
+    # TODO: This should be moved to the configuration file.
+    graphs = [['node', '24hr node usage', False, 'png'],
+              ['node', '24hr internet usage', True, 'png'],
+              ['user', '24hr internet usage', True, 'png']]
 
-        for graph in graphs:
-            image = cloudtrax.graph(graph[0], graph[1], graph[2], graph[3])
-            email.attach_image(image)
+    # Everything after the scrape only reads it, so the database, screen,
+    # graph and email body stages run side by side
+    pipeline = Pipeline()
+    pipeline.add('scrape', lambda: collect(config, snapshot, started))
+
+    if args.database:
+        pipeline.add('database', store_changes, ['scrape'])
+
+    if args.screen:
+        pipeline.add('screen', screen_report, ['scrape'])
 
-        email.send()
+    if args.email:
+        pipeline.add('graphs', lambda scraped: render_graphs(renderer,
+                                                             scraped, graphs),
+                     ['scrape'])
+        pipeline.add('body', lambda scraped: email_bodies(config, scraped,
+                                                          len(graphs)),
+                     ['scrape'])
+        pipeline.add('email', lambda emails, images: send_emails(config,
+                                                                 emails,
+                                                                 images),
+                     ['body', 'graphs'])
+
+    try:
+        pipeline.run()
+    except CloudTraxError, error:
+        logging.error(error)
+        exit(1)
+    finally:
+        pipeline.report()
+
+        if renderer is not None:
+            renderer.close()
+
+    if args.email and pipeline.get('email'):
+        sent = False
 
 elif args.report:
     logging.info('Producing report - %s' % args.report[0])
@@ -158,55 +538,107 @@ elif args.report:
     else:
         interval = '1 day'
 
-    msg = "<h2>Users by day</h2>"
+    if args.report_type != 'usage':
+        title, header, rows = history_table(args.report_type, interval)
+
+        html_part = tempfile.TemporaryFile()
+        report = Report(codecs.getwriter('utf-8')(html_part), None,
+                        email_limit(config, 'page_rows'))
+
+        report.write("<h2>%s</h2>\n" % title)
+        report.write("<pre>")
+        report.rows(header, rows)
+        report.write("</pre>")
 
-    for count in range(1):
-        msg += "<img src=\"cid:image%s\">" % (count + 1)
+        html_part.seek(0)
+        email = Email(config.get_email())
+        email.attach_html(html_part.read(), 'utf-8')
+        html_part.close()
 
-    msg += "<pre>"
+        sent = email.send()
 
-    days = []
-    users = []
-    dlkb = []
-    ulkb = []
+    else:
+        days = []
+        users = []
+        dlkb = []
+        ulkb = []
 
-    for record in database.get_past_stats(interval):
-        msg += "%s - %s users - %s kb downloaded - %s kb uploaded\n" % record
-        days.append("%s/%s" % (record[0].day, record[0].month))
-        users.append(record[1])
-        dlkb.append(record[2])
-        ulkb.append(record[3])
+        text = tempfile.TemporaryFile()
 
-    msg += "</pre>"
+        for record in database.get_past_stats(interval):
+            text.write("%s - %s users - %s kb downloaded - %s kb uploaded\n" % record)
+            days.append("%s/%s" % (record[0].day, record[0].month))
+            users.append(record[1])
+            dlkb.append(record[2])
+            ulkb.append(record[3])
 
-    email = Email(config.get_email())
-    email.attach_html(msg)
+        # Create usage graphs
+        charts = history_charts(days, users, dlkb, ulkb)
 
-    # Create usage graph
-    line_chart = pygal.Line()
-    line_chart.title = 'Users by day'
-    line_chart.x_labels = map(str, days)
-    line_chart.add('Users', users)
+        try:
+            images = renderer.render(charts, 'png').get()
+        finally:
+            renderer.close()
 
-    email.attach_image(line_chart.render_to_png())
-    email.send()
-else:
+        html_part = tempfile.TemporaryFile()
+        html_part.write("<h2>Users by day</h2>")
+
+        for count in range(len(charts)):
+            html_part.write("<img src=\"cid:image%s\">" % (count + 1))
+
+        html_part.write("<pre>")
+        text.seek(0)
+        shutil.copyfileobj(text, html_part)
+        text.close()
+        html_part.write("</pre>")
+
+        html_part.seek(0)
+        email = Email(config.get_email())
+        email.attach_html(html_part.read())
+        html_part.close()
+
+        for image in images:
+            email.attach_image(image)
+
+        sent = email.send()
+
+elif args.compact:
+    retention = config.get_db()['retention']
+
+    logging.info('Compacting records older than %s' % retention)
+
+    print 'Compacted %d scrapes, %d rows, raw records went from %d to ' \
+          '%d bytes' % database.compact(retention)
+
+elif args.backfill:
+    logging.info('Backfilling pages saved under "%s"' % args.backfill[0])
+
+    print 'Backfilled %d captures, %d nodes and %d users' % \
+          Backfill(config, database, args.backfill[0]).run()
+
+elif not args.monitor:
     parser.error('You must either scrape data or produce a report')
 
-if args.monitor:
-    interval='%s day' % str(datetime.date.today().day)
+if args.monitor and not args.daemon:
+    monitor = QuotaMonitor(config, database)
+    alerts = monitor.check()
+
+    for status in monitor.get_status():
+        print status['mac'], status['dl'], status['ul'], status['name'], \
+              status['email']
+        print '%.1f%% of %s' % (status['percent'], status['quota']),
 
-    for record in database.get_past_gw_xfer(interval):
-        node_mac = record[0]
-        dl = record[1]
-        ul = record[2]
+        if status['exhausted']:
+            print '- exhausted by %s' % status['exhausted']
+        else:
+            print
 
-        if dl > 0 and ul > 0:
-            node_name = nodes[node_mac].get_name()
-            node_settings = config.get_node_settings(node_name)
-            quota = node_settings['quota']
-            email = node_settings['email']
+    monitor.notify(alerts)
 
-            print node_mac, dl, ul, node_name, email
-            print quota
+if args.database or args.monitor or args.report or args.compact or \
+   args.daemon or args.backfill:
+    # Make sure everything spooled has been flushed before we exit
+    database.close()
 
+if not sent:
+    exit(1)
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+""" lib/api.py
+
+ HTTP API classes for CloudScraper
+
+ Copyright (c) 2013 The Goulburn Group. All Rights Reserved.
+
+ http://www.goulburngroup.com.au
+
+ Written by Alex Ferrara <alex@receptiveit.com.au>
+
+"""
+
+from lib.export import node_record, user_record
+from lib.snapshot import Snapshot
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from collections import OrderedDict
+import StringIO
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import signal
+import threading
+
+
+#
+# Helper functions
+#
+
+def dump(value):
+    """Return a value as compact JSON"""
+    return json.dumps(value, separators=(',', ':'))
+
+
+class Body:
+    """Serialized response body, with its ETag and gzipped copy"""
+
+    def __init__(self, content):
+        """Constructor"""
+        self.content = content
+        self.etag = '"%s"' % hashlib.md5(content).hexdigest()
+
+        compressed = StringIO.StringIO()
+        gzip_file = gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0)
+        gzip_file.write(content)
+        gzip_file.close()
+
+        self.gzipped = compressed.getvalue()
+
+
+class ApiState:
+    """Latest nodes, users, alerting nodes and usage of every network
+
+    Each network is serialized once when it is scraped, and the bodies of
+    every path are joined from those pieces and compressed there and then.
+    Requests only ever pick up a finished body, so serving them costs no
+    more than writing out the bytes.
+
+    put() may be used as a scrape callback, and passes each network on to
+    the next callback."""
+
+    def __init__(self, callback=None):
+        """Constructor"""
+        self.callback = callback
+        self.networks = {}
+        self.bodies = {}
+        self.lock = threading.Lock()
+
+        self.build()
+
+    def get(self, path):
+        """Return the body of a path, or None if it is not served"""
+        return self.bodies.get(path)
+
+    def serialize(self, nodes, users, scraped):
+        """Return the serialized records of one network"""
+
+        scraped = scraped.isoformat()
+        network = nodes.itervalues().next().get_values()['network']
+
+        usage = OrderedDict([('network', network),
+                             ('scraped', scraped),
+                             ('nodes', len(nodes)),
+                             ('users', len(users)),
+                             ('alerting', 0),
+                             ('dl', 0),
+                             ('ul', 0),
+                             ('gw_dl', 0),
+                             ('gw_ul', 0)])
+
+        alerting = []
+
+        for mac in sorted(nodes):
+            node = nodes[mac]
+            gw_dl, gw_ul = node.get_gw_usage()
+            usage['gw_dl'] += gw_dl
+            usage['gw_ul'] += gw_ul
+
+            if node.is_alerting():
+                usage['alerting'] += 1
+                alerting.append(mac)
+
+        for mac in users:
+            dl, ul = users[mac].get_usage()
+            usage['dl'] += dl
+            usage['ul'] += ul
+
+        node_bodies = dict((mac, dump(OrderedDict(node_record(nodes[mac],
+                                                              scraped))))
+                           for mac in nodes)
+
+        return (network,
+                {'nodes': [node_bodies[mac] for mac in sorted(nodes)],
+                 'users': [dump(OrderedDict(user_record(users[mac], network,
+                                                        scraped)))
+                           for mac in sorted(users)],
+                 'alerting': [node_bodies[mac] for mac in alerting],
+                 'usage': usage})
+
+    def build(self):
+        """Rebuild the body of every path from the serialized networks"""
+
+        networks = [self.networks[network]
+                    for network in sorted(self.networks)]
+        scraped = max([network['usage']['scraped'] for network in networks]
+                      or [None])
+
+        def records(key):
+            """Return a body listing the records of every network"""
+            return Body('{"scraped":%s,"%s":[%s]}' %
+                        (dump(scraped), key,
+                         ','.join(record for network in networks
+                                  for record in network[key])))
+
+        total = OrderedDict((key, sum(network['usage'][key]
+                                      for network in networks))
+                            for key in ('nodes', 'users', 'alerting', 'dl',
+                                        'ul', 'gw_dl', 'gw_ul'))
+
+        self.bodies = {'/nodes': records('nodes'),
+                       '/users': records('users'),
+                       '/alerting': records('alerting'),
+                       '/usage': Body(dump(OrderedDict([
+                           ('scraped', scraped),
+                           ('total', total),
+                           ('networks', [network['usage']
+                                         for network in networks])])))}
+
+    def load(self, networks, scraped):
+        """Replace every network with a list of (nodes, users)"""
+
+        serialized = dict(self.serialize(nodes, users, scraped)
+                          for nodes, users in networks if nodes)
+
+        with self.lock:
+            self.networks = serialized
+            self.build()
+
+        logging.info('API serving %d networks from %s', len(serialized),
+                     scraped)
+
+    def put(self, nodes, users, scraped=None):
+        """Replace the records of one network"""
+
+        if nodes:
+            network, serialized = self.serialize(nodes, users, scraped or
+                                                 datetime.datetime.now())
+
+            with self.lock:
+                self.networks[network] = serialized
+                self.build()
+
+        if self.callback is not None:
+            self.callback(nodes, users)
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    """Serves the precomputed bodies of an ApiState"""
+
+    server_version = 'CloudScraper'
+
+    def do_GET(self):
+        """GET implementation of this method"""
+        self.respond(True)
+
+    def do_HEAD(self):
+        """HEAD implementation of this method"""
+        self.respond(False)
+
+    def respond(self, send_body):
+        """Send a body, or Not Modified if the client has it already"""
+
+        body = self.server.state.get(self.path.split('?', 1)[0].rstrip('/'))
+
+        if body is None:
+            self.send_error(404)
+            return
+
+        etags = [etag.strip() for etag in
+                 self.headers.get('If-None-Match', '').split(',')]
+
+        if body.etag in etags or '*' in etags:
+            self.send_response(304)
+            self.send_header('ETag', body.etag)
+            self.end_headers()
+            return
+
+        content = body.content
+        accept = [encoding.split(';')[0].strip() for encoding in
+                  self.headers.get('Accept-Encoding', '').split(',')]
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('ETag', body.etag)
+        self.send_header('Vary', 'Accept-Encoding')
+
+        if 'gzip' in accept:
+            content = body.gzipped
+            self.send_header('Content-Encoding', 'gzip')
+
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+
+        if send_body:
+            self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        """Log requests at debug level rather than to stderr"""
+        logging.debug('API %s - %s', self.client_address[0], format % args)
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handling each request in its own thread"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ApiServer:
+    """Read-only HTTP API serving the latest scrape from memory
+
+    The server runs in a background thread. Scrapes reach it through the
+    state, either from the daemon as each network is polled, or from the
+    snapshot file when it is run on its own."""
+
+    def __init__(self, config, state=None):
+        """Constructor"""
+        settings = config.get_api()
+
+        self.address = settings.get('address', '127.0.0.1')
+        self.port = int(settings.get('port', 8080))
+        self.reload = float(settings.get('reload', 10))
+        self.state = state or ApiState()
+
+        self.server = None
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def start(self):
+        """Start serving in a background thread"""
+
+        self.server = ThreadedHTTPServer((self.address, self.port),
+                                         ApiHandler)
+        self.server.state = self.state
+
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='api')
+        self.thread.daemon = True
+        self.thread.start()
+
+        logging.info('API listening on %s:%d', self.address, self.port)
+
+    def stop(self):
+        """Stop serving"""
+        if self.server is not None:
+            logging.info('Stopping API')
+
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def interrupt(self, signum=None, frame=None):
+        """Stop serving a snapshot file"""
+        self.stopping.set()
+
+    def serve(self, path):
+        """Serve a snapshot file, loading it again whenever it is replaced
+
+        Runs until stopped by SIGTERM or SIGINT."""
+
+        signal.signal(signal.SIGTERM, self.interrupt)
+        signal.signal(signal.SIGINT, self.interrupt)
+
+        self.start()
+
+        modified = None
+
+        while not self.stopping.is_set():
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError, error:
+                logging.warning('Cannot read snapshot "%s": %s', path, error)
+                mtime = None
+
+            if mtime is not None and mtime != modified:
+                try:
+                    snapshot = Snapshot(path)
+                except IOError, error:
+                    logging.warning('Ignoring snapshot "%s": %s', path, error)
+                else:
+                    modified = mtime
+                    self.state.load([snapshot.get_network(index) for index in
+                                     range(len(snapshot.get_networks()))],
+                                    snapshot.get_started())
+                    snapshot.close()
+
+            self.stopping.wait(self.reload)
+
+        self.stop()
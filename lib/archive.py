@@ -0,0 +1,531 @@
+#!/usr/bin/env python
+""" lib/archive.py
+
+ Archive class for CloudScraper
+
+ Copyright (c) 2013 The Goulburn Group. All Rights Reserved.
+
+ http://www.goulburngroup.com.au
+
+ Written by Alex Ferrara <alex@receptiveit.com.au>
+
+"""
+
+from lib.reportcache import ALL_NETWORKS
+import array
+import calendar
+import datetime
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import zlib
+
+# Segment header: magic, version, number of rows, number of columns
+SEGMENT_HEADER = struct.Struct('>4sBLH')
+# Column directory entry: name, type, offset and length of the data
+COLUMN_ENTRY = struct.Struct('>16scQQ')
+SEGMENT_MAGIC = 'CSCA'
+SEGMENT_VERSION = 1
+
+# Columns stored for each table as (column name, type, value key). Types
+# are 'i' for 32 bit integers, 'f' for 32 bit floats and 's' for strings.
+COLUMNS = {'nodes': [('mac', 's', 'mac'),
+                     ('name', 's', 'name'),
+                     ('network', 's', 'network'),
+                     ('gateway', 's', 'gateway_name'),
+                     ('firmware', 's', 'fw_version'),
+                     ('status', 'i', 'status'),
+                     ('users', 'i', 'users'),
+                     ('gwkbdown', 'i', 'gw_dl'),
+                     ('gwkbup', 'i', 'gw_ul'),
+                     ('kbdown', 'i', 'dl'),
+                     ('kbup', 'i', 'ul'),
+                     ('uptime', 'f', 'uptime_percent')],
+           'users': [('mac', 's', 'mac'),
+                     ('name', 's', 'name'),
+                     ('node', 's', 'node_mac'),
+                     ('blocked', 's', 'blocked'),
+                     ('kbdown', 'i', 'dl'),
+                     ('kbup', 'i', 'ul')]}
+
+INTERVAL = re.compile(r'^\s*(\d+)\s+(day|week|month|year)s?\s*$')
+
+
+#
+# Helper functions
+#
+
+def encode_column(column_type, values):
+    """Return a compressed representation of a list of values"""
+
+    if column_type == 's':
+        data = '\0'.join(unicode(value).encode('utf-8') for value in values)
+    else:
+        if column_type == 'i':
+            data = array.array('i', [int(value) for value in values])
+        else:
+            data = array.array('f', [float(value) for value in values])
+
+        # Columns are always stored little endian
+        if sys.byteorder == 'big':
+            data.byteswap()
+
+        data = data.tostring()
+
+    return zlib.compress(data)
+
+
+def decode_column(column_type, data, rows):
+    """Return the list of values held in a compressed column"""
+
+    data = zlib.decompress(data)
+
+    if rows == 0:
+        return []
+
+    if column_type == 's':
+        return [value.decode('utf-8') for value in data.split('\0')]
+
+    values = array.array(column_type)
+    values.fromstring(data)
+
+    if sys.byteorder == 'big':
+        values.byteswap()
+
+    return values
+
+
+def interval_start(interval, now=None):
+    """Return the datetime an interval such as '3 month' before now"""
+
+    if now is None:
+        now = datetime.datetime.now()
+
+    match = INTERVAL.match(interval)
+
+    if match is None:
+        raise ValueError('Unsupported interval "%s"' % interval)
+
+    count = int(match.group(1))
+    unit = match.group(2)
+
+    if unit == 'day':
+        return now - datetime.timedelta(days=count)
+    elif unit == 'week':
+        return now - datetime.timedelta(weeks=count)
+
+    if unit == 'year':
+        count *= 12
+
+    month = now.year * 12 + now.month - 1 - count
+    year, month = divmod(month, 12)
+    day = min(now.day, calendar.monthrange(year, month + 1)[1])
+
+    return now.replace(year=year, month=month + 1, day=day)
+
+
+def write_segment(filename, table, rows):
+    """Write a list of value dicts to a columnar segment file"""
+
+    columns = COLUMNS[table]
+    blobs = [encode_column(column_type, [row[key] for row in rows])
+             for name, column_type, key in columns]
+
+    offset = SEGMENT_HEADER.size + COLUMN_ENTRY.size * len(columns)
+
+    segment_file = open(filename, 'wb')
+    segment_file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION,
+                                           len(rows), len(columns)))
+
+    for (name, column_type, key), blob in zip(columns, blobs):
+        segment_file.write(COLUMN_ENTRY.pack(name, column_type,
+                                             offset, len(blob)))
+        offset += len(blob)
+
+    for blob in blobs:
+        segment_file.write(blob)
+
+    segment_file.close()
+
+
+class Segment:
+    """Read-only view of a columnar segment file
+
+    The file is memory mapped, and only the columns that are asked for are
+    decompressed."""
+
+    def __init__(self, filename):
+        """Constructor"""
+        segment_file = open(filename, 'rb')
+        self.data = mmap.mmap(segment_file.fileno(), 0,
+                              access=mmap.ACCESS_READ)
+        segment_file.close()
+
+        magic, version, self.rows, count = \
+            SEGMENT_HEADER.unpack_from(self.data, 0)
+
+        if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+            raise IOError('Segment "%s" has an unknown format' % filename)
+
+        self.columns = dict()
+
+        for index in range(count):
+            name, column_type, offset, length = \
+                COLUMN_ENTRY.unpack_from(self.data, SEGMENT_HEADER.size +
+                                         COLUMN_ENTRY.size * index)
+            self.columns[name.rstrip('\0')] = (column_type, offset, length)
+
+    def close(self):
+        """Unmap the segment"""
+        self.data.close()
+
+    def column(self, name):
+        """Return the values of one column"""
+        column_type, offset, length = self.columns[name]
+
+        return decode_column(column_type,
+                             self.data[offset:offset + length],
+                             self.rows)
+
+
+class Archive:
+    """Columnar archive database class
+
+    Each scrape is stored as one nodes and one users segment per network,
+    in a directory per day. Storing the same network and day again replaces
+    its segments.
+
+    Segments are written under temporary names, and only take the place of
+    the real ones on commit(). Each segment is replaced atomically, but a
+    commit of several segments is not."""
+
+    def __init__(self, config):
+        """Constructor"""
+        self.path = config['path']
+        self.pending = []
+
+        if not os.path.isdir(self.path):
+            logging.info('Creating archive directory "%s"', self.path)
+            os.makedirs(self.path)
+
+    def add_records(self, nodes, users, started, commit=True):
+        """Add lists of node and user values to the archive"""
+
+        networks = {}
+        node_networks = {}
+
+        for values in nodes:
+            node_networks[values['mac']] = values['network']
+            networks.setdefault(values['network'], ([], []))[0].append(values)
+
+        for values in users:
+            network = values.get('network') or \
+                      node_networks.get(values['node_mac'], 'unknown')
+            networks.setdefault(network, ([], []))[1].append(values)
+
+        day_path = os.path.join(self.path, started.strftime('%Y-%m-%d'))
+
+        if not os.path.isdir(day_path):
+            os.makedirs(day_path)
+
+        for network in sorted(networks):
+            logging.info('Archiving network "%s" for %s', network,
+                         started.date())
+
+            prefix = os.path.join(day_path, re.sub(r'[^\w.-]', '_', network))
+
+            for index, table in enumerate(('nodes', 'users')):
+                filename = '%s.%s' % (prefix, table)
+                temporary = '%s.%d-%x.tmp' % (filename, os.getpid(),
+                                              id(self))
+
+                self.pending.append((temporary, filename))
+                write_segment(temporary, table, networks[network][index])
+
+        if commit:
+            self.commit()
+
+    def add_changes(self, events):
+        """Archive implementation of this method
+
+        Events are appended to a changes file in the directory of the day
+        they were seen, one JSON object per line."""
+
+        days = {}
+
+        for event in events:
+            days.setdefault(event['seen'].strftime('%Y-%m-%d'),
+                            []).append(event)
+
+        for day in sorted(days):
+            day_path = os.path.join(self.path, day)
+
+            if not os.path.isdir(day_path):
+                os.makedirs(day_path)
+
+            changes_file = open(os.path.join(day_path, 'changes'), 'a')
+
+            for event in days[day]:
+                changes_file.write(json.dumps(dict(event, seen=event['seen']
+                                                   .isoformat())) + '\n')
+
+            changes_file.close()
+
+    def close(self):
+        """Discard segments that were not committed"""
+        self.rollback()
+
+    def commit(self):
+        """Move the segments written since the last commit into place"""
+        for temporary, filename in self.pending:
+            os.rename(temporary, filename)
+
+        self.pending = []
+
+    def rollback(self):
+        """Remove the segments written since the last commit"""
+        for temporary, filename in self.pending:
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+
+        self.pending = []
+
+    def compact(self, retention):
+        """Archive implementation of this method"""
+        logging.info('The archive is already compact, nothing to do')
+
+        size = sum(os.path.getsize(os.path.join(directory, filename))
+                   for directory, subdirs, filenames in os.walk(self.path)
+                   for filename in filenames)
+
+        return (0, 0, size, size)
+
+    def segments(self, table, interval):
+        """Yield each day and segment of a table within an interval"""
+
+        for date, network, segment in \
+                self.day_segments(table, interval_start(interval).date()):
+            yield date, segment
+
+    def day_segments(self, table, first, last=None):
+        """Yield the day, network and segment of a table for each network
+        and day from first to last"""
+
+        for day in sorted(os.listdir(self.path)):
+            try:
+                date = datetime.datetime.strptime(day, '%Y-%m-%d').date()
+            except ValueError:
+                continue
+
+            if date < first or (last is not None and date > last):
+                continue
+
+            day_path = os.path.join(self.path, day)
+
+            for filename in sorted(os.listdir(day_path)):
+                if filename.endswith('.' + table):
+                    segment = Segment(os.path.join(day_path, filename))
+                    yield date, filename[:-len(table) - 1], segment
+                    segment.close()
+
+    def get_day_gw_xfer(self, first, last):
+        """Archive implementation of this method"""
+
+        totals = {}
+
+        for date, name, segment in self.day_segments('nodes', first, last):
+            for network, mac, dl, ul in zip(segment.column('network'),
+                                            segment.column('mac'),
+                                            segment.column('gwkbdown'),
+                                            segment.column('gwkbup')):
+                total = totals.setdefault((date, network, mac), [0, 0])
+                total[0] += dl
+                total[1] += ul
+
+        return [key + tuple(totals[key]) for key in sorted(totals)]
+
+    def get_top_users(self, first, last, count):
+        """Archive implementation of this method"""
+
+        totals = {}
+
+        for date, network, segment in self.day_segments('users', first,
+                                                        last):
+            for mac, name, dl, ul in zip(segment.column('mac'),
+                                         segment.column('name'),
+                                         segment.column('kbdown'),
+                                         segment.column('kbup')):
+                total = totals.setdefault(mac, [name, 0, 0, set()])
+                total[0] = name
+                total[1] += dl
+                total[2] += ul
+                total[3].add(date)
+
+        ranked = sorted(totals, key=lambda mac: (-totals[mac][1] -
+                                                 totals[mac][2], mac))
+        rows = []
+
+        for index, mac in enumerate(ranked):
+            name, dl, ul, days = totals[mac]
+
+            if rows and dl + ul == rows[-1][3] + rows[-1][4]:
+                rank = rows[-1][0]
+            else:
+                rank = index + 1
+
+            if rank > count:
+                break
+
+            rows.append((rank, mac, name, dl, ul, len(days)))
+
+        return rows
+
+    def get_gateway_usage(self, first, last):
+        """Archive implementation of this method"""
+
+        days = {}
+        names = {}
+
+        for date, network, segment in self.day_segments('nodes', first,
+                                                        last):
+            for mac, name, dl, ul in zip(segment.column('mac'),
+                                         segment.column('name'),
+                                         segment.column('gwkbdown'),
+                                         segment.column('gwkbup')):
+                if dl + ul > 0:
+                    total = days.setdefault(date, {}).setdefault(mac, [0, 0])
+                    total[0] += dl
+                    total[1] += ul
+                    names[mac] = name
+
+        running = {}
+        rows = []
+
+        for date in sorted(days):
+            day_total = sum(dl + ul for dl, ul in days[date].itervalues())
+
+            for mac in sorted(days[date]):
+                dl, ul = days[date][mac]
+                running[mac] = running.get(mac, 0) + dl + ul
+
+                rows.append((date, mac, names[mac], dl, ul, running[mac],
+                             round(100.0 * (dl + ul) / day_total, 1)))
+
+        return rows
+
+    def get_node_users(self, first, last):
+        """Archive implementation of this method"""
+
+        counts = {}
+        names = {}
+
+        for date, network, segment in self.day_segments('nodes', first,
+                                                        last):
+            for mac, name, users in zip(segment.column('mac'),
+                                        segment.column('name'),
+                                        segment.column('users')):
+                days = counts.setdefault(mac, {})
+                days[date] = max(days.get(date, 0), users)
+                names[mac] = name
+
+        rows = []
+
+        for mac in counts:
+            days = counts[mac]
+            peak_day = max(days, key=lambda date: (days[date], date))
+
+            rows.append((mac, names[mac], len(days),
+                         round(float(sum(days.itervalues())) / len(days), 1),
+                         days[peak_day], peak_day, days[max(days)]))
+
+        rows.sort(key=lambda row: (-row[3], row[0]))
+
+        return rows
+
+    def get_quota(self, month, rate_days):
+        """Archive implementation of this method
+
+        The archive has no running totals, so this scans the internet usage
+        columns of the month so far."""
+
+        totals = {}
+        recent = {}
+        recent_days = set()
+        since = datetime.date.today() - datetime.timedelta(days=rate_days)
+        days = (datetime.date.today() - min(month, since)).days
+
+        for date, segment in self.segments('nodes', '%d day' % days):
+            for mac, name, dl, ul in zip(segment.column('mac'),
+                                         segment.column('name'),
+                                         segment.column('gwkbdown'),
+                                         segment.column('gwkbup')):
+                if date >= month:
+                    total = totals.setdefault(mac, [name, 0, 0])
+                    total[1] += dl
+                    total[2] += ul
+
+                if date > since:
+                    recent[mac] = recent.get(mac, 0) + dl + ul
+                    recent_days.add(date)
+
+        alerted = self.load_alerted(month)
+
+        return [(mac, totals[mac][0], totals[mac][1], totals[mac][2],
+                 recent.get(mac, 0) / max(1, len(recent_days)),
+                 alerted.get(mac, 0))
+                for mac in sorted(totals) if totals[mac][1] or totals[mac][2]]
+
+    def load_alerted(self, month):
+        """Return the quota thresholds alerted on for a month"""
+        try:
+            alerted_file = open(os.path.join(self.path, 'quota-%s.json' %
+                                             month.strftime('%Y-%m')))
+        except IOError:
+            return {}
+
+        alerted = json.load(alerted_file)
+        alerted_file.close()
+
+        return alerted
+
+    def set_quota_alerted(self, month, mac, threshold):
+        """Archive implementation of this method"""
+        alerted = self.load_alerted(month)
+        alerted[mac] = threshold
+
+        filename = os.path.join(self.path, 'quota-%s.json' %
+                                month.strftime('%Y-%m'))
+
+        alerted_file = open(filename + '.tmp', 'w')
+        json.dump(alerted, alerted_file)
+        alerted_file.close()
+
+        os.rename(filename + '.tmp', filename)
+
+    def get_day_stats(self, first, last):
+        """Archive implementation of this method
+
+        Users segments are named after their network."""
+
+        days = {}
+
+        for date, network, segment in self.day_segments('users', first,
+                                                        last):
+            macs = segment.column('mac')
+            kbdown = sum(segment.column('kbdown'))
+            kbup = sum(segment.column('kbup'))
+
+            for key in (network, ALL_NETWORKS):
+                day = days.setdefault((date, key), [set(), 0, 0])
+                day[0].update(macs)
+                day[1] += kbdown
+                day[2] += kbup
+
+        return [key + (len(days[key][0]), days[key][1], days[key][2])
+                for key in sorted(days)]
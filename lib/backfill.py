@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+""" lib/backfill.py
+
+ Backfill class for CloudScraper
+
+ Copyright (c) 2013 The Goulburn Group. All Rights Reserved.
+
+ http://www.goulburngroup.com.au
+
+ Written by Alex Ferrara <alex@receptiveit.com.au>
+
+"""
+
+from lib.checkin import CheckinPolicy
+from lib.cloudtrax import CloudTrax, checkin_fields, checkin_from_image, \
+                          distill_html
+from multiprocessing import Pool
+import datetime
+import logging
+import os
+import re
+import time
+
+# Saved pages are recognised by the start of their file name
+PAGE_TYPES = [('nodes_attnt2', 'nodes'),
+              ('users2', 'users'),
+              ('checkin-graph2', 'checkin')]
+
+PAGE_NETWORK = re.compile(r'[?&]id=([^&]+)')
+PAGE_MAC = re.compile(r'[?&]mac=([0-9A-Fa-f:]{17})')
+PAGE_TIME = re.compile(r'(\d{4})-?(\d{2})-?(\d{2})'
+                       r'(?:[T_ -]?(\d{2})[:.-]?(\d{2})(?:[:.-]?(\d{2}))?)?')
+
+# Name of the file recording captures that have been loaded
+PROGRESS_FILE = '.backfill-progress'
+
+# Seconds between progress reports
+PROGRESS_INTERVAL = 10
+
+# Set in each worker process by init_worker()
+worker_config = None
+
+
+#
+# Helper functions
+#
+
+def page_time(path):
+    """Return the time in a page's path, or when the page was saved"""
+
+    matches = PAGE_TIME.findall(path)
+
+    for match in reversed(matches):
+        try:
+            return datetime.datetime(*[int(part) for part in match if part])
+        except ValueError:
+            continue
+
+    return datetime.datetime.fromtimestamp(os.path.getmtime(path))
+
+
+def nearest_images(images, network, started):
+    """Return the checkin image of each mac saved nearest to a capture"""
+
+    result = {}
+
+    for mac in images:
+        candidates = [(abs(saved - started), image_path)
+                      for saved, image_network, image_path in images[mac]
+                      if image_network in (None, network)]
+
+        if candidates:
+            result[mac] = min(candidates)[1]
+
+    return result
+
+
+def find_captures(path):
+    """Return the captures saved under a directory, oldest first
+
+    A capture is a nodes page, with the users page and checkin images of
+    the same network and time found in the same directory. The network
+    comes from the id= in a page's file name, or else the directory name,
+    and the time from a date in the path, or else when the page was
+    saved. Each node's checkin image is the one saved nearest in time to
+    the capture."""
+
+    captures = {}
+    images = {}
+
+    for directory, subdirs, filenames in os.walk(path):
+        subdirs.sort()
+
+        for filename in sorted(filenames):
+            for prefix, page_type in PAGE_TYPES:
+                if filename.startswith(prefix):
+                    break
+            else:
+                continue
+
+            page_path = os.path.join(directory, filename)
+            match = PAGE_NETWORK.search(filename)
+
+            if page_type == 'checkin':
+                mac = PAGE_MAC.search(filename)
+
+                if mac is None:
+                    logging.warning('No mac address in "%s"', page_path)
+                    continue
+
+                # Images without an id= belong to any network's capture
+                image_network = match and match.group(1)
+                macs = images.setdefault(directory, {})
+                macs.setdefault(mac.group(1).lower(), []).append(
+                    (page_time(page_path), image_network, page_path))
+                continue
+
+            if match is not None:
+                network = match.group(1)
+            else:
+                network = os.path.basename(directory)
+
+            key = (directory, network, page_time(page_path))
+            capture = captures.setdefault(key, {'network': network,
+                                                'started': key[2],
+                                                'nodes': None,
+                                                'users': None})
+            capture[page_type] = page_path
+
+    result = []
+
+    for key in captures:
+        directory, network, started = key
+        capture = captures[key]
+
+        if capture['nodes'] is None:
+            logging.warning('No nodes page for network "%s" at %s in "%s"',
+                            network, started, directory)
+            continue
+
+        capture['checkin'] = nearest_images(images.get(directory, {}),
+                                            network, started)
+        capture['key'] = os.path.relpath(capture['nodes'], path)
+        result.append(capture)
+
+    result.sort(key=lambda capture: (capture['started'], capture['key']))
+
+    return result
+
+
+def read_rows(path, element, identifier):
+    """Return the rows of a saved page as plain unicode strings"""
+
+    page = open(path, 'rb')
+    content = page.read()
+    page.close()
+
+    return [[[unicode(text) for text in cell] for cell in row]
+            for row in distill_html(content, element, identifier)]
+
+
+def init_worker(config):
+    """Set up a backfill worker process"""
+    global worker_config
+
+    worker_config = config
+
+
+def parse_capture(capture):
+    """Return the capture with lists of node and user values
+
+    This runs in a worker process, using the same parsing as a scrape."""
+
+    cloudtrax = CloudTrax(worker_config, checkin=CheckinPolicy({}),
+                          login=False)
+
+    def checkin(raw_values):
+        """Return the checkin data of a node from its saved image"""
+        image = capture['checkin'].get(checkin_fields(raw_values)[0].lower())
+
+        if image is None:
+            return (0, 0, 0, 0)
+
+        image_file = open(image, 'rb')
+        content = image_file.read()
+        image_file.close()
+
+        return checkin_from_image(content)
+
+    nodes = cloudtrax.parse_nodes(capture['network'],
+                                  read_rows(capture['nodes'], 'table',
+                                            {'id': 'mytable'}),
+                                  checkin)
+    users = dict()
+
+    if capture['users'] is not None:
+        users = cloudtrax.parse_users(read_rows(capture['users'], 'table',
+                                                {'class': 'inline sortable'}),
+                                      nodes)
+
+    return (capture,
+            [nodes[mac].get_values() for mac in nodes],
+            [users[mac].get_values() for mac in users])
+
+
+class Backfill:
+    """Loads saved dashboard pages into the database
+
+    Captures are parsed in a pool of processes and stored with the time
+    they were saved, in order. Each capture is recorded in a progress file
+    once it has been stored, so an interrupted backfill carries on where
+    it stopped when it is run again."""
+
+    def __init__(self, config, database, path, processes=None):
+        """Constructor"""
+        self.config = config
+        self.database = database
+        self.path = path
+        self.processes = processes
+        self.progress_file = os.path.join(path, PROGRESS_FILE)
+
+    def load_progress(self):
+        """Return the keys of captures that have already been stored"""
+
+        if not os.path.exists(self.progress_file):
+            return set()
+
+        progress = open(self.progress_file)
+        done = set(line.rstrip('\n') for line in progress)
+        progress.close()
+
+        return done
+
+    def run(self):
+        """Backfill every capture that has not been stored yet
+
+        Returns a tuple of (captures, nodes, users) stored."""
+
+        done = self.load_progress()
+        captures = [capture for capture in find_captures(self.path)
+                    if capture['key'] not in done]
+
+        logging.info('%d captures to backfill, %d already done',
+                     len(captures), len(done))
+
+        if not captures:
+            return (0, 0, 0)
+
+        pool = Pool(self.processes, init_worker, (self.config,))
+        progress = open(self.progress_file, 'a')
+
+        started = time.time()
+        reported = started
+        stored = [0, 0, 0]
+
+        try:
+            for capture, nodes, users in pool.imap(parse_capture, captures):
+                self.database.add_backfill(nodes, users, capture['started'])
+
+                progress.write(capture['key'] + '\n')
+                progress.flush()
+
+                stored[0] += 1
+                stored[1] += len(nodes)
+                stored[2] += len(users)
+
+                now = time.time()
+
+                if now - reported >= PROGRESS_INTERVAL or \
+                   stored[0] == len(captures):
+                    reported = now
+                    elapsed = max(now - started, 0.001)
+
+                    print 'Backfilled %d of %d captures (%s), ' \
+                          '%.1f captures/s, %.0f rows/s' % \
+                          (stored[0], len(captures), capture['started'],
+                           stored[0] / elapsed,
+                           (stored[1] + stored[2]) / elapsed)
+        finally:
+            pool.terminate()
+            pool.join()
+            progress.close()
+
+        return tuple(stored)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+""" lib/changes.py
+
+ Change tracker class for CloudScraper
+
+ Copyright (c) 2013 The Goulburn Group. All Rights Reserved.
+
+ http://www.goulburngroup.com.au
+
+ Written by Alex Ferrara <alex@receptiveit.com.au>
+
+"""
+
+from lib.node import NODE_STATUS
+import datetime
+import json
+import logging
+import os
+import threading
+
+# Types of change event, in the order they are reported
+EVENT_TYPES = ['node_down', 'node_up', 'node_new', 'node_vanished',
+               'gateway_changed', 'firmware_changed', 'name_changed',
+               'user_new', 'user_vanished']
+
+UP_STATUS = (NODE_STATUS['gw_up'], NODE_STATUS['relay_up'],
+             NODE_STATUS['spare_gw_up'], NODE_STATUS['spare_up'])
+
+# Attributes of a node compared between scrapes, and the event raised
+NODE_ATTRIBUTES = [('gateway_name', 'gateway_changed'),
+                   ('fw_version', 'firmware_changed'),
+                   ('name', 'name_changed')]
+
+
+#
+# Helper functions
+#
+
+def node_state(values):
+    """Return the tracked attributes of a node"""
+    state = dict((key, values[key]) for key, event in NODE_ATTRIBUTES)
+    state['status'] = values['status']
+
+    return state
+
+
+def diff_network(network, previous, current, seen):
+    """Return the change events between two states of a network"""
+
+    events = []
+
+    def event(event_type, mac, name, old=None, new=None):
+        events.append({'type': event_type,
+                       'network': network,
+                       'mac': mac,
+                       'name': name,
+                       'old': old,
+                       'new': new,
+                       'seen': seen})
+
+    old_nodes = previous['nodes']
+    new_nodes = current['nodes']
+
+    for mac in sorted(new_nodes):
+        state = new_nodes[mac]
+
+        if mac not in old_nodes:
+            event('node_new', mac, state['name'])
+            continue
+
+        old_state = old_nodes[mac]
+        was_up = old_state['status'] in UP_STATUS
+        is_up = state['status'] in UP_STATUS
+
+        if was_up and not is_up:
+            event('node_down', mac, state['name'])
+        elif is_up and not was_up:
+            event('node_up', mac, state['name'])
+
+        for key, event_type in NODE_ATTRIBUTES:
+            if old_state[key] != state[key]:
+                event(event_type, mac, state['name'], old_state[key],
+                      state[key])
+
+    for mac in sorted(set(old_nodes) - set(new_nodes)):
+        event('node_vanished', mac, old_nodes[mac]['name'])
+
+    old_users = set(previous['users'])
+    new_users = current['users']
+
+    for mac in sorted(set(new_users) - old_users):
+        event('user_new', mac, new_users[mac])
+
+    for mac in sorted(old_users - set(new_users)):
+        event('user_vanished', mac, previous['users'][mac])
+
+    return events
+
+
+def write_changes(report, events):
+    """Write change events to a report, grouped by type"""
+
+    report.heading('Changes since the last scrape')
+
+    if not events:
+        report.write('No changes\n\n')
+        return
+
+    for event_type in EVENT_TYPES:
+        for event in events:
+            if event['type'] != event_type:
+                continue
+
+            line = '%s: %s (%s) in %s' % (event_type.replace('_', ' '),
+                                          event['name'], event['mac'],
+                                          event['network'])
+
+            if event['old'] is not None or event['new'] is not None:
+                line += ', %s -> %s' % (event['old'], event['new'])
+
+            report.write(line + '\n')
+
+    report.write('\n\n')
+
+
+class ChangeTracker:
+    """Change data capture between consecutive scrapes
+
+    Keeps the state of every node and the users of every network from the
+    last scrape in a file, keyed by MAC address. Each network handed to
+    put() is compared with its last state, and only what changed comes
+    out as events. The first scrape of a network sets its state without
+    raising any events.
+
+    put() may be used as a scrape callback, and passes each network on to
+    the next callback, usually the put() of a database writer."""
+
+    def __init__(self, path, callback=None, seen=None):
+        """Constructor"""
+        self.path = path
+        self.callback = callback
+        self.state = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(self.path):
+            try:
+                state_file = open(self.path)
+                self.state = json.load(state_file)
+                state_file.close()
+            except ValueError:
+                logging.warning('Ignoring unreadable change state "%s"',
+                                self.path)
+
+        self.reset(seen)
+
+    def get_events(self):
+        """Return the change events raised so far"""
+        return self.events
+
+    def put(self, nodes, users):
+        """Compare the nodes and users of one network with its last state"""
+
+        if nodes:
+            network = nodes.itervalues().next().get_values()['network']
+
+            current = {'nodes': dict((mac, node_state(nodes[mac]
+                                                      .get_values()))
+                                     for mac in nodes),
+                       'users': dict((mac, users[mac].get_values()['name'])
+                                     for mac in users)}
+
+            with self.lock:
+                previous = self.state.get(network)
+                self.state[network] = current
+
+                if previous is not None:
+                    events = diff_network(network, previous, current,
+                                          self.seen)
+
+                    for event in events:
+                        logging.info('%s: %s in %s', event['type'],
+                                     event['mac'], network)
+
+                    self.events.extend(events)
+
+        if self.callback is not None:
+            self.callback(nodes, users)
+
+    def reset(self, seen=None):
+        """Start collecting the events of a new scrape"""
+        self.seen = seen or datetime.datetime.now()
+        self.events = []
+
+    def save(self):
+        """Save the state of every network for the next scrape"""
+
+        logging.info('%d changes since the last scrape', len(self.events))
+
+        state_file = open(self.path + '.tmp', 'w')
+        json.dump(self.state, state_file)
+        state_file.close()
+
+        os.rename(self.path + '.tmp', self.path)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+""" lib/checkin.py
+
+ Checkin policy class for CloudScraper
+
+ Copyright (c) 2013 The Goulburn Group. All Rights Reserved.
+
+ http://www.goulburngroup.com.au
+
+ Written by Alex Ferrara <alex@receptiveit.com.au>
+
+"""
+
+from lib.node import NODE_STATUS
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+DAY = 86400
+
+UPTIME_UNITS = {'d': 86400, 'h': 3600, 'm': 60, 's': 1}
+UPTIME_PART = re.compile(r'(\d+)\s*([dhms])', re.IGNORECASE)
+
+
+#
+# Helper functions
+#
+
+def parse_uptime(uptime):
+    """Return an uptime such as '3d 4h 12m' in seconds, or None"""
+    parts = UPTIME_PART.findall(uptime)
+
+    if not parts:
+        return None
+
+    return sum(int(value) * UPTIME_UNITS[unit.lower()]
+               for value, unit in parts)
+
+
+class CheckinPolicy:
+    """Decides which nodes need a fresh checkin image
+
+    Fetching the checkin image of every node is the bulk of the requests
+    made on each run. A node that was healthy last time, has not changed
+    status and has not restarted since is estimated from its cached
+    checkin data instead, shifted along by the time since it was fetched.
+    Alerting nodes, down nodes, and optionally gateways, are always
+    fetched. A policy may be shared by several threads."""
+
+    def __init__(self, config):
+        """Constructor"""
+        self.cache_file = config.get('cache')
+        self.max_age = float(config.get('max_age', 6)) * 3600
+        self.always = [item.strip() for item in
+                       config.get('always', 'alerting,gateway').split(',')]
+        self.cache = {}
+        self.fetched = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+        if self.cache_file and os.path.exists(self.cache_file):
+            try:
+                cache_file = open(self.cache_file)
+                self.cache = json.load(cache_file)
+                cache_file.close()
+            except ValueError:
+                logging.warning('Ignoring unreadable checkin cache "%s"',
+                                self.cache_file)
+
+    def get(self, mac, status, last_checkin, uptime, fetch):
+        """Return checkin data for a node, calling fetch() if required"""
+
+        now = time.time()
+        reason = self.must_fetch(mac, status, last_checkin, uptime, now)
+
+        if reason is None:
+            return self.reuse(mac, status, now)
+
+        logging.info('Fetching checkin data for %s, %s', mac, reason)
+
+        checkin_data = fetch()
+        self.record(mac, status, uptime, checkin_data, now)
+
+        return checkin_data
+
+    def record(self, mac, status, uptime, checkin_data, now):
+        """Cache checkin data that has just been fetched"""
+        with self.lock:
+            self.fetched += 1
+            self.cache[mac] = {'checkin': list(checkin_data),
+                               'status': status,
+                               'uptime': parse_uptime(uptime),
+                               'fetched': now}
+
+    def reuse(self, mac, status, now):
+        """Return checkin data estimated from the cache instead of fetched"""
+        with self.lock:
+            self.skipped += 1
+
+        return self.estimate(self.cache[mac], status, now)
+
+    def estimate(self, cached, status, now):
+        """Estimate current checkin data from data fetched earlier
+
+        The node has been up since it was fetched, so that part of the 24
+        hour window counts as online in its current role, and the rest of
+        the window keeps the proportions that were fetched."""
+
+        elapsed = min(1.0, (now - cached['fetched']) / DAY)
+        keep = 1 - elapsed
+        time_as_gw, time_as_relay, time_offline, time_online = \
+            cached['checkin']
+
+        time_as_gw *= keep
+        time_as_relay *= keep
+        time_offline *= keep
+
+        if status in (NODE_STATUS['gw_up'], NODE_STATUS['spare_gw_up']):
+            time_as_gw += elapsed * 100
+        else:
+            time_as_relay += elapsed * 100
+
+        return (time_as_gw, time_as_relay, time_offline,
+                time_as_gw + time_as_relay)
+
+    def get_stats(self):
+        """Return the number of checkin images fetched and skipped"""
+        return (self.fetched, self.skipped)
+
+    def must_fetch(self, mac, status, last_checkin, uptime, now):
+        """Return why a node must be fetched, or None if it can be skipped"""
+
+        cached = self.cache.get(mac)
+
+        if cached is None:
+            return 'not cached'
+
+        if status not in (NODE_STATUS['gw_up'], NODE_STATUS['relay_up'],
+                          NODE_STATUS['spare_gw_up'], NODE_STATUS['spare_up']):
+            return 'node is down'
+
+        if 'alerting' in self.always and \
+           (cached['checkin'][2] > 0 or 'Late' in last_checkin or
+            'Down' in last_checkin):
+            return 'node is alerting'
+
+        if 'gateway' in self.always and status == NODE_STATUS['gw_up']:
+            return 'node is a gateway'
+
+        if status != cached['status']:
+            return 'status has changed'
+
+        if now - cached['fetched'] > self.max_age:
+            return 'cache has expired'
+
+        seconds = parse_uptime(uptime)
+
+        if seconds is None or cached['uptime'] is None or \
+           seconds < cached['uptime'] + (now - cached['fetched']) - 3600:
+            return 'node has restarted'
+
+        return None
+
+    def save(self):
+        """Save checkin data for the next run"""
+
+        logging.info('Fetched %d checkin images, skipped %d',
+                     self.fetched, self.skipped)
+
+        if not self.cache_file:
+            return
+
+        with self.lock:
+            cache_file = open(self.cache_file + '.tmp', 'w')
+            json.dump(self.cache, cache_file)
+            cache_file.close()
+
+        os.rename(self.cache_file + '.tmp', self.cache_file)
@@ -12,51 +12,49 @@
 """
 
 from BeautifulSoup import BeautifulSoup
+from lib.checkin import CheckinPolicy
+from lib.graph import render_chart
 from lib.node import Node
 from lib.user import User
+import copy
 import cStringIO
+import heapq
 import logging
 import requests
-import texttable
-import pygal
+import threading
 import Image
 
+# Number of users drawn individually on the user graph
+GRAPH_USERS = 20
+
+TABLE_HEADERS = {'gateway': ['Name\n(mac)',
+                             'Users',
+                             'DL MB\n(UL MB)',
+                             'GWDL MB\n(GWUL MB)',
+                             'Up\n(Down)',
+                             'IP Address\n(Firmware)'],
+                 'relay': ['Name\n(mac)',
+                           'Users',
+                           'DL MB\n(UL MB)',
+                           'Gateway\n(Firmware)',
+                           'Up\n(Down)',
+                           'Latency\n(Hops)'],
+                 'spare': ['Name\n(mac)',
+                           'Users',
+                           'DL MB\n(UL MB)',
+                           'Up\n(Down)',
+                           'IP Address\n(Firmware)'],
+                 'user': ['Name\n(mac)',
+                          'Last seen on',
+                          'Blocked',
+                          'DL MB',
+                          'UL MB']}
+
 
 #
 # Helper functions
 #
 
-def draw_table(entity_type, entities):
-    """Draws a text table representation of the data supplied"""
-
-    header = {'gateway': ['Name\n(mac)',
-                          'Users',
-                          'DL MB\n(UL MB)',
-                          'GWDL MB\n(GWUL MB)',
-                          'Up\n(Down)',
-                          'IP Address\n(Firmware)'],
-              'relay': ['Name\n(mac)',
-                        'Users',
-                        'DL MB\n(UL MB)',
-                        'Gateway\n(Firmware)',
-                        'Up\n(Down)',
-                        'Latency\n(Hops)'],
-              'spare': ['Name\n(mac)',
-                        'Users',
-                        'DL MB\n(UL MB)',
-                        'Up\n(Down)',
-                        'IP Address\n(Firmware)']}
-
-    table = texttable.Texttable()
-    table.header(header[entity_type])
-
-    for entity in entities:
-        if entities[entity].get_type() == entity_type:
-            table.add_row(entities[entity].get_table_row())
-
-    return table.draw()
-
-
 def distill_html(content, element, identifier):
     """Accept some HTML and return the filtered output"""
     distilled_text = []
@@ -93,6 +91,51 @@ def distill_html(content, element, identifier):
     return distilled_text
 
 
+def checkin_from_image(content):
+    """Return the checkin data shown by a checkin graph image"""
+
+    colour_counter = {'cccccc': 0, '1faa5f': 0, '4fdd8f': 0}
+
+    checkin_img = Image.open(cStringIO.StringIO(content))
+
+    row = 1
+
+    pixelmap = checkin_img.load()
+
+    for col in range(0, checkin_img.size[0]):
+        pixel_colour = str("%x%x%x" % (pixelmap[col, row][0],
+                                       pixelmap[col, row][1],
+                                       pixelmap[col, row][2]))
+
+        if pixel_colour in colour_counter.keys():
+            colour_counter[pixel_colour] += 1
+        else:
+            colour_counter[pixel_colour] = 1
+
+    # Convert number of pixels into a percent
+    time_as_gw = percentage(colour_counter['1faa5f'],
+                            checkin_img.size[0] - 2)
+    time_as_relay = percentage(colour_counter['4fdd8f'],
+                               checkin_img.size[0] - 2)
+    time_offline = percentage(colour_counter['cccccc'],
+                              checkin_img.size[0] - 2)
+    time_online = time_as_gw + time_as_relay
+
+    return (time_as_gw, time_as_relay, time_offline, time_online)
+
+
+def checkin_fields(raw_values):
+    """Return the mac, status, last checkin and uptime of a raw node row"""
+
+    try:
+        uptime = raw_values[6][0]
+    except IndexError:
+        uptime = ''
+
+    return (raw_values[2][0], raw_values[0][0], ' '.join(raw_values[9]),
+            uptime)
+
+
 def percentage(value, max_value):
     """Returns a float representing the percentage that
        value is of max_value"""
@@ -100,15 +143,30 @@ def percentage(value, max_value):
     return (float(value) * 100) / max_value
 
 
+class CloudTraxError(Exception):
+    """Raised when the CloudTrax dashboard cannot be scraped"""
+    pass
+
+
 class CloudTrax:
     """CloudTrax connector class"""
 
-    def __init__(self, config):
-        """Constructor"""
+    def __init__(self, config, callback=None, budget=None, collect=True,
+                 account=None, checkin=None, login=True):
+        """Constructor
+
+        If a callback is supplied, it is called with the nodes and users of
+        each network as soon as that network has been scraped. If a budget
+        is supplied, its acquire() method is called before every request.
+        With collect=False, only the login is done. The account defaults to
+        the first network account in the config, and a checkin policy may
+        be shared between accounts. With login=False, nothing is requested
+        and results are added with parse_nodes() and parse_users()."""
         self.nodes = dict()
         self.users = dict()
         self.usage = [0, 0]
         self.alerting = []
+        self.lock = threading.Lock()
 
         self.session = requests.session()
 
@@ -116,12 +174,18 @@ class CloudTrax:
 
         self.config = config
         self.url = self.config.get_url()
-        self.network = self.config.get_network()
+        self.network = account or self.config.get_network()
+        self.callback = callback
+        self.budget = budget
+        self.checkin = checkin or CheckinPolicy(self.config.get_checkin())
+
+        if not login:
+            return
 
         self.login()
 
-        self.collect_nodes()
-        self.collect_users()
+        if collect:
+            self.collect()
 
 
     def login(self):
@@ -134,15 +198,13 @@ class CloudTrax:
                       'status': 'View Status'}
 
         try:
-            request = self.session.post(self.url['login'], data=parameters)
+            request = self.request('post', self.url['login'], data=parameters)
             request.raise_for_status()
 
         except requests.exceptions.HTTPError:
-            logging.error('There was a HTTP error')
-            exit(1)
+            raise CloudTraxError('There was a HTTP error')
         except requests.exceptions.ConnectionError:
-            logging.error('There was a connection error')
-            exit(1)
+            raise CloudTraxError('There was a connection error')
 
         # If the login referes to a master network with recursion,
         # we need to iterate through them to get our stats
@@ -160,6 +222,10 @@ class CloudTrax:
 
         return self.session
 
+    def get_account(self):
+        """Return the label of the network account"""
+        return self.network.get('label', 'network')
+
     def get_alerting(self):
         """Return a list of alerting nodes"""
         return self.alerting
@@ -172,36 +238,9 @@ class CloudTrax:
 
         logging.info('Requesting node checkin status for %s', node_mac)
 
-        request = self.session.get(self.url['checkin'], params=parameters)
-
-        colour_counter = {'cccccc': 0, '1faa5f': 0, '4fdd8f': 0}
+        request = self.request('get', self.url['checkin'], params=parameters)
 
-        checkin_img = Image.open(cStringIO.StringIO(request.content))
-
-        row = 1
-
-        pixelmap = checkin_img.load()
-
-        for col in range(0, checkin_img.size[0]):
-            pixel_colour = str("%x%x%x" % (pixelmap[col, row][0],
-                                           pixelmap[col, row][1],
-                                           pixelmap[col, row][2]))
-
-            if pixel_colour in colour_counter.keys():
-                colour_counter[pixel_colour] += 1
-            else:
-                colour_counter[pixel_colour] = 1
-
-        # Convert number of pixels into a percent
-        time_as_gw = percentage(colour_counter['1faa5f'],
-                                checkin_img.size[0] - 2)
-        time_as_relay = percentage(colour_counter['4fdd8f'],
-                                   checkin_img.size[0] - 2)
-        time_offline = percentage(colour_counter['cccccc'],
-                                  checkin_img.size[0] - 2)
-        time_online = time_as_gw + time_as_relay
-
-        return (time_as_gw, time_as_relay, time_offline, time_online)
+        return checkin_from_image(request.content)
 
     def get_session(self):
         """Return session id"""
@@ -223,177 +262,343 @@ class CloudTrax:
         """Return network usage"""
         return self.usage
 
-    def collect_nodes(self):
+    def collect(self, networks=None):
+        """Scrape nodes and users one network at a time"""
+
+        if networks is None:
+            networks = self.network['networks']
+
+        for network in networks:
+            self.collect_network(network)
+
+        self.checkin.save()
+
+        return (self.nodes, self.users)
+
+    def collect_network(self, network):
+        """Scrape the nodes and users of one network
+
+        Networks of the same account may be collected at the same time from
+        several threads, they share the session and the merged results."""
+
+        nodes = self.collect_nodes(network)
+        users = self.collect_users(network, nodes)
+
+        if self.callback is not None:
+            self.callback(nodes, users)
+
+        return (nodes, users)
+
+    def refresh(self, networks=None):
+        """Scrape again using the existing session"""
+        self.nodes = dict()
+        self.users = dict()
+        self.usage = [0, 0]
+        self.alerting = []
+
+        return self.collect(networks)
+
+    def request(self, method, url, **kwargs):
+        """Make a request in the dashboard session"""
+        if self.budget is not None:
+            self.budget.acquire()
+
+        return getattr(self.session, method)(url, **kwargs)
+
+    def add_network(self, nodes, users):
+        """Add the nodes and users of a network that was scraped earlier"""
+
+        with self.lock:
+            self.nodes.update(nodes)
+            self.alerting.extend(node for node in nodes.itervalues()
+                                 if node.is_alerting())
+
+            for user_mac in users:
+                usage_dl, usage_ul = users[user_mac].get_usage()
+
+                if user_mac in self.users:
+                    self.users[user_mac].add_usage(usage_dl, usage_ul)
+                else:
+                    self.users[user_mac] = copy.deepcopy(users[user_mac])
+
+                self.usage[0] += usage_dl
+                self.usage[1] += usage_ul
+
+        if self.callback is not None:
+            self.callback(nodes, users)
+
+    def collect_nodes(self, network):
         """Return network information scraped from CloudTrax"""
+        return self.parse_nodes(network, self.get_node_rows(network))
+
+    def get_node_rows(self, network):
+        """Return the raw rows of the network status page
+
+        A network always has nodes, so an empty table means the session has
+        expired. After logging in again, an empty table is an error rather
+        than a scrape of no nodes."""
+
+        parameters = {'id': network,
+                      'showall': '1',
+                      'details': '1'}
+
+        logging.info('Requesting network status') 
 
-        for network in self.network['networks']:
-            parameters = {'id': network,
-                          'showall': '1',
-                          'details': '1'}
-    
-            logging.info('Requesting network status') 
+        rows = distill_html(self.get_page(self.url['data'], parameters),
+                            'table', {'id': 'mytable'})
 
-            request = self.session.get(self.url['data'], params=parameters)
+        if not rows:
+            logging.warning('No nodes in network "%s", logging in again',
+                            network)
+            self.login()
 
-            logging.info('Received network status ok') 
+            rows = distill_html(self.get_page(self.url['data'], parameters),
+                                'table', {'id': 'mytable'})
 
-            if request.status_code == 200:
-                for raw_values in distill_html(request.content, 'table',
-                                               {'id': 'mytable'}):
+        if not rows:
+            raise CloudTraxError('There are no nodes in network "%s"' %
+                                 network)
 
-                    node = Node(raw_values,
-                                self.get_checkin_data(raw_values[2][0]),
-                                network)
+        logging.info('Received network status ok') 
 
-                    if node.is_alerting():
-                        logging.info('%s is alerting' % (node))
-                        self.alerting.append(node)
+        return rows
 
-                    self.nodes[node.get_mac()] = node
+    def get_page(self, url, parameters):
+        """Return the content of a dashboard page
 
+        If the session has expired and the login page is returned instead,
+        this logs in again and requests the page once more."""
+
+        for attempt in range(2):
+            if attempt:
+                logging.warning('Session has expired, logging in again')
+                self.login()
+
+            request = self.request('get', url, params=parameters)
+
+            if request.status_code != 200:
+                raise CloudTraxError('Request failed with status %d' %
+                                     request.status_code)
+
+            if 'login-pw' not in request.content:
+                return request.content
+
+        raise CloudTraxError('Unable to log in to CloudTrax Dashboard')
+
+    def parse_nodes(self, network, rows, checkin=None):
+        """Return the nodes of a network built from its raw rows
+
+        Checkin data comes from checkin(raw_values) if given, otherwise
+        from the checkin policy, fetching images as required."""
+
+        nodes = dict()
+
+        for raw_values in rows:
+            if checkin is None:
+                node_mac, status, last_checkin, uptime = \
+                    checkin_fields(raw_values)
+
+                checkin_data = self.checkin.get(
+                    node_mac.lower(), status, last_checkin, uptime,
+                    lambda: self.get_checkin_data(node_mac))
             else:
-                logging.error('Request failed') 
-                exit(request.status_code)
+                checkin_data = checkin(raw_values)
 
-        return self.nodes
+            node = Node(raw_values, checkin_data, network)
 
-    def collect_users(self):
+            if node.is_alerting():
+                logging.info('%s is alerting' % (node))
+
+            nodes[node.get_mac()] = node
+
+        with self.lock:
+            self.nodes.update(nodes)
+            self.alerting.extend(node for node in nodes.itervalues()
+                                 if node.is_alerting())
+
+        return nodes
+
+    def collect_users(self, network, nodes=None):
         """Return a list of wifi user statistics scraped from CloudTrax"""
+        return self.parse_users(self.get_user_rows(network), nodes)
+
+    def get_user_rows(self, network):
+        """Return the raw rows of the user statistics page"""
 
-        for network in self.network['networks']:
-            parameters = {'id': network}
-    
-            logging.info('Requesting user statistics') 
+        parameters = {'id': network}
 
-            request = self.session.get(self.url['user'], params=parameters)
+        logging.info('Requesting user statistics') 
 
-            logging.info('Received user statistics ok') 
+        content = self.get_page(self.url['user'], parameters)
 
+        logging.info('Received user statistics ok') 
 
-            if request.status_code == 200:
-                for raw_values in distill_html(request.content, 'table',
-                                               {'class': 'inline sortable'}):
+        return distill_html(content, 'table', {'class': 'inline sortable'})
 
-                    user = User(raw_values)
-                    usage_dl = user.get_dl()
-                    usage_ul = user.get_ul()
-                    user_mac = user.get_mac()
-                    node_mac = user.get_node_mac()
+    def parse_users(self, rows, nodes=None):
+        """Return the users of a network built from its raw rows
 
-                    if user_mac in self.users.keys():
-                        self.users[user_mac].add_usage(usage_dl, usage_ul)
-                    else:
-                        self.users[user_mac] = user
+        Users seen in more than one network are merged in self.users, but
+        the users returned only carry their usage in this network. Usage is
+        added to the given nodes of the network, or to self.nodes. Users on
+        a node that is not in the network are added to that node in
+        self.nodes, if it is known."""
 
-                    gateway = self.nodes[node_mac].add_usage(usage_dl, 
-                                                             usage_ul)
+        if nodes is None:
+            nodes = self.nodes
 
-                    if gateway != 'self' and gateway != 'not reported':
-                        self.nodes[node_mac].add_gw_usage(usage_dl, usage_ul)
+        users = dict()
 
-                    self.usage[0] += usage_dl
-                    self.usage[1] += usage_ul
+        for raw_values in rows:
+            user = User(raw_values)
+            usage_dl = user.get_dl()
+            usage_ul = user.get_ul()
+            user_mac = user.get_mac()
+            node_mac = user.get_node_mac()
 
+            if user_mac in users:
+                users[user_mac].add_usage(usage_dl, usage_ul)
             else:
-                logging.error('Request failed') 
-                exit(request.status_code)
+                users[user_mac] = user
 
-        return self.users
+            node = nodes.get(node_mac)
+
+            # A user may be listed against a node of another network, or
+            # one that dropped off the node list since it was fetched
+            if node is None:
+                with self.lock:
+                    node = self.nodes.get(node_mac)
+
+            if node is None:
+                logging.warning('User %s is on unknown node %s, its usage ' +
+                                'is not added to any node', user_mac,
+                                node_mac)
+            else:
+                gateway = node.add_usage(usage_dl, usage_ul)
+
+                if gateway != 'self' and gateway != 'not reported':
+                    node.add_gw_usage(usage_dl, usage_ul)
+
+            with self.lock:
+                if user_mac in self.users:
+                    self.users[user_mac].add_usage(usage_dl, usage_ul)
+                else:
+                    self.users[user_mac] = User(raw_values)
+
+                self.usage[0] += usage_dl
+                self.usage[1] += usage_ul
+
+        return users
 
     def graph(self, graph_type, title, arg, img_format='svg'):
         """Return a rendered graph"""
-        
+        return render_chart(self.graph_data(graph_type, title, arg),
+                            img_format)
+
+    def graph_data(self, graph_type, title, arg):
+        """Return the description of a graph, ready to be rendered"""
+
         if graph_type == 'node':
             graph = self.graph_node_usage(arg)
         elif graph_type == 'user':
             graph = self.graph_user_usage()
         else:
-            logging.error('Unknown graph type')
-            exit(1)
+            raise CloudTraxError('Unknown graph type')
 
-        graph.title = title
+        graph['title'] = title
 
-        if img_format == 'png':
-            return graph.render_to_png()
-
-        return graph.render()
+        return graph
 
     def graph_node_usage(self, gw_only=False):
         """Return a node graph"""
 
-        graph_object = pygal.Pie()
+        series = []
 
-        for node in self.nodes:
+        for node in sorted(self.nodes):
             if gw_only:
                 if self.nodes[node].is_gateway():
-                    graph_object.add(self.nodes[node].get_name(), self.nodes[node].get_gw_usage())
+                    series.append((self.nodes[node].get_name(),
+                                   self.nodes[node].get_gw_usage()))
             else:
-                graph_object.add(self.nodes[node].get_name(), self.nodes[node].get_usage())
+                series.append((self.nodes[node].get_name(),
+                               self.nodes[node].get_usage()))
 
-        return graph_object
+        return {'type': 'pie', 'series': series}
 
     def graph_user_usage(self, gw_only=False):
-        """Return a user graph"""
-
-        graph_object = pygal.XY(stroke=False)
+        """Return a user graph
 
-        for user in self.users:
-            graph_object.add(user, [(self.users[user].get_dl(),
-                                    self.users[user].get_ul())])
+        Only the heaviest users get their own series. Everyone else is
+        plotted as a single point at their average usage, so the size of
+        the graph does not grow with the number of users."""
 
-        return graph_object
+        top = int(self.config.get_email().get('graph_users',
+                                              GRAPH_USERS))
 
-    def report_summary(self):
-        """Return a string containing a pretty summary report"""
-        report = 'Summary statistics for the last 24 hours\n'
-        report += '----------------------------------------\n\n'
-        if len(self.alerting) > 0:
-            report += "*** Warning - %s nodes are alerting ***\n\n" % (len(self.alerting))
+        top_users = heapq.nlargest(top, self.users,
+                                   key=lambda user: sum(self.users[user]
+                                                        .get_usage()))
+        series = []
 
-        report += "Total users: %d\n" % len(self.users)
+        for user in top_users:
+            series.append((user, [self.users[user].get_usage()]))
 
-        report += "Total downloads (MB): %.2f\n" % (float(self.usage[0]) / 1000)
-        report += "Total uploads (MB): %.2f\n" % (float(self.usage[1]) / 1000)
-        report += '\n\n'
+        others = len(self.users) - len(top_users)
 
-        return report
+        if others > 0:
+            top_users = set(top_users)
+            dl = 0
+            ul = 0
 
-    def report_nodes(self):
-        """Return a string containing a pretty nodes report"""
-        report = 'Node statistics for the last 24 hours\n'
-        report += '-------------------------------------\n\n'
+            for user in self.users:
+                if user not in top_users:
+                    dl += self.users[user].get_dl()
+                    ul += self.users[user].get_ul()
 
-        report += 'Gateway nodes\n'
-        report += draw_table('gateway', self.nodes)
-        report += '\n\n'
-        report += 'Relay nodes\n'
-        report += draw_table('relay', self.nodes)
-        report += '\n\n'
-        report += 'Spare nodes\n'
-        report += draw_table('spare', self.nodes)
-        report += '\n\n'
+            series.append(('Others (average of %d)' % others,
+                           [(dl / others, ul / others)]))
 
-        return report
+        return {'type': 'xy', 'options': {'stroke': False}, 'series': series}
 
-    def report_users(self):
-        """Return a string containing a pretty user report"""
-        report = 'User statistics for the last 24 hours\n'
-        report += '-------------------------------------\n\n'
-        report += 'Users\n'
+    def report_summary(self, report):
+        """Write a pretty summary report"""
+        report.heading('Summary statistics for the last 24 hours')
 
-        table = texttable.Texttable()
-        table.header(['Name\n(mac)',
-                      'Last seen on',
-                      'Blocked',
-                      'DL MB',
-                      'UL MB'])
-
-        self.get_users()
-
-        for user in self.users:
-            table.add_row(self.users[user].get_table_row())
-
-        report += table.draw()
-        report += '\n\n'
-
-        return report
+        if len(self.alerting) > 0:
+            report.write("*** Warning - %s nodes are alerting ***\n\n" % (len(self.alerting)))
+
+        report.write("Total users: %d\n" % len(self.users))
+
+        report.write("Total downloads (MB): %.2f\n" % (float(self.usage[0]) / 1000))
+        report.write("Total uploads (MB): %.2f\n" % (float(self.usage[1]) / 1000))
+        report.write("Checkin images fetched: %d (%d estimated)\n" %
+                     self.checkin.get_stats())
+        report.write('\n\n')
+
+    def report_nodes(self, report):
+        """Write a pretty nodes report"""
+        report.heading('Node statistics for the last 24 hours')
+
+        for node_type, title in (('gateway', 'Gateway nodes'),
+                                 ('relay', 'Relay nodes'),
+                                 ('spare', 'Spare nodes')):
+            report.write(title + '\n')
+            report.table(TABLE_HEADERS[node_type],
+                         [self.nodes[node] for node in self.nodes
+                          if self.nodes[node].get_type() == node_type])
+            report.write('\n\n')
+
+    def report_users(self, report):
+        """Write a pretty user report, busiest users first if limited"""
+        report.heading('User statistics for the last 24 hours')
+        report.write('Users\n')
+
+        report.table(TABLE_HEADERS['user'], self.users.itervalues(),
+                     key=lambda user: sum(user.get_usage()))
+        report.write('\n\n')
+
+    def write_report(self, report):
+        """Write the summary, nodes and users reports"""
+        self.report_summary(report)
+        self.report_nodes(report)
+        self.report_users(report)
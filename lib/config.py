@@ -34,7 +34,7 @@ class Config:
 
         self.database = {'type': self.config.get('database', 'type')}
 
-        if self.database['type'] != "none":
+        if self.database['type'] == 'pgsql':
             self.database.update({'host': self.config.get('database', 'host'),
                                   'database': self.config.get('database',
                                                          'database'),
@@ -43,19 +43,100 @@ class Config:
                                   'password': self.config.get('database',
                                                          'password')})
 
+        elif self.database['type'] == 'archive':
+            self.database['path'] = self.config.get('database', 'path')
+
+        if self.database['type'] != "none":
+            self.database.update({'retention': '1 year',
+                                  'spool': '/opt/cloudscraper/spool',
+                                  'commit': 'run'})
+
+            for option in ('retention', 'spool', 'commit', 'report_cache'):
+                if self.config.has_option('database', option):
+                    self.database[option] = self.config.get('database',
+                                                            option)
+
         self.email = dict(self.config.items('email'))
 
-        self.network = {'name': self.config.get('network', 'username'),
-                        'username': self.config.get('network', 'username'),
-                        'password': self.config.get('network', 'password'),
-                        'recurse': self.config.getboolean('network', 'recurse'),
-                        'networks': [self.config.get('network', 'name')]}
+        self.checkin = dict()
+
+        if self.config.has_section('checkin'):
+            self.checkin.update(self.config.items('checkin'))
+
+        self.changes = dict()
+
+        if self.config.has_section('changes'):
+            self.changes.update(self.config.items('changes'))
+
+        self.snapshot = dict()
+
+        if self.config.has_section('snapshot'):
+            self.snapshot.update(self.config.items('snapshot'))
+
+        self.api = dict()
+
+        if self.config.has_section('api'):
+            self.api.update(self.config.items('api'))
+
+        self.daemon = dict()
+
+        if self.config.has_section('daemon'):
+            self.daemon.update(self.config.items('daemon'))
+
+        self.queue = dict()
 
+        if self.config.has_section('queue'):
+            self.queue.update(self.config.items('queue'))
+
+        self.runner = dict()
+
+        if self.config.has_section('runner'):
+            self.runner.update(self.config.items('runner'))
+
+        # Each account is a [network] or [network:label] section
+        self.networks = [self.read_network(section)
+                         for section in self.config.sections()
+                         if section == 'network' or
+                            section.startswith('network:')]
+
+        if not self.networks:
+            raise ConfigParser.NoSectionError('network')
+
+        self.network = self.networks[0]
+
+    def read_network(self, section):
+        """Return the config of one network account section"""
+        return {'label': section.split(':', 1)[-1],
+                'name': self.config.get(section, 'username'),
+                'username': self.config.get(section, 'username'),
+                'password': self.config.get(section, 'password'),
+                'recurse': self.config.getboolean(section, 'recurse'),
+                'networks': [self.config.get(section, 'name')]}
+
+    def get_api(self):
+        """Return HTTP API config, empty unless the API is served"""
+        return self.api
+
+    def get_snapshot(self):
+        """Return snapshot config, empty unless snapshots are saved"""
+        return self.snapshot
 
     def get_url(self):
         """Return url config"""
         return self.url
 
+    def get_changes(self):
+        """Return change tracking config, empty unless changes are tracked"""
+        return self.changes
+
+    def get_checkin(self):
+        """Return checkin policy config"""
+        return self.checkin
+
+    def get_daemon(self):
+        """Return daemon config"""
+        return self.daemon
+
     def get_db(self):
         """Return database config"""
         return self.database
@@ -65,9 +146,21 @@ class Config:
         return self.email
 
     def get_network(self):
-        """Return network config"""
+        """Return the config of the first network account"""
         return self.network
 
+    def get_networks(self):
+        """Return the config of every network account"""
+        return self.networks
+
+    def get_queue(self):
+        """Return work queue config, empty unless a queue is used"""
+        return self.queue
+
+    def get_runner(self):
+        """Return multi-account runner config"""
+        return self.runner
+
     def get_node_settings(self, node_name):
         """Return network quota config"""
         if not self.config.has_section(node_name):
@@ -76,7 +169,9 @@ class Config:
         return dict(self.config.items(node_name))
 
     def set_network(self, network):
-        """Set a single network"""
+        """Set a single network of the first account"""
         self.network['name'] = network
+        self.network['networks'] = [network]
         self.network['recurse'] = False
+        self.networks = [self.network]
 
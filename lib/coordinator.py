@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+""" lib/coordinator.py
+
+ Work queue coordinator and worker classes for CloudScraper
+
+ Copyright (c) 2013 The Goulburn Group. All Rights Reserved.
+
+ http://www.goulburngroup.com.au
+
+ Written by Alex Ferrara <alex@receptiveit.com.au>
+
+"""
+
+from lib.checkin import CheckinPolicy
+from lib.cloudtrax import CloudTrax, CloudTraxError, checkin_fields
+from lib.runner import ACCOUNT_ERRORS
+import datetime
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+
+def queue_settings(config):
+    """Return the work queue settings with their defaults"""
+    settings = config.get_queue()
+
+    return {'lease': float(settings.get('lease', 300)),
+            'attempts': int(settings.get('attempts', 3)),
+            'checkin_batch': int(settings.get('checkin_batch', 20)),
+            'poll': float(settings.get('poll', 2)),
+            'timeout': float(settings.get('timeout', 3600))}
+
+
+class Coordinator:
+    """Splits a scrape into work items for queue workers
+
+    A run starts with an item per account. When an account has logged in,
+    an item is queued for each of its networks, and when the pages of a
+    network have been fetched, the checkin images that the checkin policy
+    cannot estimate are fetched in batches. Nothing is built from the
+    results until every item has finished, so the callback and the reports
+    see one consistent snapshot."""
+
+    def __init__(self, config, queue, callback=None):
+        """Constructor"""
+        self.config = config
+        self.queue = queue
+        self.callback = callback
+        self.settings = queue_settings(config)
+
+        self.checkin = CheckinPolicy(config.get_checkin())
+        self.accounts = dict((account['label'], account)
+                             for account in config.get_networks())
+        self.results = dict()
+        self.networks = []
+        self.failures = []
+
+    def get_failures(self):
+        """Return a list of (account, network, error) tuples"""
+        return self.failures
+
+    def fail(self, label, network, error):
+        """Record the failure of an account, or one of its networks"""
+        if network is None:
+            logging.error('Account "%s" failed: %s', label, error)
+        else:
+            logging.error('Account "%s" network "%s" failed: %s', label,
+                          network, error)
+
+        self.failures.append((label, network, error))
+
+    def put(self, kind, payload):
+        """Queue an item of this run"""
+        self.queue.put(self.run_id, kind, payload, self.settings['attempts'])
+
+    def account_done(self, payload, result):
+        """Queue the networks of an account that has logged in"""
+
+        account = self.accounts[payload['account']]
+        networks = list(account['networks'])
+
+        if account['recurse']:
+            networks.extend(network for network in result
+                            if network not in networks)
+
+        self.results[account['label']] = CloudTrax(self.config,
+                                                   account=account,
+                                                   checkin=self.checkin,
+                                                   login=False)
+
+        for network in networks:
+            self.put('network', {'account': account['label'],
+                                 'network': network})
+
+    def network_done(self, payload, result):
+        """Queue the checkin images needed for a network"""
+
+        entry = dict(payload, nodes=result['nodes'], users=result['users'],
+                     checkin={}, waiting=0, failed=None, now=time.time())
+        fetch = []
+
+        for raw_values in entry['nodes']:
+            node_mac, status, last_checkin, uptime = checkin_fields(raw_values)
+
+            reason = self.checkin.must_fetch(node_mac.lower(), status,
+                                             last_checkin, uptime,
+                                             entry['now'])
+
+            if reason is not None:
+                fetch.append(node_mac)
+
+        batch = self.settings['checkin_batch']
+
+        for start in range(0, len(fetch), batch):
+            entry['waiting'] += 1
+            self.put('checkin', dict(payload, index=len(self.networks),
+                                     macs=fetch[start:start + batch]))
+
+        self.networks.append(entry)
+
+    def checkin_done(self, payload, result, error):
+        """Add a batch of checkin data to its network"""
+
+        entry = self.networks[payload['index']]
+        entry['waiting'] -= 1
+
+        if error is not None:
+            entry['failed'] = error
+        else:
+            entry['checkin'].update(result)
+
+    def node_checkin(self, entry):
+        """Return a function giving the checkin data of a raw node row"""
+
+        def checkin(raw_values):
+            node_mac, status, last_checkin, uptime = checkin_fields(raw_values)
+
+            if node_mac in entry['checkin']:
+                checkin_data = entry['checkin'][node_mac]
+                self.checkin.record(node_mac.lower(), status, uptime,
+                                    checkin_data, entry['now'])
+                return checkin_data
+
+            return self.checkin.reuse(node_mac.lower(), status, entry['now'])
+
+        return checkin
+
+    def assemble(self):
+        """Build the nodes and users of every network that was scraped"""
+
+        for entry in self.networks:
+            label = entry['account']
+
+            if entry['failed'] is not None:
+                self.fail(label, entry['network'], entry['failed'])
+                continue
+
+            if entry['waiting'] > 0:
+                self.fail(label, entry['network'], 'Timed out')
+                continue
+
+            cloudtrax = self.results[label]
+            nodes = cloudtrax.parse_nodes(entry['network'], entry['nodes'],
+                                          self.node_checkin(entry))
+            users = cloudtrax.parse_users(entry['users'], nodes)
+
+            if self.callback is not None:
+                self.callback(nodes, users)
+
+    def run(self):
+        """Queue a scrape of every account and wait for the workers"""
+
+        self.run_id = '%s:%d:%s' % (socket.gethostname(), os.getpid(),
+                                    datetime.datetime.now().isoformat())
+
+        logging.info('Coordinating run %s', self.run_id)
+
+        for label in self.accounts:
+            self.put('account', {'account': label})
+
+        deadline = time.time() + self.settings['timeout']
+        sequence = 0
+
+        while True:
+            items = self.queue.finished(self.run_id, sequence)
+
+            for sequence, item_id, kind, payload, result, error in items:
+                label = payload['account']
+
+                if kind == 'checkin':
+                    self.checkin_done(payload, result, error)
+                elif error is not None:
+                    self.fail(label, payload.get('network'), error)
+                elif kind == 'account':
+                    self.account_done(payload, result)
+                else:
+                    self.network_done(payload, result)
+
+            if not items and self.queue.outstanding(self.run_id) == 0:
+                break
+
+            if time.time() > deadline:
+                logging.error('Run %s timed out with %d items outstanding',
+                              self.run_id,
+                              self.queue.outstanding(self.run_id))
+                break
+
+            if not items:
+                time.sleep(self.settings['poll'])
+
+        self.assemble()
+        self.checkin.save()
+        self.queue.purge(self.run_id)
+
+        return [self.results[label] for label in sorted(self.results)]
+
+
+class QueueWorker:
+    """Claims work items from the queue until stopped
+
+    Each worker logs in to an account the first time it is given an item
+    of that account, and keeps the session for later items. Workers read
+    the account credentials from their own config file."""
+
+    def __init__(self, config, queue):
+        """Constructor"""
+        self.config = config
+        self.queue = queue
+        self.settings = queue_settings(config)
+        self.name = '%s:%d' % (socket.gethostname(), os.getpid())
+
+        self.sessions = dict()
+        self.stopping = threading.Event()
+        self.handlers = {'account': self.login_account,
+                         'network': self.scrape_network,
+                         'checkin': self.fetch_checkin}
+
+    def session(self, label):
+        """Return the logged in CloudTrax object of an account"""
+
+        if label not in self.sessions:
+            for account in self.config.get_networks():
+                if account['label'] == label:
+                    break
+            else:
+                raise CloudTraxError('Unknown account "%s"' % label)
+
+            self.sessions[label] = CloudTrax(self.config, account=account,
+                                             collect=False)
+
+        return self.sessions[label]
+
+    def login_account(self, payload):
+        """Log in, returning the networks found for the account"""
+        return self.session(payload['account']).network['networks']
+
+    def scrape_network(self, payload):
+        """Return the raw node and user rows of a network"""
+        cloudtrax = self.session(payload['account'])
+
+        return {'nodes': cloudtrax.get_node_rows(payload['network']),
+                'users': cloudtrax.get_user_rows(payload['network'])}
+
+    def fetch_checkin(self, payload):
+        """Return the checkin data of a batch of nodes"""
+        cloudtrax = self.session(payload['account'])
+
+        return dict((node_mac, cloudtrax.get_checkin_data(node_mac))
+                    for node_mac in payload['macs'])
+
+    def run(self):
+        """Work on items until stopped by SIGTERM or SIGINT"""
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        logging.info('Worker %s started', self.name)
+
+        while not self.stopping.is_set():
+            item = self.queue.claim(self.name, self.settings['lease'])
+
+            if item is None:
+                self.stopping.wait(self.settings['poll'])
+                continue
+
+            item_id, run, kind, payload = item
+
+            logging.info('Working on %s item %d of run %s', kind, item_id,
+                         run)
+
+            try:
+                result = self.handlers[kind](payload)
+            except ACCOUNT_ERRORS, error:
+                logging.error('%s item %d failed: %s', kind, item_id, error)
+
+                # Log in again next time, in case the session has expired
+                self.sessions.pop(payload['account'], None)
+                self.queue.fail(item_id, self.name, str(error))
+                continue
+
+            self.queue.complete(item_id, self.name, result)
+
+        logging.info('Worker %s stopped', self.name)
+
+    def stop(self, signum=None, frame=None):
+        """Stop after the current item"""
+        logging.info('Stopping worker')
+        self.stopping.set()
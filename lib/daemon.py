@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+""" lib/daemon.py
+
+ Daemon class for CloudScraper
+
+ Copyright (c) 2013 The Goulburn Group. All Rights Reserved.
+
+ http://www.goulburngroup.com.au
+
+ Written by Alex Ferrara <alex@receptiveit.com.au>
+
+"""
+
+from lib.api import ApiServer
+from lib.changes import ChangeTracker
+from lib.checkin import CheckinPolicy
+from lib.cloudtrax import CloudTrax, CloudTraxError
+from lib.quota import QuotaMonitor
+import datetime
+import heapq
+import logging
+import random
+import signal
+import threading
+import time
+
+
+class RequestBudget:
+    """Token bucket limiting the rate of requests to the dashboard
+
+    Shared by everything that talks to cloudtrax.com, so the total load
+    stays bounded however many networks are being polled."""
+
+    def __init__(self, per_hour, burst=None):
+        """Constructor"""
+        self.rate = float(per_hour) / 3600
+        self.capacity = float(burst or max(1, per_hour / 60))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request may be made"""
+
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class Daemon:
+    """Long running scraper
+
+    Keeps a dashboard session for every account, and the database
+    connection and caches, from one poll to the next, and polls each
+    network on its own schedule. Networks with alerting nodes or many users
+    are polled more often, networks with no users are polled less and less
+    often, and every interval is jittered so polls do not line up. An
+    account that fails is logged in again later without holding up the
+    others."""
+
+    def __init__(self, config, database, monitor=False):
+        """Constructor"""
+        self.config = config
+        self.database = database
+        self.monitor = monitor
+
+        settings = config.get_daemon()
+
+        self.interval = float(settings.get('interval', 900))
+        self.min_interval = float(settings.get('min_interval', 300))
+        self.max_interval = float(settings.get('max_interval', 3600))
+        self.busy_users = int(settings.get('busy_users', 50))
+        self.jitter = float(settings.get('jitter', 0.1))
+        self.budget = RequestBudget(int(settings.get('requests_per_hour',
+                                                     1200)))
+
+        self.tracker = None
+
+        if config.get_changes():
+            self.tracker = ChangeTracker(config.get_changes()['state'])
+
+        self.api = None
+
+        if config.get_api():
+            self.api = ApiServer(config)
+
+        self.stopping = threading.Event()
+        self.checkin = CheckinPolicy(config.get_checkin())
+        self.sessions = {}
+        self.intervals = {}
+
+    def login(self, account):
+        """Log in to an account, keeping the session for later polls"""
+        cloudtrax = CloudTrax(self.config, budget=self.budget, collect=False,
+                              account=account, checkin=self.checkin)
+
+        networks = cloudtrax.network['networks']
+
+        if not networks:
+            raise CloudTraxError('There are no networks to poll')
+
+        self.sessions[account['label']] = cloudtrax
+
+        return networks
+
+    def next_interval(self, key, cloudtrax):
+        """Return the number of seconds until a network is polled again"""
+
+        users = len(cloudtrax.get_users())
+        interval = self.intervals.get(key, self.interval)
+
+        if cloudtrax.get_alerting():
+            interval = self.min_interval
+        elif users >= self.busy_users:
+            interval = self.interval / 2
+        elif users == 0:
+            interval = interval * 2
+        else:
+            interval = self.interval
+
+        interval = max(self.min_interval, min(self.max_interval, interval))
+        self.intervals[key] = interval
+
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def poll(self, cloudtrax, network):
+        """Scrape one network of an account and store the results"""
+
+        logging.info('Polling network "%s" of account "%s"', network,
+                     cloudtrax.network['label'])
+
+        started = datetime.datetime.now()
+        cloudtrax.refresh([network])
+
+        self.database.add_records(cloudtrax.get_nodes(),
+                                  cloudtrax.get_users(), started)
+
+        if self.tracker is not None:
+            self.tracker.reset(started)
+            self.tracker.put(cloudtrax.get_nodes(), cloudtrax.get_users())
+            self.tracker.save()
+
+            if self.tracker.get_events():
+                self.database.add_changes(self.tracker.get_events())
+
+        if self.api is not None:
+            self.api.state.put(cloudtrax.get_nodes(), cloudtrax.get_users(),
+                               started)
+
+        if self.monitor:
+            monitor = QuotaMonitor(self.config, self.database)
+            monitor.notify(monitor.check())
+
+    def run(self):
+        """Poll networks until stopped by SIGTERM or SIGINT"""
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        if self.api is not None:
+            self.api.start()
+
+        accounts = dict((account['label'], account)
+                        for account in self.config.get_networks())
+
+        # Each entry is (due, account, network), and a network of None
+        # logs in to the account and schedules its networks
+        schedule = [(time.time(), label, None) for label in sorted(accounts)]
+        heapq.heapify(schedule)
+
+        while not self.stopping.is_set():
+            due, label, network = schedule[0]
+            self.stopping.wait(max(0, due - time.time()))
+
+            if self.stopping.is_set():
+                break
+
+            try:
+                if network is None:
+                    heapq.heappop(schedule)
+
+                    # Spread the first polls out a little
+                    for network in self.login(accounts[label]):
+                        heapq.heappush(schedule,
+                                       (time.time() +
+                                        random.uniform(0, self.jitter *
+                                                       self.interval),
+                                        label, network))
+                    continue
+
+                cloudtrax = self.sessions[label]
+                self.poll(cloudtrax, network)
+
+                heapq.heapreplace(schedule,
+                                  (time.time() +
+                                   self.next_interval((label, network),
+                                                      cloudtrax),
+                                   label, network))
+
+            # Whatever went wrong, only this account is affected
+            except Exception, error:
+                logging.error('Account "%s" failed, logging in again ' +
+                              'later: %s', label, error)
+                self.sessions.pop(label, None)
+
+                schedule = [entry for entry in schedule if entry[1] != label]
+                schedule.append((time.time() + self.min_interval, label,
+                                 None))
+                heapq.heapify(schedule)
+
+        if self.api is not None:
+            self.api.stop()
+
+        logging.info('Daemon stopped')
+
+    def stop(self, signum=None, frame=None):
+        """Stop polling after the current poll"""
+        logging.info('Stopping daemon')
+        self.stopping.set()
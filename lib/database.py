@@ -11,26 +11,391 @@
 
 """
 
-import logging
+from lib.archive import Archive, interval_start
+from lib.reportcache import ALL_NETWORKS, ReportCache
+from lib.spool import Spool, SpoolError
 from psycopg2.extensions import AsIs
+from psycopg2.extras import execute_values
+import datetime
+import logging
+import Queue
 import psycopg2
+import threading
+import time
+
+# Number of per-network batches that may wait for the writer
+WRITER_QUEUE_SIZE = 2
+
+# Tables of raw records, which are rolled into daily totals by compact()
+RAW_TABLES = ('scrapes', 'nodes', 'users')
+
+# Rows sent to the database in each bulk insert
+BULK_ROWS = 500
+
+# Tables of older versions that keep every attribute on each row
+LEGACY_TABLES = ('nodes', 'users')
+
+# Errors that mean a backend is unavailable, rather than a bug
+BACKEND_ERRORS = (psycopg2.Error, EnvironmentError)
+
+# Errors that may go away when the same records are stored again later
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError,
+                    EnvironmentError)
+
+
+def create_backend(config):
+    """Return a new backend for the configured database type"""
+
+    if config['type'] == 'pgsql':
+        return Postgres(config)
+
+    elif config['type'] == 'archive':
+        return Archive(config)
+
+    raise Exception('Database type is unknown.')
+
+
+def tag_users(nodes, users):
+    """Return the values of a batch of users, tagged with its network
+
+    A user may be listed against a node of another network, so users are
+    stored under the network they were scraped from rather than the
+    network of their node. Batches holding several networks are left as
+    they are."""
+
+    networks = set(values['network'] for values in nodes)
+
+    if len(networks) != 1:
+        return users
+
+    network = networks.pop()
+
+    return [dict(values, network=values.get('network', network))
+            for values in users]
+
+
+def open_cache(config):
+    """Return the report cache, or None if reports are not cached"""
+
+    if config.get('report_cache'):
+        return ReportCache(config['report_cache'])
+
+    return None
+
 
 class Database:
-    """Database connector class"""
+    """Database connector class
+
+    Records are always written to the local spool first. A background
+    flusher then connects to the database and stores every spooled
+    segment, so a slow or unavailable database never holds up a scrape."""
 
     def __init__(self, config):
 
         self.backend = None
+        self.config = config
 
-        if config['type'] == 'pgsql':
-            self.backend = Postgres(config)
-
-        else:
+        if config['type'] not in ('pgsql', 'archive'):
             raise Exception('Database type is unknown.')
 
-    def add_records(self, nodes, users):
-        """Add a node in the database"""
-        return self.backend.add_records(nodes, users)
+        self.spool = Spool(config['spool'])
+        self.cache = open_cache(config)
+
+        # Held while the spool or a writer is being stored, so that a stale
+        # spooled scrape can never be committed over a live one
+        self.lock = threading.Lock()
+
+        # A single flusher thread stores the spool whenever it is asked to,
+        # so adding records never waits for the database
+        self.condition = threading.Condition()
+        self.requested = False
+        self.flushing = False
+        self.closing = False
+
+        self.flusher = threading.Thread(target=self.run_flusher,
+                                        name='spool-flusher')
+        self.flusher.daemon = True
+        self.flusher.start()
+
+        # Store anything left over from a previous run
+        self.writer = None
+        self.start_flush()
+
+    def add_records(self, nodes, users, started=None):
+        """Add a scrape of nodes and users to the database
+
+        Records are grouped into one scrape per network and day, so adding
+        the same day again replaces the earlier records."""
+        if started is None:
+            started = datetime.datetime.now()
+
+        # Storing a scrape without nodes would remove the day's records
+        if not nodes:
+            logging.warning('Not storing a scrape with no nodes')
+            return
+
+        nodes = [nodes[node].get_values() for node in nodes]
+
+        self.spool.write(nodes,
+                         tag_users(nodes, [users[user].get_values()
+                                           for user in users]),
+                         started)
+
+        self.start_flush()
+
+    def add_backfill(self, nodes, users, started):
+        """Store lists of node and user values from a backfill
+
+        Backfilled records go straight to the database rather than through
+        the spool, and are committed before this returns."""
+        if not nodes:
+            logging.warning('Not storing a backfill with no nodes for %s',
+                            started)
+            return
+
+        self.wait()
+
+        with self.lock:
+            self.connect().add_records(nodes, tag_users(nodes, users),
+                                       started)
+
+        if self.cache is not None:
+            self.cache.invalidate(started.date())
+
+    def add_changes(self, events):
+        """Store the change events raised by a change tracker"""
+        self.wait()
+        return self.connect().add_changes(events)
+
+    def close(self):
+        """Wait for spooled and queued records to be flushed"""
+        self.wait()
+
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+
+        self.flusher.join()
+
+    def start_writer(self, started=None):
+        """Start a writer thread and return it
+
+        Batches handed to the writer with put() are stored while the caller
+        carries on scraping."""
+        if started is None:
+            started = datetime.datetime.now()
+
+        if self.writer is not None:
+            self.writer.finish()
+            self.writer.join()
+
+        self.writer = Writer(self.config, self.spool, started, self.lock)
+        self.writer.start()
+
+        return self.writer
+
+    def connect(self):
+        """Return the backend, connecting to the database if required"""
+        if self.backend is None:
+            self.backend = create_backend(self.config)
+
+        return self.backend
+
+    def flush(self):
+        """Store all spooled segments in the database"""
+        with self.lock:
+            self.flush_spool()
+
+    def flush_spool(self):
+        """Store all spooled segments, with the store lock held"""
+
+        try:
+            backend = self.connect()
+
+            for segment in self.spool.segments():
+                try:
+                    nodes, users, started = self.spool.read(segment)
+                except SpoolError, error:
+                    logging.error(error)
+                    self.spool.quarantine(segment)
+                    continue
+
+                logging.info('Flushing spool segment "%s"', segment)
+
+                # Records the database rejects will be rejected every time,
+                # so they are moved aside rather than holding up the spool
+                try:
+                    backend.add_records(nodes, users, started)
+                except TRANSIENT_ERRORS:
+                    raise
+                except psycopg2.Error, error:
+                    logging.error('Database rejected spool segment "%s": %s',
+                                  segment, error)
+                    backend.rollback()
+                    self.spool.quarantine(segment)
+                    continue
+
+                self.spool.remove(segment)
+
+                if self.cache is not None:
+                    self.cache.invalidate(started.date())
+
+        except BACKEND_ERRORS, error:
+            logging.warning('Unable to store spooled records, %d segments ' +
+                            'left in the spool: %s',
+                            len(self.spool.segments()), error)
+
+            # The connection may be broken, so it is dropped and the next
+            # flush connects again
+            if self.backend is not None:
+                try:
+                    self.backend.rollback()
+                except BACKEND_ERRORS, error:
+                    logging.warning('Unable to roll back: %s', error)
+
+                try:
+                    self.backend.close()
+                except BACKEND_ERRORS, error:
+                    logging.warning('Unable to close the database: %s', error)
+
+                self.backend = None
+
+    def run_flusher(self):
+        """Flush the spool each time a flush is requested, until closed"""
+
+        while True:
+            with self.condition:
+                while not self.requested and not self.closing:
+                    self.condition.wait(1)
+
+                if not self.requested:
+                    return
+
+                self.requested = False
+                self.flushing = True
+
+            try:
+                self.flush()
+            except Exception, error:
+                logging.error('Spool flusher failed: %s', error)
+            finally:
+                with self.condition:
+                    self.flushing = False
+                    self.condition.notify_all()
+
+    def start_flush(self):
+        """Ask the flusher thread to flush the spool, without waiting"""
+        with self.condition:
+            self.requested = True
+            self.condition.notify_all()
+
+    def wait(self):
+        """Wait for the writer and any requested flush to finish"""
+        if self.writer is not None:
+            self.writer.finish()
+            self.writer.join()
+            self.writer = None
+
+        with self.condition:
+            while self.requested or self.flushing:
+                self.condition.wait(1)
+
+    def compact(self, retention):
+        """Roll raw records older than retention into daily aggregates
+
+        Returns a tuple of the number of scrapes and raw rows that were
+        compacted, and the size in bytes of the raw records before and
+        after."""
+        self.wait()
+        compacted = self.connect().compact(retention)
+
+        # Unique users of a compacted day may be counted differently
+        if self.cache is not None and compacted[0]:
+            self.cache.clear()
+
+        return compacted
+
+    def get_quota(self, month, rate_days):
+        """Retrieve month to date internet usage by gateway
+
+        Returns (mac, name, kbdown, kbup, daily rate, alerted threshold)
+        tuples, where the daily rate is the average of the last rate_days
+        days."""
+        self.wait()
+        return self.connect().get_quota(month, rate_days)
+
+    def set_quota_alerted(self, month, mac, threshold):
+        """Record the highest quota threshold alerted on this month"""
+        self.wait()
+        return self.connect().set_quota_alerted(month, mac, threshold)
+
+    def get_top_users(self, interval, count):
+        """Retrieve the users with the most traffic over an interval
+
+        Returns (rank, mac, name, kbdown, kbup, days seen) tuples of the
+        top count users. Users tied on traffic share a rank."""
+        self.wait()
+        return self.connect().get_top_users(interval_start(interval).date(),
+                                            datetime.date.today(), count)
+
+    def get_gateway_usage(self, interval):
+        """Retrieve the daily internet usage of each gateway
+
+        Returns (day, mac, name, kbdown, kbup, running total, percent of
+        the day) tuples, by day."""
+        self.wait()
+        return self.connect().get_gateway_usage(
+            interval_start(interval).date(), datetime.date.today())
+
+    def get_node_users(self, interval):
+        """Retrieve the daily user counts of each node
+
+        Returns (mac, name, days, average, peak, peak day, latest) tuples,
+        busiest nodes first."""
+        self.wait()
+        return self.connect().get_node_users(interval_start(interval).date(),
+                                             datetime.date.today())
+
+    def get_days(self, kind, interval, query):
+        """Return the rows of each day in an interval
+
+        Closed days come from the report cache when there is one, and only
+        days that are missing from it and today are queried."""
+
+        first = interval_start(interval).date()
+        today = datetime.date.today()
+
+        if self.cache is None:
+            return query(first, today)
+
+        queried = time.time()
+        rows, missing = self.cache.get(kind, first, today)
+
+        if missing:
+            logging.info('Querying %d uncached days of %s', len(missing),
+                         kind)
+
+            # Query each run of consecutive missing days on its own, so that
+            # a few gaps in a long interval do not pull in the cached days
+            # between them
+            fetched = []
+            run_start = missing[0]
+
+            for index, day in enumerate(missing):
+                if index + 1 == len(missing) or \
+                   missing[index + 1] != day + datetime.timedelta(days=1):
+                    fetched.extend(query(run_start, day))
+
+                    if index + 1 < len(missing):
+                        run_start = missing[index + 1]
+
+            self.cache.put(kind, fetched, missing, queried)
+            rows.extend(fetched)
+
+        if first <= today:
+            rows.extend(query(today, today))
+
+        return rows
 
     def get_past_gw_xfer(self, interval):
         """Retrieve past statistics from the database
@@ -38,7 +403,19 @@ class Database:
         This method retrieves the following by gateway,
         - Total downloads in kb
         - Total uploads in kb"""
-        return self.backend.get_past_gw_xfer(interval)
+        self.wait()
+
+        totals = {}
+
+        for day, network, mac, kbdown, kbup in \
+                self.get_days('gw_xfer', interval,
+                              self.connect().get_day_gw_xfer):
+            total = totals.setdefault(mac, [0, 0])
+            total[0] += kbdown
+            total[1] += kbup
+
+        return [(mac, totals[mac][0], totals[mac][1])
+                for mac in sorted(totals)]
 
     def get_past_stats(self, interval):
         """Retrieve past statistics from the database
@@ -47,7 +424,121 @@ class Database:
         - Unique users
         - Total downloads in kb
         - Total uploads in kb"""
-        return self.backend.get_past_stats(interval)
+        self.wait()
+
+        return [(day, users, kbdown, kbup) for day, network, users, kbdown,
+                kbup in sorted(self.get_days('stats', interval,
+                                             self.connect().get_day_stats))
+                if network == ALL_NETWORKS]
+
+
+class Writer(threading.Thread):
+    """Database writer thread
+
+    Takes per-network batches off a bounded queue and stores them using its
+    own database connection. The queue blocks the producer when it is full,
+    so a slow database holds back the scrape instead of letting batches pile
+    up in memory. Batches are committed one network at a time, or all at
+    once when the writer finishes, depending on the 'commit' setting. Any
+    batches that could not be committed are written to the spool.
+
+    The writer takes the store lock before it takes the first batch, so it
+    waits for a spool flush that is already running, and no flush can
+    start until it is done."""
+
+    def __init__(self, config, spool, started, lock):
+        """Constructor"""
+        threading.Thread.__init__(self, name='database-writer')
+
+        self.config = config
+        self.spool = spool
+        self.started = started
+        self.lock = lock
+        self.queue = Queue.Queue(WRITER_QUEUE_SIZE)
+        self.finished = False
+
+    def put(self, nodes, users):
+        """Queue the nodes and users of one network"""
+        if not nodes:
+            logging.warning('Not storing a network with no nodes')
+            return
+
+        nodes = [nodes[node].get_values() for node in nodes]
+
+        self.queue.put((nodes, tag_users(nodes, [users[user].get_values()
+                                                 for user in users])))
+
+    def finish(self):
+        """Tell the writer there are no more batches"""
+        if not self.finished:
+            self.finished = True
+            self.queue.put(None)
+
+    def run(self):
+        """Store batches until finish() is called"""
+        with self.lock:
+            self.store()
+
+    def store(self):
+        """Store batches, with the store lock held"""
+
+        backend = None
+        failed = False
+        pending = ([], [])
+
+        while True:
+            batch = self.queue.get()
+
+            if batch is None:
+                break
+
+            pending[0].extend(batch[0])
+            pending[1].extend(batch[1])
+
+            if failed:
+                continue
+
+            try:
+                if backend is None:
+                    backend = create_backend(self.config)
+
+                backend.add_records(batch[0], batch[1], self.started,
+                                    commit=False)
+
+                if self.config['commit'] == 'network':
+                    backend.commit()
+                    pending = ([], [])
+
+            except BACKEND_ERRORS, error:
+                logging.warning('Unable to store records: %s', error)
+                failed = True
+
+                if backend is not None:
+                    try:
+                        backend.rollback()
+                    except BACKEND_ERRORS, error:
+                        logging.warning('Unable to roll back: %s', error)
+
+        if not failed and backend is not None:
+            try:
+                backend.commit()
+                pending = ([], [])
+            except BACKEND_ERRORS, error:
+                logging.warning('Unable to commit records: %s', error)
+
+        cache = open_cache(self.config)
+
+        if cache is not None and backend is not None:
+            cache.invalidate(self.started.date())
+
+        if pending[0] or pending[1]:
+            self.spool.write(pending[0], pending[1], self.started)
+
+        if backend is not None:
+            try:
+                backend.close()
+            except BACKEND_ERRORS, error:
+                logging.warning('Unable to close the database: %s', error)
 
 
 class Postgres:
@@ -56,142 +547,974 @@ class Postgres:
     def __init__(self, config):
         """Constructor"""
 
-        self.schema = {'users': 'id        SERIAL primary key NOT NULL, \
-                                 timestamp timestamp NOT NULL default now(), \
+        # Slowly changing attributes live in the dimension tables, keyed by
+        # mac address. The fact tables only reference them by id. The order
+        # of this list matters, as tables are created in sequence.
+        self.schema = [('node_dim', 'id        SERIAL primary key NOT NULL, \
+                                    mac       macaddr NOT NULL UNIQUE, \
+                                    name      varchar(40), \
+                                    network   varchar(40), \
+                                    gateway   varchar(40), \
+                                    firmware  varchar(20)'),
+                       ('user_dim', 'id        SERIAL primary key NOT NULL, \
+                                    mac       macaddr NOT NULL UNIQUE, \
+                                    name      varchar(40)'),
+                       ('scrapes', 'id        SERIAL primary key NOT NULL, \
+                                   network   varchar(40) NOT NULL, \
+                                   day       date NOT NULL, \
+                                   started   timestamp NOT NULL, \
+                                   finished  timestamp, \
+                                   nodes     integer NOT NULL default 0, \
+                                   users     integer NOT NULL default 0, \
+                                   UNIQUE (network, day)'),
+                       ('users', 'id        SERIAL primary key NOT NULL, \
+                                 scrape_id integer NOT NULL \
+                                           references scrapes(id), \
+                                 user_id   integer NOT NULL \
+                                           references user_dim(id), \
+                                 node_id   integer NOT NULL \
+                                           references node_dim(id), \
                                  blocked   boolean NOT NULL, \
-                                 name      varchar(40), \
-                                 mac       macaddr NOT NULL, \
                                  kbdown    integer NOT NULL, \
                                  kbup      integer NOT NULL, \
-                                 node      macaddr NOT NULL', \
-                       'nodes': 'id        SERIAL primary key NOT NULL, \
-                                 timestamp timestamp NOT NULL default now(), \
+                                 UNIQUE (scrape_id, user_id)'),
+                       ('nodes', 'id        SERIAL primary key NOT NULL, \
+                                 scrape_id integer NOT NULL \
+                                           references scrapes(id), \
+                                 node_id   integer NOT NULL \
+                                           references node_dim(id), \
                                  status    smallint NOT NULL, \
-                                 name      varchar(40), \
-                                 network   varchar(40), \
-                                 gateway   varchar(40), \
-                                 mac       macaddr NOT NULL, \
                                  users     smallint NOT NULL, \
                                  gwkbdown  integer NOT NULL, \
                                  gwkbup    integer NOT NULL, \
                                  kbdown    integer NOT NULL, \
                                  kbup      integer NOT NULL, \
                                  uptime    numeric(5,2) NOT NULL, \
-                                 firmware  varchar(20) NOT NULL'}
+                                 UNIQUE (scrape_id, node_id)'),
+                       ('usage_daily', 'day       date NOT NULL, \
+                                       network   varchar(40) NOT NULL, \
+                                       users     integer NOT NULL, \
+                                       kbdown    bigint NOT NULL, \
+                                       kbup      bigint NOT NULL, \
+                                       UNIQUE (network, day)'),
+                       ('node_daily', 'day       date NOT NULL, \
+                                      node_id   integer NOT NULL \
+                                                references node_dim(id), \
+                                      users     integer NOT NULL, \
+                                      gwkbdown  bigint NOT NULL, \
+                                      gwkbup    bigint NOT NULL, \
+                                      kbdown    bigint NOT NULL, \
+                                      kbup      bigint NOT NULL, \
+                                      uptime    numeric(5,2) NOT NULL, \
+                                      UNIQUE (day, node_id)'),
+                       ('user_daily', 'day       date NOT NULL, \
+                                      user_id   integer NOT NULL \
+                                                references user_dim(id), \
+                                      kbdown    bigint NOT NULL, \
+                                      kbup      bigint NOT NULL, \
+                                      UNIQUE (day, user_id)'),
+                       ('quota', 'month     date NOT NULL, \
+                                 node_id   integer NOT NULL \
+                                           references node_dim(id), \
+                                 kbdown    bigint NOT NULL, \
+                                 kbup      bigint NOT NULL, \
+                                 alerted   smallint NOT NULL default 0, \
+                                 UNIQUE (month, node_id)'),
+                       ('changes', 'id        SERIAL primary key NOT NULL, \
+                                   seen      timestamp NOT NULL, \
+                                   network   varchar(40) NOT NULL, \
+                                   mac       macaddr NOT NULL, \
+                                   event     varchar(20) NOT NULL, \
+                                   old_value varchar(40), \
+                                   new_value varchar(40)')]
+
+        # In-process cache of dimension rows, mac -> (id, attributes)
+        self.dim_cache = {'node_dim': {}, 'user_dim': {}}
 
         logging.info('Connecting to database')
 
         self.conn = psycopg2.connect(host=config['host'],
                                 database=config['database'],
                                 user=config['username'],
-                                password=config['password'])
+                                password=config['password'],
+                                connect_timeout=int(config.get(
+                                    'connect_timeout', 10)))
 
         logging.info('Creating database cursor')
 
         self.cursor = self.conn.cursor()
 
         self.create_schema()
+        self.load_dimensions()
+
+
+    def add_records(self, nodes, users, started, commit=True):
+        """Add lists of node and user values to the Postgres database"""
+
+        networks = {}
+        node_networks = {}
 
+        for values in nodes:
+            node_networks[values['mac']] = values['network']
+            networks.setdefault(values['network'], ([], []))[0].append(values)
 
-    def add_records(self, nodes, users):
-        """Add a node in the Postgres database"""
-
-        for node in nodes:
-            self.cursor.execute("""INSERT INTO nodes(status,
-                                                     name,
-                                                     network,
-                                                     gateway,
-                                                     mac,
-                                                     users,
-                                                     gwkbdown,
-                                                     gwkbup,
-                                                     kbdown,
-                                                     kbup,
-                                                     uptime,
-                                                     firmware)
-                                             VALUES (%(status)s,
-                                                     %(name)s,
-                                                     %(network)s,
-                                                     %(gateway_name)s,
-                                                     %(mac)s,
-                                                     %(users)s,
-                                                     %(gw_dl)s,
-                                                     %(gw_ul)s,
-                                                     %(dl)s,
-                                                     %(ul)s,
-                                                     %(uptime_percent)s,
-                                                     %(fw_version)s)""",
-                                                     nodes[node].get_values())
-
-        for user in users:
-            self.cursor.execute("""INSERT INTO users(blocked,
-                                                     name,
-                                                     mac,
-                                                     kbdown,
-                                                     kbup,
-                                                     node)
-                                             VALUES (%(blocked)s,
-                                                     %(name)s,
-                                                     %(mac)s,
-                                                     %(dl)s,
-                                                     %(ul)s,
-                                                     %(node_mac)s)""",
-                                                     users[user].get_values())
+        for values in users:
+            network = values.get('network') or \
+                      node_networks.get(values['node_mac'], 'unknown')
+            networks.setdefault(network, ([], []))[1].append(values)
 
+        # Pages older than the newest scrape, such as a backfill, must not
+        # overwrite the current names, networks and firmware of the nodes
+        self.cursor.execute('SELECT max(started) FROM scrapes')
+        latest = self.cursor.fetchone()[0]
+        update = latest is None or started >= latest
+
+        for network in sorted(networks):
+            self.add_scrape(network, started, *networks[network],
+                            update=update)
+
+        if commit:
+            self.conn.commit()
+
+
+    def add_scrape(self, network, started, nodes, users, update=True):
+        """Upsert one network's records under a single scrape id
+
+        Records from an earlier ingest of the same network and day are
+        replaced, and records that are no longer present are removed. A day
+        that has been compacted is not stored again, as it would be counted
+        on top of its daily totals. Without update, the attributes of known
+        nodes and users are left as they are."""
+
+        self.cursor.execute("""SELECT 1
+                                 FROM usage_daily
+                                WHERE network = %s AND day = %s""",
+                            (network, started.date()))
+
+        if self.cursor.fetchone() is not None:
+            logging.warning('Not storing network "%s" for %s, that day has ' +
+                            'been compacted', network, started.date())
+            return None
+
+        self.cursor.execute("""INSERT INTO scrapes(network, day, started)
+                                    VALUES (%s, %s, %s)
+                               ON CONFLICT (network, day)
+                             DO UPDATE SET started = EXCLUDED.started
+                                 RETURNING id""",
+                            (network, started.date(), started))
+
+        scrape_id = self.cursor.fetchone()[0]
+
+        logging.info('Adding scrape %d for network "%s"', scrape_id, network)
+
+        # Internet usage already counted from an earlier ingest of this
+        # scrape, so that only the difference is added to the quota totals
+        self.cursor.execute("""SELECT node_id, gwkbdown, gwkbup
+                                 FROM nodes
+                                WHERE scrape_id = %s""", (scrape_id, ))
+
+        previous = dict((row[0], row[1:]) for row in self.cursor.fetchall())
+        quota = {}
+
+        # Rows are keyed by id, as a mac listed twice would otherwise make
+        # the bulk upsert update the same row twice
+        node_rows = {}
+
+        for values in nodes:
+            node_id = self.get_dim_id('node_dim', values['mac'],
+                                      (values['name'],
+                                       values['network'],
+                                       values['gateway_name'],
+                                       values['fw_version']), update)
+            node_rows[node_id] = dict(values, scrape_id=scrape_id,
+                                      node_id=node_id)
+
+        for node_id in node_rows:
+            values = node_rows[node_id]
+            old = previous.pop(node_id, (0, 0))
+            quota[node_id] = (values['gw_dl'] - old[0],
+                              values['gw_ul'] - old[1])
+
+        execute_values(self.cursor,
+                       """INSERT INTO nodes(scrape_id,
+                                           node_id,
+                                           status,
+                                           users,
+                                           gwkbdown,
+                                           gwkbup,
+                                           kbdown,
+                                           kbup,
+                                           uptime)
+                                   VALUES %s
+                              ON CONFLICT (scrape_id, node_id)
+                            DO UPDATE SET status = EXCLUDED.status,
+                                          users = EXCLUDED.users,
+                                          gwkbdown = EXCLUDED.gwkbdown,
+                                          gwkbup = EXCLUDED.gwkbup,
+                                          kbdown = EXCLUDED.kbdown,
+                                          kbup = EXCLUDED.kbup,
+                                          uptime = EXCLUDED.uptime""",
+                       node_rows.values(),
+                       template='(%(scrape_id)s, %(node_id)s, %(status)s, ' +
+                                '%(users)s, %(gw_dl)s, %(gw_ul)s, %(dl)s, ' +
+                                '%(ul)s, %(uptime_percent)s)',
+                       page_size=BULK_ROWS)
+
+        user_rows = {}
+
+        for values in users:
+            user_id = self.get_dim_id('user_dim', values['mac'],
+                                      (values['name'], ), update)
+            node_id = self.get_dim_id('node_dim', values['node_mac'])
+            user_rows[user_id] = dict(values, scrape_id=scrape_id,
+                                      user_id=user_id, node_id=node_id)
+
+        execute_values(self.cursor,
+                       """INSERT INTO users(scrape_id,
+                                           user_id,
+                                           node_id,
+                                           blocked,
+                                           kbdown,
+                                           kbup)
+                                   VALUES %s
+                              ON CONFLICT (scrape_id, user_id)
+                            DO UPDATE SET node_id = EXCLUDED.node_id,
+                                          blocked = EXCLUDED.blocked,
+                                          kbdown = EXCLUDED.kbdown,
+                                          kbup = EXCLUDED.kbup""",
+                       user_rows.values(),
+                       template='(%(scrape_id)s, %(user_id)s, %(node_id)s, ' +
+                                '%(blocked)s, %(dl)s, %(ul)s)',
+                       page_size=BULK_ROWS)
+
+        node_ids = node_rows.keys()
+        user_ids = user_rows.keys()
+
+        self.cursor.execute("""DELETE FROM nodes
+                                WHERE scrape_id = %s AND
+                                      node_id <> ALL(%s)""",
+                            (scrape_id, node_ids))
+        self.cursor.execute("""DELETE FROM users
+                                WHERE scrape_id = %s AND
+                                      user_id <> ALL(%s)""",
+                            (scrape_id, user_ids))
+
+        for node_id, old in previous.items():
+            quota[node_id] = (-old[0], -old[1])
+
+        self.update_quota(started.date().replace(day=1), quota)
+
+        self.cursor.execute("""UPDATE scrapes
+                                  SET finished = now(),
+                                      nodes = %s,
+                                      users = %s
+                                WHERE id = %s""",
+                            (len(node_ids), len(user_ids), scrape_id))
+
+        return scrape_id
+
+
+    def add_changes(self, events):
+        """Postgres implementation of this method"""
+        self.cursor.executemany("""INSERT INTO changes(seen, network, mac, event,
+                                                       old_value, new_value)
+                                        VALUES (%(seen)s, %(network)s, %(mac)s,
+                                                %(type)s, %(old)s, %(new)s)""",
+                                events)
         self.conn.commit()
 
 
-    def get_past_gw_xfer(self, interval):
+    def close(self):
+        """Close the database connection"""
+        self.conn.close()
+
+
+    def commit(self):
+        """Commit the current transaction"""
+        self.conn.commit()
+
+
+    def rollback(self):
+        """Roll back the current transaction
+
+        Dimension rows added in the transaction are gone, so the cache is
+        emptied and refilled as rows are looked up again."""
+        self.dim_cache = {'node_dim': {}, 'user_dim': {}}
+        self.conn.rollback()
+
+
+    def update_quota(self, month, quota):
+        """Add changes in internet usage to the month to date totals"""
+
+        for node_id in quota:
+            dl, ul = quota[node_id]
+
+            if dl == 0 and ul == 0:
+                continue
+
+            self.cursor.execute("""INSERT INTO quota(month, node_id, kbdown, kbup)
+                                        VALUES (%s, %s, %s, %s)
+                                   ON CONFLICT (month, node_id)
+                                 DO UPDATE SET kbdown = quota.kbdown +
+                                                        EXCLUDED.kbdown,
+                                               kbup = quota.kbup +
+                                                      EXCLUDED.kbup""",
+                                (month, node_id, dl, ul))
+
+
+    def get_quota(self, month, rate_days):
         """Postgres implementation of this method"""
         self.cursor.execute("""SELECT mac,
-                                      sum(gwkbdown) as kbdown,
-                                      sum(gwkbup) as kbup
-                                 FROM nodes
-                                WHERE timestamp > now() - INTERVAL %s AND
-                                      timestamp < now()
-                             GROUP BY mac
-                             ORDER BY mac""", (interval, ))
+                                      name,
+                                      quota.kbdown,
+                                      quota.kbup,
+                                      coalesce(rate.kb, 0),
+                                      alerted
+                                 FROM quota
+                                 JOIN node_dim ON node_dim.id = quota.node_id
+                            LEFT JOIN (SELECT node_id,
+                                              sum(gwkbdown + gwkbup) /
+                                              count(distinct(day)) AS kb
+                                         FROM nodes
+                                         JOIN scrapes
+                                           ON scrapes.id = nodes.scrape_id
+                                        WHERE day > current_date - %s
+                                     GROUP BY node_id) AS rate
+                                   ON rate.node_id = quota.node_id
+                                WHERE month = %s
+                             ORDER BY mac""", (rate_days, month))
 
-        return self.cursor
+        return self.cursor.fetchall()
 
 
-    def get_past_stats(self, interval):
+    def set_quota_alerted(self, month, mac, threshold):
         """Postgres implementation of this method"""
-        self.cursor.execute("""SELECT date(timestamp) as date,
-                                      count(distinct(mac)) as users,
-                                      sum(kbdown) as kbdown,
-                                      sum(kbup) as kbup
-                                 FROM users
-                                WHERE timestamp > now() - INTERVAL %s AND
-                                      timestamp < now()
-                             GROUP BY date
-                             ORDER BY date""", (interval, ))
+        self.cursor.execute("""UPDATE quota
+                                  SET alerted = %s
+                                 FROM node_dim
+                                WHERE node_dim.id = quota.node_id AND
+                                      node_dim.mac = %s AND
+                                      month = %s""", (threshold, mac, month))
+        self.conn.commit()
+
+
+    def load_dimensions(self):
+        """Populate the dimension cache from the database"""
+
+        self.cursor.execute("""SELECT id, mac, name, network, gateway, firmware
+                                 FROM node_dim""")
+
+        for row in self.cursor.fetchall():
+            self.dim_cache['node_dim'][row[1]] = (row[0], tuple(row[2:]))
+
+        self.cursor.execute('SELECT id, mac, name FROM user_dim')
+
+        for row in self.cursor.fetchall():
+            self.dim_cache['user_dim'][row[1]] = (row[0], tuple(row[2:]))
+
+        logging.info('Cached %d nodes and %d users',
+                     len(self.dim_cache['node_dim']),
+                     len(self.dim_cache['user_dim']))
+
+
+    def get_dim_id(self, table, mac, attributes=None, update=True):
+        """Return the dimension id for a mac address
+
+        The row is created if it does not exist yet, and updated if the
+        attributes have changed, unless update is False. Passing no
+        attributes only ensures the row exists."""
+
+        columns = {'node_dim': ('name', 'network', 'gateway', 'firmware'),
+                   'user_dim': ('name', )}[table]
+
+        cached = self.dim_cache[table].get(mac)
+
+        if cached is not None:
+            if attributes is None or not update or cached[1] == attributes:
+                return cached[0]
+
+            logging.info('Updating %s row for %s', table, mac)
+
+            self.cursor.execute("UPDATE %s SET %s WHERE id = %%s" %
+                                (table, ', '.join(['%s = %%s' % column
+                                                   for column in columns])),
+                                attributes + (cached[0], ))
+
+            dim_id = cached[0]
+
+        else:
+            # Another connection may have added the row since the cache was
+            # loaded, so an existing row is updated rather than duplicated.
+            # Without attributes, or without update, the existing ones are
+            # left alone.
+            if attributes is None:
+                values = (None, ) * len(columns)
+                updates = ['mac = EXCLUDED.mac']
+            elif not update:
+                values = attributes
+                updates = ['mac = EXCLUDED.mac']
+            else:
+                values = attributes
+                updates = ['%s = EXCLUDED.%s' % (column, column)
+                           for column in columns]
+
+            self.cursor.execute("INSERT INTO %s (mac, %s) VALUES (%%s, %s) \
+                                 ON CONFLICT (mac) DO UPDATE SET %s \
+                                   RETURNING id, %s" %
+                                (table, ', '.join(columns),
+                                 ', '.join(['%s'] * len(columns)),
+                                 ', '.join(updates), ', '.join(columns)),
+                                (mac, ) + values)
+
+            row = self.cursor.fetchone()
+            dim_id = row[0]
+            attributes = tuple(row[1:])
+
+        self.dim_cache[table][mac] = (dim_id, attributes)
 
-        return self.cursor
+        return dim_id
 
 
-    def table_exists(self, table):
-        """Check if a particular table exists in the database"""
+    def compact(self, retention):
+        """Postgres implementation of this method
 
-        logging.info('Checking if table "%s" exists', table)
+        Each scrape is compacted in its own transaction, so the ingest is
+        never blocked for longer than it takes to compact one scrape. The
+        raw tables are vacuumed afterwards, which frees the space of the
+        deleted rows for reuse, but only returns it to the filesystem where
+        whole pages at the end of a table are now empty."""
 
-        self.cursor.execute('SELECT * FROM information_schema.tables \
-                                     WHERE table_name=%s', (table,))
+        before = self.get_raw_size()
 
-        return bool(self.cursor.rowcount)
+        self.cursor.execute("""SELECT id, network, day
+                                 FROM scrapes
+                                WHERE started < now() - INTERVAL %s
+                             ORDER BY started""", (retention, ))
+
+        scrapes = self.cursor.fetchall()
+        rows = 0
+
+        for scrape_id, network, day in scrapes:
+            logging.info('Compacting scrape %d for network "%s" on %s',
+                         scrape_id, network, day)
+
+            self.cursor.execute("""INSERT INTO usage_daily(day,
+                                                           network,
+                                                           users,
+                                                           kbdown,
+                                                           kbup)
+                                        SELECT %s, %s,
+                                               count(distinct(user_id)),
+                                               coalesce(sum(kbdown), 0),
+                                               coalesce(sum(kbup), 0)
+                                          FROM users
+                                         WHERE scrape_id = %s
+                                   ON CONFLICT (network, day)
+                                 DO UPDATE SET users = EXCLUDED.users,
+                                               kbdown = EXCLUDED.kbdown,
+                                               kbup = EXCLUDED.kbup""",
+                                (day, network, scrape_id))
+
+            self.cursor.execute("""INSERT INTO node_daily(day,
+                                                          node_id,
+                                                          users,
+                                                          gwkbdown,
+                                                          gwkbup,
+                                                          kbdown,
+                                                          kbup,
+                                                          uptime)
+                                        SELECT %s, node_id, users, gwkbdown,
+                                               gwkbup, kbdown, kbup, uptime
+                                          FROM nodes
+                                         WHERE scrape_id = %s
+                                   ON CONFLICT (day, node_id)
+                                 DO UPDATE SET users = greatest(node_daily.users,
+                                                                EXCLUDED.users),
+                                               gwkbdown = node_daily.gwkbdown +
+                                                          EXCLUDED.gwkbdown,
+                                               gwkbup = node_daily.gwkbup +
+                                                        EXCLUDED.gwkbup,
+                                               kbdown = node_daily.kbdown +
+                                                        EXCLUDED.kbdown,
+                                               kbup = node_daily.kbup +
+                                                      EXCLUDED.kbup,
+                                               uptime = least(node_daily.uptime,
+                                                              EXCLUDED.uptime)""",
+                                (day, scrape_id))
+
+            self.cursor.execute("""INSERT INTO user_daily(day,
+                                                          user_id,
+                                                          kbdown,
+                                                          kbup)
+                                        SELECT %s, user_id, kbdown, kbup
+                                          FROM users
+                                         WHERE scrape_id = %s
+                                   ON CONFLICT (day, user_id)
+                                 DO UPDATE SET kbdown = user_daily.kbdown +
+                                                        EXCLUDED.kbdown,
+                                               kbup = user_daily.kbup +
+                                                      EXCLUDED.kbup""",
+                                (day, scrape_id))
+
+            for table in ('users', 'nodes'):
+                self.cursor.execute('DELETE FROM %s WHERE scrape_id = %%s' %
+                                    table, (scrape_id, ))
+
+                rows += self.cursor.rowcount
+
+            self.cursor.execute('DELETE FROM scrapes WHERE id = %s',
+                                (scrape_id, ))
+
+            self.conn.commit()
+
+        if scrapes:
+            # VACUUM cannot run inside a transaction
+            self.conn.autocommit = True
+
+            try:
+                for table in RAW_TABLES:
+                    self.cursor.execute('VACUUM %s' % table)
+            finally:
+                self.conn.autocommit = False
+
+        return (len(scrapes), rows, before, self.get_raw_size())
+
+
+    def get_raw_size(self):
+        """Return the bytes used by the raw tables and their indexes"""
+        self.cursor.execute('SELECT %s' %
+                            ' + '.join(["pg_total_relation_size('%s')" %
+                                        table for table in RAW_TABLES]))
+
+        return self.cursor.fetchone()[0]
+
+
+    def get_day_gw_xfer(self, first, last):
+        """Postgres implementation of this method"""
+        self.cursor.execute("""SELECT day,
+                                      xfer.network,
+                                      mac::text,
+                                      sum(kbdown)::bigint,
+                                      sum(kbup)::bigint
+                                 FROM (SELECT day,
+                                              scrapes.network,
+                                              node_id,
+                                              gwkbdown AS kbdown,
+                                              gwkbup AS kbup
+                                         FROM nodes
+                                         JOIN scrapes
+                                           ON scrapes.id = nodes.scrape_id
+                                        WHERE day BETWEEN %(first)s AND
+                                                          %(last)s
+                                    UNION ALL
+                                       SELECT day,
+                                              node_dim.network,
+                                              node_id,
+                                              gwkbdown,
+                                              gwkbup
+                                         FROM node_daily
+                                         JOIN node_dim
+                                           ON node_dim.id = node_daily.node_id
+                                        WHERE day BETWEEN %(first)s AND
+                                                          %(last)s
+                                      ) AS xfer
+                                 JOIN node_dim ON node_dim.id = xfer.node_id
+                             GROUP BY day, xfer.network, mac
+                             ORDER BY day, xfer.network, mac""",
+                            {'first': first, 'last': last})
+
+        return self.cursor.fetchall()
+
+
+    def get_day_stats(self, first, last):
+        """Postgres implementation of this method
+
+        Unique users of the whole day are counted over the raw and
+        compacted users of every network."""
+        self.cursor.execute("""WITH stats AS (
+                                   SELECT day,
+                                          network,
+                                          count(distinct(user_id)) AS users,
+                                          sum(kbdown) AS kbdown,
+                                          sum(kbup) AS kbup
+                                     FROM users
+                                     JOIN scrapes
+                                       ON scrapes.id = users.scrape_id
+                                    WHERE day BETWEEN %(first)s AND %(last)s
+                                 GROUP BY day, network
+                                UNION ALL
+                                   SELECT day, network, users, kbdown, kbup
+                                     FROM usage_daily
+                                    WHERE day BETWEEN %(first)s AND %(last)s
+                               ), day_users AS (
+                                   SELECT day,
+                                          count(distinct(user_id)) AS users
+                                     FROM (SELECT day, user_id
+                                             FROM users
+                                             JOIN scrapes
+                                               ON scrapes.id = users.scrape_id
+                                            WHERE day BETWEEN %(first)s AND
+                                                              %(last)s
+                                        UNION ALL
+                                           SELECT day, user_id
+                                             FROM user_daily
+                                            WHERE day BETWEEN %(first)s AND
+                                                              %(last)s
+                                          ) AS seen
+                                 GROUP BY day
+                               )
+                               SELECT day,
+                                      network,
+                                      users::integer,
+                                      kbdown::bigint,
+                                      kbup::bigint
+                                 FROM stats
+                            UNION ALL
+                               SELECT stats.day,
+                                      %(all)s,
+                                      coalesce(max(day_users.users),
+                                               0)::integer,
+                                      sum(stats.kbdown)::bigint,
+                                      sum(stats.kbup)::bigint
+                                 FROM stats
+                            LEFT JOIN day_users
+                                   ON day_users.day = stats.day
+                             GROUP BY stats.day
+                             ORDER BY day, network""",
+                            {'first': first, 'last': last,
+                             'all': ALL_NETWORKS})
+
+        return self.cursor.fetchall()
+
+
+    def get_top_users(self, first, last, count):
+        """Postgres implementation of this method"""
+        self.cursor.execute("""SELECT rank,
+                                      mac::text,
+                                      name,
+                                      kbdown,
+                                      kbup,
+                                      days
+                                 FROM (SELECT user_dim.mac,
+                                              user_dim.name,
+                                              sum(traffic.kbdown)::bigint
+                                                  AS kbdown,
+                                              sum(traffic.kbup)::bigint
+                                                  AS kbup,
+                                              count(distinct(traffic.day))
+                                                  AS days,
+                                              rank() OVER (ORDER BY
+                                                  sum(traffic.kbdown +
+                                                      traffic.kbup) DESC)
+                                                  AS rank
+                                         FROM (SELECT day,
+                                                      user_id,
+                                                      kbdown,
+                                                      kbup
+                                                 FROM users
+                                                 JOIN scrapes
+                                                   ON scrapes.id =
+                                                      users.scrape_id
+                                                WHERE day BETWEEN %(first)s
+                                                              AND %(last)s
+                                            UNION ALL
+                                               SELECT day,
+                                                      user_id,
+                                                      kbdown,
+                                                      kbup
+                                                 FROM user_daily
+                                                WHERE day BETWEEN %(first)s
+                                                              AND %(last)s
+                                              ) AS traffic
+                                         JOIN user_dim
+                                           ON user_dim.id = traffic.user_id
+                                     GROUP BY user_dim.mac, user_dim.name
+                                      ) AS ranked
+                                WHERE rank <= %(count)s
+                             ORDER BY rank, mac""",
+                            {'first': first, 'last': last, 'count': count})
+
+        return self.cursor.fetchall()
+
+
+    def get_gateway_usage(self, first, last):
+        """Postgres implementation of this method"""
+        self.cursor.execute("""SELECT day,
+                                      mac::text,
+                                      name,
+                                      kbdown,
+                                      kbup,
+                                      sum(kbdown + kbup) OVER (
+                                          PARTITION BY mac
+                                              ORDER BY day)::bigint
+                                          AS running,
+                                      round(100.0 * (kbdown + kbup) /
+                                            sum(kbdown + kbup) OVER (
+                                                PARTITION BY day),
+                                            1)::float8 AS share
+                                 FROM (SELECT day,
+                                              node_id,
+                                              sum(gwkbdown)::bigint
+                                                  AS kbdown,
+                                              sum(gwkbup)::bigint AS kbup
+                                         FROM (SELECT day,
+                                                      node_id,
+                                                      gwkbdown,
+                                                      gwkbup
+                                                 FROM nodes
+                                                 JOIN scrapes
+                                                   ON scrapes.id =
+                                                      nodes.scrape_id
+                                                WHERE day BETWEEN %(first)s
+                                                              AND %(last)s
+                                            UNION ALL
+                                               SELECT day,
+                                                      node_id,
+                                                      gwkbdown,
+                                                      gwkbup
+                                                 FROM node_daily
+                                                WHERE day BETWEEN %(first)s
+                                                              AND %(last)s
+                                              ) AS xfer
+                                     GROUP BY day, node_id
+                                       HAVING sum(gwkbdown + gwkbup) > 0
+                                      ) AS daily
+                                 JOIN node_dim ON node_dim.id = daily.node_id
+                             ORDER BY day, mac""",
+                            {'first': first, 'last': last})
+
+        return self.cursor.fetchall()
+
+
+    def get_node_users(self, first, last):
+        """Postgres implementation of this method"""
+        self.cursor.execute("""SELECT mac::text,
+                                      name,
+                                      days,
+                                      average,
+                                      peak,
+                                      peak_day,
+                                      users
+                                 FROM (SELECT node_id,
+                                              users,
+                                              count(*) OVER node AS days,
+                                              round(avg(users) OVER node,
+                                                    1)::float8 AS average,
+                                              max(users) OVER node AS peak,
+                                              first_value(day) OVER (
+                                                  PARTITION BY node_id
+                                                      ORDER BY users DESC,
+                                                               day DESC)
+                                                  AS peak_day,
+                                              row_number() OVER (
+                                                  PARTITION BY node_id
+                                                      ORDER BY day DESC)
+                                                  AS recent
+                                         FROM (SELECT day,
+                                                      node_id,
+                                                      max(users) AS users
+                                                 FROM (SELECT day,
+                                                              node_id,
+                                                              users
+                                                         FROM nodes
+                                                         JOIN scrapes
+                                                           ON scrapes.id =
+                                                              nodes.scrape_id
+                                                        WHERE day BETWEEN
+                                                              %(first)s AND
+                                                              %(last)s
+                                                    UNION ALL
+                                                       SELECT day,
+                                                              node_id,
+                                                              users
+                                                         FROM node_daily
+                                                        WHERE day BETWEEN
+                                                              %(first)s AND
+                                                              %(last)s
+                                                      ) AS counts
+                                             GROUP BY day, node_id
+                                              ) AS daily
+                                       WINDOW node AS (PARTITION BY node_id)
+                                      ) AS summary
+                                 JOIN node_dim ON node_dim.id = summary.node_id
+                                WHERE recent = 1
+                             ORDER BY average DESC, mac""",
+                            {'first': first, 'last': last})
+
+        return self.cursor.fetchall()
 
 
     def create_schema(self):
-        """Create the current database schema if it doesn't exist"""
+        """Create the current database schema if it doesn't exist
+
+        Nodes and users tables from older versions, which kept every
+        attribute on each row, are renamed and their records migrated into
+        the new tables."""
+
+        tables = [table for table, definition in self.schema]
+
+        logging.info('Checking for existing tables')
+
+        self.cursor.execute("""SELECT table_name
+                                 FROM information_schema.tables
+                                WHERE table_name = ANY(%s)""", (tables, ))
+
+        existing = set(row[0] for row in self.cursor.fetchall())
+
+        self.cursor.execute("""SELECT 1
+                                 FROM information_schema.columns
+                                WHERE table_name = 'nodes' AND
+                                      column_name = 'timestamp'""")
+
+        legacy = self.cursor.fetchone() is not None
+
+        if legacy:
+            self.rename_legacy_tables()
+            existing -= set(LEGACY_TABLES)
 
-        for table in self.schema:
-            if not self.table_exists(table):
+        for table, definition in self.schema:
+            if table not in existing:
 
                 logging.info('Creating "%s" table', table)
 
                 self.cursor.execute("CREATE TABLE %s (%s);",
-                                   (AsIs(table), AsIs(self.schema[table])))
-
-                self.conn.commit()
+                                   (AsIs(table), AsIs(definition)))
             else:
                 logging.info('Table "%s" already exists', table)
+
+        if legacy:
+            self.migrate_legacy_tables()
+
+        self.conn.commit()
+
+
+    def rename_legacy_tables(self):
+        """Move the nodes and users tables of older versions aside"""
+
+        for table in LEGACY_TABLES:
+            logging.warning('Renaming "%s" table from an older version to ' +
+                            '"%s_v1"', table, table)
+
+            self.cursor.execute("ALTER TABLE %s RENAME TO %s_v1",
+                                (AsIs(table), AsIs(table)))
+            self.cursor.execute("ALTER INDEX IF EXISTS %s_pkey " +
+                                "RENAME TO %s_v1_pkey",
+                                (AsIs(table), AsIs(table)))
+            self.cursor.execute("ALTER SEQUENCE IF EXISTS %s_id_seq " +
+                                "RENAME TO %s_v1_id_seq",
+                                (AsIs(table), AsIs(table)))
+
+
+    def migrate_legacy_tables(self):
+        """Copy the records of older versions into the current schema
+
+        The latest attributes of each mac address become its dimension row,
+        and the latest record of each node and user on a day becomes that
+        day's scrape, as if it had been stored by this version."""
+
+        logging.warning('Migrating records from an older version')
+
+        self.cursor.execute("""INSERT INTO node_dim(mac, name, network,
+                                                    gateway, firmware)
+                               SELECT DISTINCT ON (mac)
+                                      mac, name, network, gateway, firmware
+                                 FROM nodes_v1
+                             ORDER BY mac, timestamp DESC""")
+
+        # Users may have been seen on nodes that were never recorded
+        self.cursor.execute("""INSERT INTO node_dim(mac)
+                               SELECT DISTINCT node
+                                 FROM users_v1
+                          ON CONFLICT (mac) DO NOTHING""")
+
+        self.cursor.execute("""INSERT INTO user_dim(mac, name)
+                               SELECT DISTINCT ON (mac) mac, name
+                                 FROM users_v1
+                             ORDER BY mac, timestamp DESC""")
+
+        self.cursor.execute("""INSERT INTO scrapes(network, day, started,
+                                                   finished)
+                               SELECT coalesce(network, 'unknown'),
+                                      timestamp::date,
+                                      min(timestamp),
+                                      max(timestamp)
+                                 FROM nodes_v1
+                             GROUP BY 1, 2""")
+
+        self.cursor.execute("""INSERT INTO scrapes(network, day, started,
+                                                   finished)
+                               SELECT coalesce(node_dim.network, 'unknown'),
+                                      users_v1.timestamp::date,
+                                      min(users_v1.timestamp),
+                                      max(users_v1.timestamp)
+                                 FROM users_v1
+                                 JOIN node_dim ON node_dim.mac = users_v1.node
+                             GROUP BY 1, 2
+                          ON CONFLICT (network, day) DO NOTHING""")
+
+        self.cursor.execute("""INSERT INTO nodes(scrape_id, node_id, status,
+                                                 users, gwkbdown, gwkbup,
+                                                 kbdown, kbup, uptime)
+                               SELECT DISTINCT ON (scrapes.id, node_dim.id)
+                                      scrapes.id,
+                                      node_dim.id,
+                                      nodes_v1.status,
+                                      nodes_v1.users,
+                                      nodes_v1.gwkbdown,
+                                      nodes_v1.gwkbup,
+                                      nodes_v1.kbdown,
+                                      nodes_v1.kbup,
+                                      nodes_v1.uptime
+                                 FROM nodes_v1
+                                 JOIN node_dim ON node_dim.mac = nodes_v1.mac
+                                 JOIN scrapes ON scrapes.network =
+                                                 coalesce(nodes_v1.network,
+                                                          'unknown') AND
+                                                 scrapes.day =
+                                                 nodes_v1.timestamp::date
+                             ORDER BY scrapes.id, node_dim.id,
+                                      nodes_v1.timestamp DESC""")
+
+        self.cursor.execute("""INSERT INTO users(scrape_id, user_id, node_id,
+                                                 blocked, kbdown, kbup)
+                               SELECT DISTINCT ON (scrapes.id, user_dim.id)
+                                      scrapes.id,
+                                      user_dim.id,
+                                      node_dim.id,
+                                      users_v1.blocked,
+                                      users_v1.kbdown,
+                                      users_v1.kbup
+                                 FROM users_v1
+                                 JOIN user_dim ON user_dim.mac = users_v1.mac
+                                 JOIN node_dim ON node_dim.mac = users_v1.node
+                                 JOIN scrapes ON scrapes.network =
+                                                 coalesce(node_dim.network,
+                                                          'unknown') AND
+                                                 scrapes.day =
+                                                 users_v1.timestamp::date
+                             ORDER BY scrapes.id, user_dim.id,
+                                      users_v1.timestamp DESC""")
+
+        self.cursor.execute("""UPDATE scrapes
+                                  SET nodes = (SELECT count(*)
+                                                 FROM nodes
+                                                WHERE scrape_id = scrapes.id),
+                                      users = (SELECT count(*)
+                                                 FROM users
+                                                WHERE scrape_id = scrapes.id)""")
+
+        self.cursor.execute("""INSERT INTO quota(month, node_id, kbdown, kbup)
+                               SELECT date_trunc('month', scrapes.day)::date,
+                                      nodes.node_id,
+                                      sum(nodes.gwkbdown),
+                                      sum(nodes.gwkbup)
+                                 FROM nodes
+                                 JOIN scrapes ON scrapes.id = nodes.scrape_id
+                             GROUP BY 1, 2
+                          ON CONFLICT (month, node_id) DO NOTHING""")
+
+        self.cursor.execute("SELECT count(*) FROM scrapes")
+
+        logging.warning('Migrated %d scrapes. The nodes_v1 and users_v1 ' +
+                        'tables can be dropped once they have been checked',
+                        self.cursor.fetchone()[0])
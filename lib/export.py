@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+""" lib/export.py
+
+ Exporter class for CloudScraper
+
+ Copyright (c) 2013 The Goulburn Group. All Rights Reserved.
+
+ http://www.goulburngroup.com.au
+
+ Written by Alex Ferrara <alex@receptiveit.com.au>
+
+"""
+
+from collections import OrderedDict
+import csv
+import json
+import logging
+import re
+import threading
+
+EXPORT_FORMATS = ['ndjson', 'csv']
+
+# Fields of each record and how their values are typed. Values that
+# CloudTrax leaves blank or as "Unknown" come out as null.
+NODE_FIELDS = [('network', 'str'),
+               ('mac', 'mac'),
+               ('name', 'str'),
+               ('comment', 'str'),
+               ('type', 'str'),
+               ('state', 'str'),
+               ('status', 'int'),
+               ('ip', 'str'),
+               ('gateway_name', 'str'),
+               ('gateway_ip', 'str'),
+               ('chan_24', 'int'),
+               ('chan_58', 'int'),
+               ('hops', 'int'),
+               ('latency', 'float'),
+               ('users', 'int'),
+               ('dl', 'int'),
+               ('ul', 'int'),
+               ('gw_dl', 'int'),
+               ('gw_ul', 'int'),
+               ('uptime', 'str'),
+               ('uptime_percent', 'float'),
+               ('time_gw', 'float'),
+               ('time_relay', 'float'),
+               ('time_offline', 'float'),
+               ('last_checkin', 'str'),
+               ('fw_version', 'str'),
+               ('fw_name', 'str'),
+               ('load', 'float'),
+               ('memfree', 'int')]
+
+USER_FIELDS = [('network', 'str'),
+               ('mac', 'mac'),
+               ('name', 'str'),
+               ('node_mac', 'mac'),
+               ('node_name', 'str'),
+               ('rssi', 'int'),
+               ('rate', 'float'),
+               ('MCS', 'int'),
+               ('blocked', 'str'),
+               ('dl', 'int'),
+               ('ul', 'int'),
+               ('nodes', 'int')]
+
+# CSV rows hold both kinds of record, so the columns are the union of both
+CSV_FIELDS = ['record', 'scraped'] + [field for field, field_type in
+                                      NODE_FIELDS] + \
+             [field for field, field_type in USER_FIELDS
+              if field not in dict(NODE_FIELDS)]
+
+# Text values that CloudTrax uses when it has nothing to show
+BLANK_VALUES = ('', 'Unknown')
+
+HEX_DIGITS = re.compile(r'[^0-9a-f]')
+NUMBER = re.compile(r'-?[\d,]*\.?\d+')
+
+
+#
+# Helper functions
+#
+
+def normal_mac(value):
+    """Return a mac address as lower case, colon separated hex digits"""
+
+    if not value:
+        return None
+
+    digits = HEX_DIGITS.sub('', unicode(value).lower())
+
+    if len(digits) != 12:
+        return unicode(value).lower()
+
+    return ':'.join(digits[index:index + 2] for index in range(0, 12, 2))
+
+
+def typed(value, field_type):
+    """Return a value converted to the type of its field"""
+
+    if field_type == 'mac':
+        return normal_mac(value)
+
+    if value is None:
+        return None
+
+    if field_type == 'str':
+        value = unicode(value).strip()
+
+        if value in BLANK_VALUES:
+            return None
+
+        return value
+
+    if isinstance(value, (int, long, float)):
+        if field_type == 'int':
+            return int(value)
+
+        return float(value)
+
+    # Numbers scraped from the dashboard may carry units or separators
+    # such as "1,024" or "12ms"
+    match = NUMBER.search(unicode(value))
+
+    if match is None:
+        return None
+
+    number = float(match.group(0).replace(',', ''))
+
+    if field_type == 'int':
+        return int(number)
+
+    return number
+
+
+def node_record(node, scraped):
+    """Return the export record of a node"""
+
+    values = dict(node.get_values())
+    values['type'] = getattr(node, 'node_type', None)
+    values['state'] = getattr(node, 'node_status', None)
+    values['time_gw'] = node.get_time_gw()
+    values['time_relay'] = node.get_time_relay()
+    values['time_offline'] = node.get_time_offline()
+
+    record = [('record', 'node'), ('scraped', scraped)]
+    record.extend((field, typed(values.get(field), field_type))
+                  for field, field_type in NODE_FIELDS)
+
+    return record
+
+
+def user_record(user, network, scraped):
+    """Return the export record of a user"""
+
+    values = dict(user.get_values(), network=network)
+
+    record = [('record', 'user'), ('scraped', scraped)]
+    record.extend((field, typed(values.get(field), field_type))
+                  for field, field_type in USER_FIELDS)
+
+    return record
+
+
+class Exporter:
+    """Streams scraped nodes and users as NDJSON or CSV
+
+    put() may be used as a scrape callback, and passes each network on to
+    the next callback. Records are written and flushed as each network
+    arrives, so nothing is held back until the end of the run."""
+
+    def __init__(self, stream, export_format, scraped, callback=None):
+        """Constructor"""
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError('Unknown export format "%s"' % export_format)
+
+        self.stream = stream
+        self.export_format = export_format
+        self.scraped = scraped.isoformat()
+        self.callback = callback
+        self.records = 0
+        self.lock = threading.Lock()
+
+        if export_format == 'csv':
+            self.writer = csv.writer(stream)
+            self.writer.writerow(CSV_FIELDS)
+
+    def write(self, record):
+        """Write one record"""
+
+        if self.export_format == 'ndjson':
+            self.stream.write(json.dumps(OrderedDict(record),
+                                         separators=(',', ':')) + '\n')
+        else:
+            values = dict(record)
+            row = []
+
+            for field in CSV_FIELDS:
+                value = values.get(field)
+
+                if value is None:
+                    row.append('')
+                elif isinstance(value, unicode):
+                    row.append(value.encode('utf-8'))
+                else:
+                    row.append(value)
+
+            self.writer.writerow(row)
+
+        self.records += 1
+
+    def put(self, nodes, users):
+        """Write the nodes and users of one network"""
+
+        network = None
+
+        if nodes:
+            network = nodes.itervalues().next().get_values()['network']
+
+        with self.lock:
+            for mac in sorted(nodes):
+                self.write(node_record(nodes[mac], self.scraped))
+
+            for mac in sorted(users):
+                self.write(user_record(users[mac], network, self.scraped))
+
+            self.stream.flush()
+
+        if self.callback is not None:
+            self.callback(nodes, users)
+
+    def close(self):
+        """Flush the output"""
+        logging.info('Exported %d records', self.records)
+
+        self.stream.flush()
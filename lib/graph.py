@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+""" lib/graph.py
+
+ Graph rendering for CloudScraper
+
+ Copyright (c) 2013 The Goulburn Group. All Rights Reserved.
+
+ http://www.goulburngroup.com.au
+
+ Written by Alex Ferrara <alex@receptiveit.com.au>
+
+"""
+
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import pygal
+import time
+
+CHART_TYPES = {'line': pygal.Line,
+               'pie': pygal.Pie,
+               'xy': pygal.XY}
+
+# Most points and x labels drawn on a history chart
+HISTORY_POINTS = 120
+HISTORY_LABELS = 12
+
+
+#
+# Helper functions
+#
+
+def chart_key(chart, img_format):
+    """Return a hash of everything that affects how a chart renders"""
+    return hashlib.sha1(json.dumps([chart, img_format],
+                                   sort_keys=True)).hexdigest()
+
+
+def history_charts(labels, users, dlkb, ulkb):
+    """Return charts of users and transfer over a range of days
+
+    Long ranges are downsampled with largest triangle three buckets, which
+    keeps peaks and troughs, and only a limited number of x labels are
+    shown, so a chart of several years renders as quickly as a month."""
+
+    users_index = lttb(users, HISTORY_POINTS)
+    xfer_index = lttb([dl + ul for dl, ul in zip(dlkb, ulkb)], HISTORY_POINTS)
+
+    return [{'type': 'line',
+             'title': 'Users by day',
+             'x_labels': thin_labels([labels[i] for i in users_index],
+                                     HISTORY_LABELS),
+             'series': [('Users', [int(users[i]) for i in users_index])]},
+            {'type': 'line',
+             'title': 'Transfer by day (MB)',
+             'x_labels': thin_labels([labels[i] for i in xfer_index],
+                                     HISTORY_LABELS),
+             'series': [('Downloads', [float(dlkb[i]) / 1000
+                                       for i in xfer_index]),
+                        ('Uploads', [float(ulkb[i]) / 1000
+                                     for i in xfer_index])]}]
+
+
+def lttb(values, threshold):
+    """Return the indexes of the points to keep when downsampling values
+
+    This is the largest triangle three buckets algorithm, with the index
+    of each value as its x coordinate. The first and last points are always
+    kept."""
+
+    count = len(values)
+
+    if threshold >= count or threshold < 3:
+        return range(count)
+
+    every = float(count - 2) / (threshold - 2)
+    selected = 0
+    indexes = [0]
+
+    for bucket in range(threshold - 2):
+        # Average of the next bucket, the third point of the triangle
+        next_start = int((bucket + 1) * every) + 1
+        next_end = min(int((bucket + 2) * every) + 1, count)
+        next_x = (next_start + next_end - 1) / 2.0
+        next_y = float(sum(values[next_start:next_end])) / \
+                 (next_end - next_start)
+
+        best_area = -1
+        best = None
+
+        for index in range(int(bucket * every) + 1, next_start):
+            area = abs((selected - next_x) * (values[index] -
+                                              values[selected]) -
+                       (selected - index) * (next_y - values[selected]))
+
+            if area > best_area:
+                best_area = area
+                best = index
+
+        indexes.append(best)
+        selected = best
+
+    indexes.append(count - 1)
+
+    return indexes
+
+
+def thin_labels(labels, limit):
+    """Blank out labels so that no more than limit are shown"""
+    step = max(1, -(-len(labels) // limit))
+
+    return [label if index % step == 0 else ''
+            for index, label in enumerate(labels)]
+
+
+def render_chart(chart, img_format='svg'):
+    """Render a chart description with pygal
+
+    A chart is a dict holding its 'type', 'title', a list of 'series' as
+    (label, values) pairs, and optionally 'x_labels' and pygal 'options'.
+    This is a module level function so it can run in a process pool."""
+
+    graph = CHART_TYPES[chart['type']](**chart.get('options', {}))
+    graph.title = chart['title']
+
+    if 'x_labels' in chart:
+        graph.x_labels = chart['x_labels']
+
+    for label, values in chart['series']:
+        graph.add(label, values)
+
+    if img_format == 'png':
+        return graph.render_to_png()
+
+    return graph.render()
+
+
+class RenderJob:
+    """A set of charts being rendered in the background"""
+
+    def __init__(self, renderer, keys, results):
+        """Constructor"""
+        self.renderer = renderer
+        self.keys = keys
+        self.results = results
+
+    def get(self):
+        """Wait for the charts and return them in the order requested"""
+        images = []
+
+        for key, result in zip(self.keys, self.results):
+            if isinstance(result, str):
+                images.append(result)
+            else:
+                image = result.get()
+                self.renderer.cache_store(key, image)
+                images.append(image)
+
+        return images
+
+
+class Renderer:
+    """Renders charts concurrently in a process pool
+
+    Rendered charts are cached by a hash of their input data, so a chart
+    that has not changed since the last run is not rendered again. Charts
+    that have not been used for cache_days are removed from the cache.
+
+    The pool is started when the renderer is created. Forking a process
+    while other threads hold locks can deadlock the child, so a renderer
+    should be created before any other threads are started, and closed
+    when it is no longer needed."""
+
+    def __init__(self, cache_path=None, processes=None, cache_days=30):
+        """Constructor"""
+        self.cache_path = cache_path
+        self.cache_days = float(cache_days)
+
+        if self.cache_path:
+            if not os.path.isdir(self.cache_path):
+                logging.info('Creating graph cache "%s"', self.cache_path)
+                os.makedirs(self.cache_path)
+
+            self.cache_prune()
+
+        self.pool = multiprocessing.Pool(processes or
+                                         multiprocessing.cpu_count())
+
+    def close(self):
+        """Wait for the pool to finish and stop it"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def cache_load(self, key):
+        """Return a cached chart, or None"""
+        if not self.cache_path:
+            return None
+
+        filename = os.path.join(self.cache_path, key)
+
+        try:
+            cache_file = open(filename, 'rb')
+        except IOError:
+            return None
+
+        image = cache_file.read()
+        cache_file.close()
+
+        # Charts are pruned by when they were last used, not created
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+
+        logging.info('Using cached graph %s', key)
+
+        return image
+
+    def cache_prune(self):
+        """Remove charts that have not been used for cache_days"""
+        expires = time.time() - self.cache_days * 86400
+        removed = 0
+
+        for name in os.listdir(self.cache_path):
+            filename = os.path.join(self.cache_path, name)
+
+            try:
+                if os.path.getmtime(filename) < expires:
+                    os.remove(filename)
+                    removed += 1
+            except OSError:
+                continue
+
+        if removed:
+            logging.info('Removed %d unused graphs from the cache', removed)
+
+    def cache_store(self, key, image):
+        """Add a rendered chart to the cache"""
+        if not self.cache_path:
+            return
+
+        filename = os.path.join(self.cache_path, key)
+
+        cache_file = open(filename + '.tmp', 'wb')
+        cache_file.write(image)
+        cache_file.close()
+
+        os.rename(filename + '.tmp', filename)
+
+    def render(self, charts, img_format='png'):
+        """Start rendering a list of charts and return a RenderJob"""
+        keys = [chart_key(chart, img_format) for chart in charts]
+        results = [self.cache_load(key) for key in keys]
+        misses = results.count(None)
+
+        if misses:
+            logging.info('Rendering %d graphs', misses)
+
+            for index, chart in enumerate(charts):
+                if results[index] is None:
+                    results[index] = self.pool.apply_async(render_chart,
+                                                           (chart,
+                                                            img_format))
+
+        return RenderJob(self, keys, results)
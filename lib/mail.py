@@ -16,19 +16,68 @@ from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
 
 import logging
+import os
+import Queue
 import smtplib
+import socket
+import threading
+import time
 
-class Email:
-    """Email connector class"""
+# Seconds to wait before the first retry of a transient failure, this is
+# doubled for each further retry
+RETRY_DELAY = 5
 
-    def __init__(self, config):
+
+class FileTransport:
+    """Local mail sink with the parts of the smtplib.SMTP interface we use
+
+    Each message is written to its own file in a directory, which is handy
+    for testing. It is selected with a server of 'file:/some/directory'."""
+
+    def __init__(self, path):
         """Constructor"""
+        self.path = path
 
-        self.email_from = config['from']
-        self.email_to = config['to']
-        self.email_subject = config['subject']
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def login(self, username, password):
+        """Nothing to authenticate against"""
+        pass
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """Write a message to the sink directory"""
+        filename = os.path.join(self.path, '%.6f-%d-%s.eml' %
+                                (time.time(), os.getpid(),
+                                 threading.current_thread().name))
 
+        sink_file = open(filename, 'wb')
+        sink_file.write('X-Envelope-From: %s\n' % from_addr)
+        sink_file.write('X-Envelope-To: %s\n' % ', '.join(to_addrs))
+        sink_file.write(msg)
+        sink_file.close()
+
+        return {}
+
+    def quit(self):
+        """Nothing to disconnect from"""
+        pass
+
+
+class Mailer:
+    """Mail dispatcher
+
+    Sends a batch of messages over a small number of SMTP connections, each
+    of which is opened and authenticated once for the whole batch. Transient
+    (4xx) failures are retried, and the time taken to connect and to send
+    each message is logged, with the totals for the batch."""
+
+    def __init__(self, config):
+        """Constructor"""
         self.smtp_server = config['server']
+        self.connections = int(config.get('connections', 1))
+        self.retries = int(config.get('retries', 3))
+        self.timeout = float(config.get('timeout', 60))
 
         if 'username' in config.keys():
             self.smtp_auth = True
@@ -37,6 +86,157 @@ class Email:
         else:
             self.smtp_auth = False
 
+        self.timings = []
+        self.failed = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """Return a new connection to the mail server"""
+
+        if self.smtp_server.startswith('file:'):
+            return FileTransport(self.smtp_server[5:])
+
+        logging.info('Connecting to SMTP server')
+
+        started = time.time()
+        mailer = smtplib.SMTP(self.smtp_server, timeout=self.timeout)
+
+        if self.smtp_auth:
+            logging.info('Authenticating to SMTP server')
+            mailer.login(self.smtp_username,
+                         self.smtp_password)
+
+        self.record('connect', self.smtp_server, time.time() - started)
+
+        return mailer
+
+    def record(self, event, subject, seconds):
+        """Record how long something took"""
+        logging.info('%s %s took %.3fs', event, subject, seconds)
+
+        with self.lock:
+            self.timings.append((event, subject, seconds))
+
+    def send(self, emails):
+        """Send a list of Email objects, returning those that failed"""
+
+        started = time.time()
+        messages = Queue.Queue()
+
+        for email in emails:
+            messages.put(email)
+
+        workers = []
+
+        for count in range(min(self.connections, len(emails))):
+            worker = threading.Thread(target=self.worker, args=(messages, ),
+                                      name='mailer-%d' % count)
+            worker.start()
+            workers.append(worker)
+
+        for worker in workers:
+            worker.join()
+
+        totals = {'connect': [0, 0.0], 'send': [0, 0.0]}
+
+        for event, subject, seconds in self.timings:
+            totals[event][0] += 1
+            totals[event][1] += seconds
+
+        logging.info('Sent %d of %d messages in %.3fs, %d connections took ' +
+                     '%.3fs and sending took %.3fs', totals['send'][0],
+                     len(emails), time.time() - started,
+                     totals['connect'][0], totals['connect'][1],
+                     totals['send'][1])
+
+        return self.failed
+
+    def send_one(self, mailer, email):
+        """Send one message, retrying transient failures
+
+        Returns the connection to use for the next message, which is a new
+        one if the server dropped the old one."""
+
+        delay = RETRY_DELAY
+
+        for attempt in range(self.retries + 1):
+            try:
+                if mailer is None:
+                    mailer = self.connect()
+
+                started = time.time()
+                mailer.sendmail(*email.get_message())
+                self.record('send', email.get_subject(), time.time() - started)
+
+                return mailer
+
+            except (smtplib.SMTPServerDisconnected, socket.error), error:
+                mailer = None
+                transient = True
+
+            except smtplib.SMTPResponseException, error:
+                transient = 400 <= error.smtp_code < 500
+
+            except smtplib.SMTPRecipientsRefused, error:
+                transient = all(400 <= code < 500 for code, message
+                                in error.recipients.values())
+
+            except smtplib.SMTPException, error:
+                transient = False
+
+            except Exception, error:
+                # Anything else leaves the connection in an unknown state
+                logging.exception('Unexpected failure sending "%s"',
+                                  email.get_subject())
+                mailer = None
+                transient = False
+
+            if not transient or attempt == self.retries:
+                break
+
+            logging.warning('Transient failure sending "%s", retrying in ' +
+                            '%ds: %s', email.get_subject(), delay, error)
+            time.sleep(delay)
+            delay *= 2
+
+        logging.error('Unable to send "%s": %s', email.get_subject(), error)
+
+        with self.lock:
+            self.failed.append(email)
+
+        return mailer
+
+    def worker(self, messages):
+        """Send messages from the queue over one connection"""
+
+        mailer = None
+
+        while True:
+            try:
+                email = messages.get_nowait()
+            except Queue.Empty:
+                break
+
+            mailer = self.send_one(mailer, email)
+
+        if mailer is not None:
+            try:
+                mailer.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+
+
+class Email:
+    """Email connector class"""
+
+    def __init__(self, config):
+        """Constructor"""
+
+        self.config = config
+        self.email_from = config['from']
+        self.email_to = config['to']
+        self.email_subject = config['subject']
+
         self.email = MIMEMultipart('related')
         self.email['Subject'] = self.email_subject
         self.email['From'] = self.email_from
@@ -57,9 +257,9 @@ class Email:
         part = MIMEText(text_part)
         self.alternative.attach(part)
 
-    def attach_html(self, html_part):
+    def attach_html(self, html_part, charset='us-ascii'):
         """Attach a HTML alternative"""
-        part = MIMEText(html_part, 'html')
+        part = MIMEText(html_part, 'html', charset)
         self.alternative.attach(part)
 
     def attach_image(self, image):
@@ -71,18 +271,14 @@ class Email:
 
         self.email.attach(part)
 
-    def send(self):
-        """Send email"""
-
-        logging.info('Connecting to SMTP server')
+    def get_message(self):
+        """Return the sender, recipients and text of the message"""
+        return (self.email_from, self.email_to.split(), self.email.as_string())
 
-        mailer = smtplib.SMTP(self.smtp_server)
-
-        if self.smtp_auth:
-            logging.info('Authenticating to SMTP server')
-            mailer.login(self.smtp_username,
-                         self.smtp_password)
-
-        mailer.sendmail(self.email_from, self.email_to.split(), self.email.as_string())
-        mailer.quit()
+    def get_subject(self):
+        """Return the subject of the message"""
+        return self.email_subject
 
+    def send(self):
+        """Send email"""
+        return not Mailer(self.config).send([self])
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+""" lib/pipeline.py
+
+ Pipeline class for CloudScraper
+
+ Copyright (c) 2013 The Goulburn Group. All Rights Reserved.
+
+ http://www.goulburngroup.com.au
+
+ Written by Alex Ferrara <alex@receptiveit.com.au>
+
+"""
+
+import logging
+import sys
+import threading
+import time
+
+
+class Pipeline:
+    """Small dependency graph executor
+
+    Each stage runs in its own thread as soon as the stages it requires
+    have finished, and is called with their results in order. A stage
+    whose requirements failed is skipped. When every stage is done, the
+    first error is raised again, and the critical path, the chain of
+    stages that decided how long the run took, can be reported."""
+
+    def __init__(self):
+        """Constructor"""
+        self.stages = []
+        self.functions = {}
+        self.requires = {}
+        self.results = {}
+        self.errors = {}
+        self.times = {}
+        self.condition = threading.Condition()
+
+    def add(self, name, function, requires=()):
+        """Add a stage"""
+        for required in requires:
+            if required not in self.functions:
+                raise ValueError('Stage "%s" requires unknown stage "%s"' %
+                                 (name, required))
+
+        self.stages.append(name)
+        self.functions[name] = function
+        self.requires[name] = list(requires)
+
+    def get(self, name):
+        """Return the result of a stage"""
+        return self.results.get(name)
+
+    def run_stage(self, name):
+        """Run one stage, recording its result or error"""
+
+        started = time.time()
+
+        try:
+            result = self.functions[name](*[self.results[required] for
+                                            required in self.requires[name]])
+        except Exception:
+            with self.condition:
+                self.errors[name] = sys.exc_info()
+        else:
+            with self.condition:
+                self.results[name] = result
+        finally:
+            with self.condition:
+                self.times[name] = (started, time.time())
+                self.condition.notify()
+
+    def run(self):
+        """Run every stage, returning when they have all finished"""
+
+        waiting = list(self.stages)
+        running = set()
+        skipped = set()
+
+        with self.condition:
+            while waiting or running:
+                # Stages are always added after the stages they require, so
+                # one pass in order starts or skips everything it can
+                for name in list(waiting):
+                    requires = self.requires[name]
+
+                    if any(required in self.errors or required in skipped
+                           for required in requires):
+                        logging.warning('Skipping stage "%s"', name)
+                        waiting.remove(name)
+                        skipped.add(name)
+
+                    elif all(required in self.results
+                             for required in requires):
+                        waiting.remove(name)
+                        running.add(name)
+                        threading.Thread(target=self.run_stage, args=(name,),
+                                         name='stage-' + name).start()
+
+                if running:
+                    self.condition.wait()
+                    running -= set(self.times)
+
+        for name in self.stages:
+            if name in self.errors:
+                error = self.errors[name]
+                raise error[0], error[1], error[2]
+
+    def critical_path(self):
+        """Return the stages on the critical path as (name, seconds)"""
+
+        if not self.times:
+            return []
+
+        name = max(self.times, key=lambda stage: self.times[stage][1])
+        path = []
+
+        while name is not None:
+            started, finished = self.times[name]
+            path.append((name, finished - started))
+
+            # The requirement that finished last held this stage back
+            previous = [required for required in self.requires[name]
+                        if required in self.times]
+
+            if previous:
+                name = max(previous, key=lambda stage: self.times[stage][1])
+            else:
+                name = None
+
+        path.reverse()
+
+        return path
+
+    def report(self):
+        """Log how long each stage took and the critical path"""
+
+        if not self.times:
+            return
+
+        for name in self.stages:
+            if name in self.times:
+                started, finished = self.times[name]
+                logging.info('Stage "%s" took %.3fs', name,
+                             finished - started)
+
+        elapsed = max(finished for started, finished in
+                      self.times.itervalues()) - \
+                  min(started for started, finished in
+                      self.times.itervalues())
+
+        logging.info('Critical path: %s (%.3fs in total)',
+                     ' -> '.join('%s %.3fs' % stage
+                                 for stage in self.critical_path()),
+                     elapsed)
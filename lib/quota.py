@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+""" lib/quota.py
+
+ Quota monitor class for CloudScraper
+
+ Copyright (c) 2013 The Goulburn Group. All Rights Reserved.
+
+ http://www.goulburngroup.com.au
+
+ Written by Alex Ferrara <alex@receptiveit.com.au>
+
+"""
+
+from lib.mail import Email, Mailer
+import datetime
+import logging
+
+# Number of days used to work out the recent rate of internet usage
+RATE_DAYS = 7
+
+# Percentages of the quota that trigger an alert, unless configured
+THRESHOLDS = '80,100'
+
+
+class QuotaMonitor:
+    """Gateway quota monitor
+
+    Compares the month to date internet usage of each gateway, which the
+    database keeps up to date as records are added, against its quota. An
+    alert is raised the first time each threshold is crossed in a month."""
+
+    def __init__(self, config, database, today=None):
+        """Constructor"""
+        self.config = config
+        self.database = database
+        self.today = today or datetime.date.today()
+        self.month = self.today.replace(day=1)
+        self.status = []
+
+    def check(self):
+        """Return a list of alerts for thresholds crossed since last time"""
+
+        alerts = []
+        self.status = []
+
+        for mac, name, dl, ul, rate, alerted in \
+                self.database.get_quota(self.month, RATE_DAYS):
+
+            settings = self.config.get_node_settings(name)
+            quota = int(settings.get('quota', 0))
+
+            if quota <= 0:
+                continue
+
+            used = dl + ul
+            percent = float(used) * 100 / quota
+            exhausted = None
+
+            if used >= quota:
+                exhausted = self.today
+            elif rate > 0:
+                exhausted = self.today + \
+                    datetime.timedelta(days=int((quota - used) / rate))
+
+            status = {'mac': mac,
+                      'name': name,
+                      'dl': dl,
+                      'ul': ul,
+                      'quota': quota,
+                      'percent': percent,
+                      'exhausted': exhausted,
+                      'email': settings.get('email')}
+
+            self.status.append(status)
+
+            crossed = [threshold for threshold in
+                       [int(value) for value in
+                        settings.get('thresholds', THRESHOLDS).split(',')]
+                       if alerted < threshold <= percent]
+
+            if crossed:
+                alerts.append(dict(status, threshold=max(crossed)))
+
+        return alerts
+
+    def get_status(self):
+        """Return the status of every gateway with a quota"""
+        return self.status
+
+    def notify(self, alerts):
+        """Email alerts in one batch, and record the ones that were sent"""
+
+        emails = []
+        emailed = []
+
+        for alert in alerts:
+            logging.info('%s has used %.1f%% of its quota', alert['name'],
+                         alert['percent'])
+
+            if not alert['email']:
+                self.database.set_quota_alerted(self.month, alert['mac'],
+                                                alert['threshold'])
+                continue
+
+            email = Email(dict(self.config.get_email(),
+                               to=alert['email'],
+                               subject='Quota warning - %s has used %d%%' %
+                                       (alert['name'], alert['threshold'])))
+
+            text = '%s (%s) has used %s KB of its %s KB quota this month.\n' % \
+                   (alert['name'], alert['mac'],
+                    '{:,}'.format(alert['dl'] + alert['ul']),
+                    '{:,}'.format(alert['quota']))
+
+            if alert['exhausted'] is not None:
+                text += 'At the current rate the quota will run out on %s.\n' % \
+                        alert['exhausted'].strftime('%A, %d %B %Y')
+
+            email.attach_text(text)
+            emails.append(email)
+            emailed.append(alert)
+
+        if not emails:
+            return []
+
+        failed = Mailer(self.config.get_email()).send(emails)
+
+        for email, alert in zip(emails, emailed):
+            if email not in failed:
+                self.database.set_quota_alerted(self.month, alert['mac'],
+                                                alert['threshold'])
+
+        return failed
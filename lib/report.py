@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+""" lib/report.py
+
+ Report class for CloudScraper
+
+ Copyright (c) 2013 The Goulburn Group. All Rights Reserved.
+
+ http://www.goulburngroup.com.au
+
+ Written by Alex Ferrara <alex@receptiveit.com.au>
+
+"""
+
+from lib.table import write_table
+import heapq
+import itertools
+
+
+class Report:
+    """Report builder
+
+    Sections are written to a file-like sink as they are produced, rather
+    than being collected into one large string. Tables can be limited to
+    their top rows and split into pages, to keep very large reports to a
+    manageable size."""
+
+    def __init__(self, sink, max_rows=None, page_rows=None):
+        """Constructor"""
+        self.sink = sink
+        self.max_rows = max_rows
+        self.page_rows = page_rows
+
+    def heading(self, title):
+        """Write an underlined heading"""
+        self.sink.write('%s\n%s\n\n' % (title, '-' * len(title)))
+
+    def table(self, header, entities, key=None):
+        """Write a table with a row for each entity
+
+        Entities must have a get_table_row() method. If a row limit is set
+        and a key is given, only the entities with the largest keys are
+        included."""
+
+        omitted = 0
+
+        if self.max_rows and key is not None:
+            counter = itertools.count()
+            entities = heapq.nlargest(self.max_rows,
+                                      itertools.izip(entities, counter),
+                                      key=lambda entity: key(entity[0]))
+            omitted = next(counter) - len(entities)
+            entities = [entity for entity, index in entities]
+
+        self.rows(header, (entity.get_table_row() for entity in entities))
+
+        if omitted:
+            self.sink.write('\n(%d more not shown)' % omitted)
+
+    def rows(self, header, rows):
+        """Write a table of rows, split into pages if a page size is set"""
+
+        rows = iter(rows)
+        page = list(itertools.islice(rows, self.page_rows))
+
+        while True:
+            write_table(self.sink, header, page)
+
+            page = list(itertools.islice(rows, self.page_rows))
+
+            if not page:
+                break
+
+            self.sink.write('\n')
+
+    def write(self, text):
+        """Write some text"""
+        self.sink.write(text)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+""" lib/reportcache.py
+
+ Report cache class for CloudScraper
+
+ Copyright (c) 2013 The Goulburn Group. All Rights Reserved.
+
+ http://www.goulburngroup.com.au
+
+ Written by Alex Ferrara <alex@receptiveit.com.au>
+
+"""
+
+import datetime
+import logging
+import sqlite3
+import time
+
+# Network of the rows that total a whole day. Some totals, such as unique
+# users, cannot be added up from the rows of each network.
+ALL_NETWORKS = ''
+
+# Columns of each kind of cached row, after the day
+KINDS = {'stats': ('network', 'users', 'kbdown', 'kbup'),
+         'gw_xfer': ('network', 'mac', 'kbdown', 'kbup')}
+
+# Invalidation of every day, used when the whole cache is cleared
+EVERY_DAY = '*'
+
+
+class ReportCache:
+    """Per-day report results of closed days, kept in an SQLite file
+
+    Days before today do not change once they have been scraped, so the
+    rows of each day and network only need to be queried once. Storing or
+    backfilling records of a closed day invalidates that day. A day that
+    was invalidated while its rows were being queried is not cached, so an
+    ingest running alongside a report cannot leave stale rows behind."""
+
+    schema = '''CREATE TABLE IF NOT EXISTS filled (
+                    kind TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    PRIMARY KEY (kind, day));
+                CREATE TABLE IF NOT EXISTS invalidated (
+                    day TEXT PRIMARY KEY,
+                    at REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS stats (
+                    day TEXT NOT NULL,
+                    network TEXT NOT NULL,
+                    users INTEGER NOT NULL,
+                    kbdown INTEGER NOT NULL,
+                    kbup INTEGER NOT NULL,
+                    PRIMARY KEY (day, network));
+                CREATE TABLE IF NOT EXISTS gw_xfer (
+                    day TEXT NOT NULL,
+                    network TEXT NOT NULL,
+                    mac TEXT NOT NULL,
+                    kbdown INTEGER NOT NULL,
+                    kbup INTEGER NOT NULL,
+                    PRIMARY KEY (day, network, mac))'''
+
+    def __init__(self, path):
+        """Constructor"""
+        self.path = path
+
+        conn = self.connect()
+        conn.executescript(self.schema)
+        conn.close()
+
+    def connect(self):
+        """Return a new connection
+
+        The cache is used from the spool flusher and writer threads as well
+        as the main thread, so each call has its own connection."""
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def transaction(self, function, *args):
+        """Run a function in a write transaction"""
+
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+
+        try:
+            value = function(cursor, *args)
+        except:
+            cursor.execute('ROLLBACK')
+            conn.close()
+            raise
+
+        cursor.execute('COMMIT')
+        conn.close()
+
+        return value
+
+    def get(self, kind, first, last):
+        """Return the cached rows of closed days from first to last, and
+        the closed days that are not cached"""
+
+        last = min(last, datetime.date.today() - datetime.timedelta(days=1))
+
+        if last < first:
+            return ([], [])
+
+        conn = self.connect()
+
+        filled = set(row[0] for row in
+                     conn.execute('''SELECT day FROM filled
+                                      WHERE kind = ? AND day BETWEEN ? AND ?''',
+                                  (kind, first.isoformat(),
+                                   last.isoformat())))
+
+        rows = [(datetime.datetime.strptime(row[0], '%Y-%m-%d').date(), ) +
+                row[1:]
+                for row in conn.execute('SELECT day, %s FROM %s '
+                                        'WHERE day BETWEEN ? AND ? '
+                                        'ORDER BY day' %
+                                        (', '.join(KINDS[kind]), kind),
+                                        (first.isoformat(), last.isoformat()))
+                if row[0] in filled]
+
+        conn.close()
+
+        missing = []
+        day = first
+
+        while day <= last:
+            if day.isoformat() not in filled:
+                missing.append(day)
+
+            day += datetime.timedelta(days=1)
+
+        return (rows, missing)
+
+    def put(self, kind, rows, days, queried):
+        """Cache the rows of closed days that were queried at a time"""
+
+        def store(cursor):
+            stored = 0
+
+            invalidated = dict(cursor.execute('SELECT day, at '
+                                              'FROM invalidated'))
+            every_day = invalidated.get(EVERY_DAY, 0)
+
+            by_day = {}
+
+            for row in rows:
+                by_day.setdefault(row[0], []).append(row)
+
+            for day in days:
+                if max(invalidated.get(day.isoformat(), 0),
+                       every_day) >= queried:
+                    continue
+
+                cursor.execute('DELETE FROM %s WHERE day = ?' % kind,
+                               (day.isoformat(), ))
+                cursor.executemany('INSERT INTO %s (day, %s) '
+                                   'VALUES (?, %s)' %
+                                   (kind, ', '.join(KINDS[kind]),
+                                    ', '.join('?' * len(KINDS[kind]))),
+                                   [(day.isoformat(), ) + tuple(row[1:])
+                                    for row in by_day.get(day, [])])
+                cursor.execute('INSERT OR REPLACE INTO filled (kind, day) '
+                               'VALUES (?, ?)', (kind, day.isoformat()))
+                stored += 1
+
+            return stored
+
+        stored = self.transaction(store)
+
+        logging.info('Cached %d of %d days of %s', stored, len(days), kind)
+
+    def invalidate(self, day):
+        """Forget the cached rows of a day, if it is closed"""
+
+        if day >= datetime.date.today():
+            return
+
+        logging.info('Invalidating cached reports of %s', day)
+
+        self.forget(day.isoformat())
+
+    def clear(self):
+        """Forget every cached row"""
+        logging.info('Clearing the report cache')
+
+        self.forget(EVERY_DAY)
+
+    def forget(self, day):
+        """Remove the cached rows of a day, or every day"""
+
+        def remove(cursor):
+            for table in ['filled'] + sorted(KINDS):
+                if day == EVERY_DAY:
+                    cursor.execute('DELETE FROM %s' % table)
+                else:
+                    cursor.execute('DELETE FROM %s WHERE day = ?' % table,
+                                   (day, ))
+
+            cursor.execute('INSERT OR REPLACE INTO invalidated (day, at) '
+                           'VALUES (?, ?)', (day, time.time()))
+
+        self.transaction(remove)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+""" lib/runner.py
+
+ Multi-account runner class for CloudScraper
+
+ Copyright (c) 2013 The Goulburn Group. All Rights Reserved.
+
+ http://www.goulburngroup.com.au
+
+ Written by Alex Ferrara <alex@receptiveit.com.au>
+
+"""
+
+from lib.checkin import CheckinPolicy
+from lib.cloudtrax import CloudTrax, CloudTraxError
+from multiprocessing.pool import ThreadPool
+import logging
+import requests
+import threading
+
+# Errors that only fail the account they happen in
+ACCOUNT_ERRORS = (CloudTraxError, requests.exceptions.RequestException)
+
+
+class Runner:
+    """Scrapes every network account in one process
+
+    Each account logs in with its own session, then the networks of all
+    accounts are scraped by a shared pool of worker threads. No account has
+    more than account_concurrency networks scraped at once, and an account
+    that fails does not stop the others. Every network is passed to the
+    same callback as it is scraped, usually the put() of a database
+    writer."""
+
+    def __init__(self, config, callback=None, budget=None):
+        """Constructor"""
+        self.config = config
+        self.callback = callback
+        self.budget = budget
+
+        settings = config.get_runner()
+
+        self.workers = int(settings.get('workers', 4))
+        self.account_concurrency = int(settings.get('account_concurrency', 2))
+
+        self.checkin = CheckinPolicy(config.get_checkin())
+        self.results = []
+        self.failures = []
+
+    def get_failures(self):
+        """Return a list of (account, network, error) tuples"""
+        return self.failures
+
+    def get_results(self):
+        """Return a CloudTrax object for each account that logged in"""
+        return self.results
+
+    def fail(self, account, network, error):
+        """Record the failure of an account, or one of its networks"""
+        if network is None:
+            logging.error('Account "%s" failed: %s', account['label'], error)
+        else:
+            logging.error('Account "%s" network "%s" failed: %s',
+                          account['label'], network, error)
+
+        self.failures.append((account['label'], network, error))
+
+    def login(self, account):
+        """Log in to one account, returning None if it fails
+
+        Any error is caught, so that nothing that goes wrong with one
+        account can stop the others."""
+        try:
+            return CloudTrax(self.config, self.callback, self.budget,
+                             collect=False, account=account,
+                             checkin=self.checkin)
+        except Exception, error:
+            self.fail(account, None, error)
+            return None
+
+    def scrape(self, cloudtrax, network, semaphore):
+        """Scrape one network of an account"""
+        with semaphore:
+            try:
+                cloudtrax.collect_network(network)
+            except Exception, error:
+                self.fail(cloudtrax.network, network, error)
+
+    def run(self):
+        """Scrape every account, returning the ones that logged in"""
+
+        accounts = self.config.get_networks()
+        pool = ThreadPool(self.workers)
+
+        try:
+            logins = pool.map(self.login, accounts)
+            self.results = [cloudtrax for cloudtrax in logins
+                            if cloudtrax is not None]
+
+            queues = []
+
+            for cloudtrax in self.results:
+                semaphore = threading.Semaphore(self.account_concurrency)
+                queues.append([(cloudtrax, network, semaphore)
+                               for network in cloudtrax.network['networks']])
+
+            # Interleave the accounts, so a large account does not hold
+            # every worker waiting on its semaphore
+            jobs = []
+
+            while any(queues):
+                for queue in queues:
+                    if queue:
+                        jobs.append(queue.pop(0))
+
+            pending = [pool.apply_async(self.scrape, job) for job in jobs]
+
+            for result in pending:
+                result.get()
+
+        finally:
+            pool.close()
+            pool.join()
+
+        self.checkin.save()
+
+        logging.info('Scraped %d of %d accounts, %d failures',
+                     len(self.results), len(accounts), len(self.failures))
+
+        return self.results
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+""" lib/snapshot.py
+
+ Snapshot classes for CloudScraper
+
+ Copyright (c) 2013 The Goulburn Group. All Rights Reserved.
+
+ http://www.goulburngroup.com.au
+
+ Written by Alex Ferrara <alex@receptiveit.com.au>
+
+"""
+
+from lib.checkin import CheckinPolicy
+from lib.cloudtrax import CloudTrax
+from lib.node import Node
+from lib.user import User
+import calendar
+import datetime
+import logging
+import mmap
+import os
+import struct
+import threading
+
+SNAPSHOT_MAGIC = 'CSSN'
+SNAPSHOT_VERSION = 1
+
+# String values of each record, stored as an offset and length into the
+# string table
+NODE_STRINGS = ['status', 'mac', 'network', 'ip', 'chan_24', 'chan_58',
+                'last_checkin', 'gateway_name', 'hops', 'latency', 'name',
+                'comment', 'uptime', 'fw_version', 'fw_name', 'load',
+                'memfree', 'gateway_ip']
+NODE_NUMBERS = ['users', 'dl', 'ul', 'gw_dl', 'gw_ul', 'uptime_percent']
+USER_STRINGS = ['name', 'mac', 'node_mac', 'rssi', 'rate', 'MCS', 'blocked',
+                'node_name']
+USER_NUMBERS = ['dl', 'ul', 'nodes']
+
+# All records are little endian with no padding. The header holds the
+# magic, version, scrape time, checkin images fetched and skipped, record
+# counts and the offset and length of the string table.
+HEADER = struct.Struct('<4sHxxdIIIIIQQ')
+NETWORK = struct.Struct('<IHIHIIII')
+# Node strings, node type and status, the numbers and the checkin data
+NODE = struct.Struct('<' + 'IH' * (len(NODE_STRINGS) + 2) +
+                     'Iqqqqd' + 'dddd')
+USER = struct.Struct('<' + 'IH' * len(USER_STRINGS) + 'qqI')
+
+
+class SnapshotNode(Node):
+    """Node loaded from a snapshot"""
+
+    def __init__(self, values, checkin_data, node_type, node_status):
+        """Constructor"""
+        self.values = values
+        self.checkin_data = checkin_data
+        self.node_type = node_type
+        self.node_status = node_status
+
+
+class SnapshotUser(User):
+    """User loaded from a snapshot"""
+
+    def __init__(self, values):
+        """Constructor"""
+        self.values = values
+
+
+class SnapshotWriter:
+    """Collects scraped networks into a snapshot file
+
+    put() may be used as a scrape callback, and passes each network on to
+    the next callback. Records are packed as they arrive, and the file is
+    written in one go by close(), replacing the last snapshot atomically,
+    so readers that have the old file mapped are not disturbed."""
+
+    def __init__(self, path, started, callback=None):
+        """Constructor"""
+        self.path = path
+        self.started = started
+        self.callback = callback
+
+        self.networks = []
+        self.nodes = []
+        self.users = []
+        self.strings = []
+        self.string_refs = {}
+        self.string_length = 0
+        self.lock = threading.Lock()
+
+    def string(self, value):
+        """Return the offset and length of a string in the string table"""
+
+        if value is None:
+            value = ''
+
+        value = unicode(value).encode('utf-8')
+
+        if value not in self.string_refs:
+            self.string_refs[value] = (self.string_length, len(value))
+            self.strings.append(value)
+            self.string_length += len(value)
+
+        return self.string_refs[value]
+
+    def pack_node(self, node):
+        """Return the record of a node"""
+
+        values = node.get_values()
+        fields = []
+
+        for key in NODE_STRINGS:
+            fields.extend(self.string(values.get(key)))
+
+        fields.extend(self.string(getattr(node, 'node_type', '')))
+        fields.extend(self.string(getattr(node, 'node_status', '')))
+        fields.extend(values[key] for key in NODE_NUMBERS)
+        fields.extend(node.checkin_data)
+
+        return NODE.pack(*fields)
+
+    def pack_user(self, user):
+        """Return the record of a user"""
+
+        values = user.get_values()
+        fields = []
+
+        for key in USER_STRINGS:
+            fields.extend(self.string(values.get(key)))
+
+        fields.extend(values[key] for key in USER_NUMBERS)
+
+        return USER.pack(*fields)
+
+    def put(self, nodes, users):
+        """Add the nodes and users of one network"""
+
+        if nodes:
+            network = nodes.itervalues().next().get_values()['network']
+
+            with self.lock:
+                self.networks.append((network, len(self.nodes), len(nodes),
+                                      len(self.users), len(users)))
+                self.nodes.extend(self.pack_node(nodes[mac])
+                                  for mac in sorted(nodes))
+                self.users.extend(self.pack_user(users[mac])
+                                  for mac in sorted(users))
+
+        if self.callback is not None:
+            self.callback(nodes, users)
+
+    def close(self, accounts, checkin_stats=(0, 0)):
+        """Write the snapshot file, labelling networks with their account"""
+
+        labels = {}
+
+        for cloudtrax in accounts:
+            for network in cloudtrax.network['networks']:
+                labels[network] = cloudtrax.get_account()
+
+        networks = [NETWORK.pack(*(self.string(network) +
+                                   self.string(labels.get(network, '')) +
+                                   (node_first, node_count,
+                                    user_first, user_count)))
+                    for network, node_first, node_count,
+                        user_first, user_count in self.networks]
+
+        strings_offset = HEADER.size + NETWORK.size * len(networks) + \
+                         NODE.size * len(self.nodes) + \
+                         USER.size * len(self.users)
+
+        snapshot_file = open(self.path + '.tmp', 'wb')
+        snapshot_file.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                        calendar.timegm(self.started
+                                                        .utctimetuple()) +
+                                        self.started.microsecond / 1e6,
+                                        checkin_stats[0], checkin_stats[1],
+                                        len(networks), len(self.nodes),
+                                        len(self.users), strings_offset,
+                                        self.string_length))
+
+        for records in (networks, self.nodes, self.users, self.strings):
+            snapshot_file.write(''.join(records))
+
+        snapshot_file.close()
+
+        os.rename(self.path + '.tmp', self.path)
+
+        logging.info('Saved snapshot of %d networks, %d nodes and %d users',
+                     len(networks), len(self.nodes), len(self.users))
+
+
+class Snapshot:
+    """Read-only view of a snapshot file
+
+    The file is memory mapped, and records are only unpacked when they are
+    asked for."""
+
+    def __init__(self, path):
+        """Constructor"""
+        snapshot_file = open(path, 'rb')
+        self.data = mmap.mmap(snapshot_file.fileno(), 0,
+                              access=mmap.ACCESS_READ)
+        snapshot_file.close()
+
+        if len(self.data) < HEADER.size:
+            raise IOError('Snapshot "%s" is truncated' % path)
+
+        magic, version, started, fetched, skipped, self.network_count, \
+            self.node_count, self.user_count, self.strings_offset, \
+            strings_length = HEADER.unpack_from(self.data, 0)
+
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise IOError('Snapshot "%s" has an unknown format' % path)
+
+        if len(self.data) != self.strings_offset + strings_length:
+            raise IOError('Snapshot "%s" is truncated' % path)
+
+        self.started = datetime.datetime.utcfromtimestamp(started)
+        self.checkin_stats = (fetched, skipped)
+
+        self.nodes_offset = HEADER.size + NETWORK.size * self.network_count
+        self.users_offset = self.nodes_offset + NODE.size * self.node_count
+
+    def close(self):
+        """Unmap the snapshot"""
+        self.data.close()
+
+    def string(self, offset, length):
+        """Return a string from the string table"""
+        offset += self.strings_offset
+        return self.data[offset:offset + length].decode('utf-8')
+
+    def strings(self, fields, keys):
+        """Return a dict of the strings referenced by record fields"""
+        return dict((key, self.string(fields[index * 2],
+                                      fields[index * 2 + 1]))
+                    for index, key in enumerate(keys))
+
+    def get_checkin_stats(self):
+        """Return the number of checkin images fetched and skipped"""
+        return self.checkin_stats
+
+    def get_started(self):
+        """Return when the scrape started"""
+        return self.started
+
+    def get_networks(self):
+        """Return (network, account) tuples"""
+        networks = []
+
+        for index in range(self.network_count):
+            fields = NETWORK.unpack_from(self.data,
+                                         HEADER.size + NETWORK.size * index)
+            networks.append((self.string(*fields[0:2]),
+                             self.string(*fields[2:4])))
+
+        return networks
+
+    def get_node(self, index):
+        """Return a node"""
+        fields = NODE.unpack_from(self.data,
+                                  self.nodes_offset + NODE.size * index)
+
+        strings = len(NODE_STRINGS) * 2
+        values = self.strings(fields, NODE_STRINGS)
+        values.update(zip(NODE_NUMBERS, fields[strings + 4:strings + 10]))
+
+        return SnapshotNode(values, fields[strings + 10:],
+                            self.string(*fields[strings:strings + 2]),
+                            self.string(*fields[strings + 2:strings + 4]))
+
+    def get_user(self, index):
+        """Return a user"""
+        fields = USER.unpack_from(self.data,
+                                  self.users_offset + USER.size * index)
+
+        strings = len(USER_STRINGS) * 2
+        values = self.strings(fields, USER_STRINGS)
+        values.update(zip(USER_NUMBERS, fields[strings:]))
+
+        return SnapshotUser(values)
+
+    def get_network(self, index):
+        """Return the nodes and users of a network as dicts by mac"""
+        fields = NETWORK.unpack_from(self.data,
+                                     HEADER.size + NETWORK.size * index)
+        node_first, node_count, user_first, user_count = fields[4:]
+
+        nodes = dict((node.get_mac(), node) for node in
+                     [self.get_node(position) for position in
+                      range(node_first, node_first + node_count)])
+        users = dict((user.get_mac(), user) for user in
+                     [self.get_user(position) for position in
+                      range(user_first, user_first + user_count)])
+
+        return (nodes, users)
+
+
+def restore(config, snapshot, callback=None):
+    """Return a CloudTrax object for each account in a snapshot
+
+    The networks are passed to the callback as if they had just been
+    scraped."""
+
+    accounts = dict((account['label'], account)
+                    for account in config.get_networks())
+    results = []
+    by_label = {}
+
+    checkin = CheckinPolicy({})
+    checkin.fetched, checkin.skipped = snapshot.get_checkin_stats()
+
+    for index, (network, label) in enumerate(snapshot.get_networks()):
+        if label not in by_label:
+            account = accounts.get(label, {'label': label, 'networks': [],
+                                           'recurse': False})
+            by_label[label] = CloudTrax(config, callback, account=account,
+                                        checkin=checkin, login=False)
+            results.append(by_label[label])
+
+        nodes, users = snapshot.get_network(index)
+        by_label[label].add_network(nodes, users)
+
+    return results
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+""" lib/spool.py
+
+ Spool class for CloudScraper
+
+ Copyright (c) 2013 The Goulburn Group. All Rights Reserved.
+
+ http://www.goulburngroup.com.au
+
+ Written by Alex Ferrara <alex@receptiveit.com.au>
+
+"""
+
+import datetime
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+
+# Segment header: magic, version, crc32 of the payload, payload length
+SEGMENT_HEADER = struct.Struct('>4sBIL')
+SEGMENT_MAGIC = 'CSSP'
+SEGMENT_VERSION = 1
+SEGMENT_SUFFIX = '.seg'
+
+# Directory under the spool that segments which cannot be stored are moved to
+QUARANTINE = 'quarantine'
+
+
+class SpoolError(Exception):
+    """Raised when a spool segment is unreadable"""
+    pass
+
+
+class Spool:
+    """Local append-only spool of scrapes waiting to be stored"""
+
+    def __init__(self, path):
+        """Constructor"""
+        self.path = path
+
+        if not os.path.isdir(self.path):
+            logging.info('Creating spool directory "%s"', self.path)
+            os.makedirs(self.path)
+
+    def write(self, nodes, users, started):
+        """Write one scrape to a new segment and return its name
+
+        The segment is written to a temporary file and renamed into place,
+        so a partially written segment is never picked up by a flush."""
+
+        payload = zlib.compress(json.dumps({
+            'started': time.mktime(started.timetuple()) +
+                       started.microsecond / 1000000.0,
+            'nodes': nodes,
+            'users': users}, separators=(',', ':')))
+
+        segment = '%s-%d%s' % (started.strftime('%Y%m%d%H%M%S%f'),
+                               os.getpid(), SEGMENT_SUFFIX)
+        filename = os.path.join(self.path, segment)
+
+        logging.info('Spooling %d nodes and %d users to "%s"',
+                     len(nodes), len(users), segment)
+
+        spool_file = open(filename + '.tmp', 'wb')
+        spool_file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC,
+                                             SEGMENT_VERSION,
+                                             zlib.crc32(payload) & 0xffffffff,
+                                             len(payload)))
+        spool_file.write(payload)
+        spool_file.flush()
+        os.fsync(spool_file.fileno())
+        spool_file.close()
+
+        os.rename(filename + '.tmp', filename)
+
+        return segment
+
+    def read(self, segment):
+        """Return the (nodes, users, started) stored in a segment"""
+
+        spool_file = open(os.path.join(self.path, segment), 'rb')
+        header = spool_file.read(SEGMENT_HEADER.size)
+        payload = spool_file.read()
+        spool_file.close()
+
+        if len(header) != SEGMENT_HEADER.size:
+            raise SpoolError('Segment "%s" is truncated' % segment)
+
+        magic, version, checksum, length = SEGMENT_HEADER.unpack(header)
+
+        if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+            raise SpoolError('Segment "%s" has an unknown format' % segment)
+
+        if len(payload) != length or \
+           zlib.crc32(payload) & 0xffffffff != checksum:
+            raise SpoolError('Segment "%s" is corrupt' % segment)
+
+        scrape = json.loads(zlib.decompress(payload))
+
+        return (scrape['nodes'],
+                scrape['users'],
+                datetime.datetime.fromtimestamp(scrape['started']))
+
+    def remove(self, segment):
+        """Remove a segment once it has been stored"""
+        os.remove(os.path.join(self.path, segment))
+
+    def quarantine(self, segment):
+        """Move a segment that cannot be stored out of the way"""
+        quarantine = os.path.join(self.path, QUARANTINE)
+
+        if not os.path.isdir(quarantine):
+            os.makedirs(quarantine)
+
+        os.rename(os.path.join(self.path, segment),
+                  os.path.join(quarantine, segment))
+
+        logging.error('Moved spool segment "%s" to "%s"', segment, quarantine)
+
+    def segments(self):
+        """Return the names of all spooled segments, oldest first"""
+        return sorted(segment for segment in os.listdir(self.path)
+                      if segment.endswith(SEGMENT_SUFFIX))
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+""" lib/table.py
+
+ Text table renderer for CloudScraper
+
+ Copyright (c) 2013 The Goulburn Group. All Rights Reserved.
+
+ http://www.goulburngroup.com.au
+
+ Written by Alex Ferrara <alex@receptiveit.com.au>
+
+ This draws the same tables as texttable.Texttable with its default
+settings (borders, header line, lines between rows, 80 columns wide, cells
+left aligned, headers centred and numbers auto formatted), for cells that
+contain no tabs or double width characters. Column widths are worked out in
+a single pass over the rows, and each line is written to the sink as soon
+as it is formatted.
+
+"""
+
+import StringIO
+import textwrap
+
+MAX_WIDTH = 80
+
+
+#
+# Helper functions
+#
+
+def format_cell(cell):
+    """Format a cell the way texttable's automatic data type does"""
+
+    try:
+        value = float(cell)
+    except (TypeError, ValueError):
+        return cell
+
+    if abs(value) > 1e8:
+        return '%.3e' % value
+    elif value != value:
+        return cell
+    elif value - round(value) == 0:
+        if type(cell) == int:
+            return str(cell)
+        return str(int(round(value)))
+
+    return '%.3f' % value
+
+
+def cell_width(cell):
+    """Return the width of the widest line in a cell"""
+    return max(len(line) for line in cell.split('\n'))
+
+
+def fit_widths(widths, max_width):
+    """Shrink column widths to fit the table within max_width"""
+
+    deco_width = 3 * (len(widths) - 1) + 4
+
+    if sum(widths) + deco_width <= max_width:
+        return widths
+
+    if max_width < len(widths) + deco_width:
+        raise ValueError('max_width too low to render data')
+
+    available = max_width - deco_width
+    fitted = [0] * len(widths)
+    column = 0
+
+    # Hand out the available width one character at a time
+    while available > 0:
+        if fitted[column] < widths[column]:
+            fitted[column] += 1
+            available -= 1
+        column = (column + 1) % len(widths)
+
+    return fitted
+
+
+def render_table(header, rows, max_width=MAX_WIDTH):
+    """Return a table as a string, like texttable.Texttable.draw()"""
+    sink = StringIO.StringIO()
+    write_table(sink, header, rows, max_width)
+
+    return sink.getvalue()
+
+
+def hline(widths, horiz, corner):
+    """Return a horizontal line"""
+    return '%s%s%s%s%s\n' % (corner, horiz,
+                             (horiz + corner + horiz).join(horiz * width
+                                                           for width in widths),
+                             horiz, corner)
+
+
+def wrap_cell(cell, width):
+    """Return a cell split into lines no wider than width"""
+    lines = []
+
+    for line in cell.split('\n'):
+        if line.strip() == '':
+            lines.append('')
+        else:
+            lines.extend(textwrap.wrap(line, width))
+
+    return lines
+
+
+def write_line(sink, cells, widths, isheader=False):
+    """Write one table row, which may take several lines of text"""
+
+    cells = [wrap_cell(cell, width) for cell, width in zip(cells, widths)]
+    height = max(len(cell) for cell in cells)
+
+    for index in range(height):
+        out = []
+
+        for cell, width in zip(cells, widths):
+            text = cell[index] if index < len(cell) else ''
+            fill = width - len(text)
+
+            if isheader:
+                out.append(' ' * (fill / 2) + text + ' ' * (fill - fill / 2))
+            else:
+                out.append(text + ' ' * fill)
+
+        sink.write('| ' + ' | '.join(out) + ' |\n')
+
+
+def write_table(sink, header, rows, max_width=MAX_WIDTH):
+    """Write a table to a file-like sink
+
+    Like texttable.Texttable.draw(), the last line is written without a
+    trailing newline."""
+
+    widths = [cell_width(cell) for cell in header]
+    formatted = []
+
+    for row in rows:
+        row = [format_cell(cell) for cell in row]
+        widths = [max(width, cell_width(cell))
+                  for width, cell in zip(widths, row)]
+        formatted.append(row)
+
+    widths = fit_widths(widths, max_width)
+
+    line = hline(widths, '-', '+')
+
+    sink.write(line)
+    write_line(sink, header, widths, isheader=True)
+    sink.write(hline(widths, '=', '+'))
+
+    for index, row in enumerate(formatted):
+        write_line(sink, row, widths)
+
+        if index < len(formatted) - 1:
+            sink.write(line)
+
+    sink.write(line[:-1])
@@ -98,6 +98,10 @@ class User:
            in the past 24hrs"""
         return self.values['dl']
 
+    def get_usage(self):
+        """Returns the data transfer for this client"""
+        return (self.values['dl'], self.values['ul'])
+
     def get_ul(self):
         """Returns an integer representing the number of kilobytes uploaded
            in the past 24hrs"""
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+""" lib/workqueue.py
+
+ Work queue classes for CloudScraper
+
+ Copyright (c) 2013 The Goulburn Group. All Rights Reserved.
+
+ http://www.goulburngroup.com.au
+
+ Written by Alex Ferrara <alex@receptiveit.com.au>
+
+"""
+
+import json
+import logging
+import sqlite3
+import time
+
+
+class WorkQueueError(Exception):
+    """Raised when the work queue cannot be used"""
+    pass
+
+
+def create_queue(config):
+    """Return the work queue selected by the queue config"""
+
+    queue_type = config.get('type', 'sqlite')
+
+    if queue_type == 'sqlite':
+        return SqliteQueue(config['path'])
+
+    raise WorkQueueError('Unknown queue type "%s"' % queue_type)
+
+
+class WorkQueue:
+    """Durable queue of work items
+
+    Items belong to a run and have a kind and a JSON payload. A worker
+    claims an item with a lease, and must complete or fail it before the
+    lease expires, otherwise the item is handed to another worker. Items
+    are retried until they have been claimed max_attempts times.
+
+    Finished items are numbered in the order they finish, so a coordinator
+    can pick up new results without reading old ones again."""
+
+    def put(self, run, kind, payload, max_attempts=3):
+        """Add an item to a run, returning its id"""
+        raise NotImplementedError
+
+    def claim(self, worker, lease):
+        """Return (id, run, kind, payload) of a claimed item, or None"""
+        raise NotImplementedError
+
+    def complete(self, item_id, worker, result):
+        """Store the result of an item, unless the lease has been lost"""
+        raise NotImplementedError
+
+    def fail(self, item_id, worker, error):
+        """Give up on an item, retrying it if it has attempts left"""
+        raise NotImplementedError
+
+    def finished(self, run, after=0):
+        """Return (sequence, id, kind, payload, result, error) tuples of
+        the items of a run that finished after a sequence number"""
+        raise NotImplementedError
+
+    def outstanding(self, run):
+        """Return the number of items of a run that have not finished"""
+        raise NotImplementedError
+
+    def purge(self, run):
+        """Remove every item of a run"""
+        raise NotImplementedError
+
+
+class SqliteQueue(WorkQueue):
+    """Work queue kept in an SQLite database
+
+    Workers on other hosts can share the queue through a network
+    filesystem, as long as it supports file locking."""
+
+    schema = '''CREATE TABLE IF NOT EXISTS items (
+                    id INTEGER PRIMARY KEY,
+                    run TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_until REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL,
+                    sequence INTEGER,
+                    result TEXT,
+                    error TEXT);
+                CREATE INDEX IF NOT EXISTS items_state
+                    ON items (state, lease_until);
+                CREATE INDEX IF NOT EXISTS items_run
+                    ON items (run, sequence)'''
+
+    def __init__(self, path):
+        """Constructor"""
+        try:
+            self.conn = sqlite3.connect(path, timeout=60,
+                                        isolation_level=None)
+            self.conn.executescript(self.schema)
+        except sqlite3.Error, error:
+            raise WorkQueueError('Unable to open queue "%s": %s' %
+                                 (path, error))
+
+    def transaction(self, function, *args):
+        """Run a function in a write transaction"""
+
+        cursor = self.conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+
+        try:
+            value = function(cursor, *args)
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+
+        cursor.execute('COMMIT')
+
+        return value
+
+    def finish(self, cursor, item_id, state, result, error, worker=None):
+        """Mark an item finished with the next sequence number
+
+        With a worker, nothing happens unless that worker holds the lease,
+        so a worker that lost its lease cannot finish the item twice."""
+        cursor.execute('''UPDATE items SET state = ?, result = ?, error = ?,
+                                 sequence = (SELECT COALESCE(MAX(sequence), 0)
+                                             + 1 FROM items),
+                                 lease_until = NULL
+                          WHERE id = ? AND state = 'leased'
+                            AND (? IS NULL OR worker = ?)''',
+                       (state, result, error, item_id, worker, worker))
+
+    def put(self, run, kind, payload, max_attempts=3):
+        """SQLite implementation of this method"""
+        cursor = self.conn.execute('''INSERT INTO items (run, kind, payload,
+                                                         max_attempts)
+                                      VALUES (?, ?, ?, ?)''',
+                                   (run, kind, json.dumps(payload),
+                                    max_attempts))
+        return cursor.lastrowid
+
+    def claim(self, worker, lease):
+        """SQLite implementation of this method"""
+        return self.transaction(self.claim_item, worker, lease)
+
+    def claim_item(self, cursor, worker, lease):
+        """Claim the oldest available item in a transaction"""
+
+        now = time.time()
+
+        # Leases that expired on their last attempt will not be retried
+        cursor.execute('''SELECT id FROM items
+                          WHERE state = 'leased' AND lease_until < ?
+                            AND attempts >= max_attempts''', (now,))
+
+        for (item_id,) in cursor.fetchall():
+            logging.warning('Work item %d ran out of attempts', item_id)
+            self.finish(cursor, item_id, 'failed', None, 'Lease expired')
+
+        cursor.execute('''SELECT id, run, kind, payload FROM items
+                          WHERE state = 'pending'
+                             OR (state = 'leased' AND lease_until < ?)
+                          ORDER BY id LIMIT 1''', (now,))
+        row = cursor.fetchone()
+
+        if row is None:
+            return None
+
+        cursor.execute('''UPDATE items SET state = 'leased', worker = ?,
+                                 lease_until = ?, attempts = attempts + 1
+                          WHERE id = ?''', (worker, now + lease, row[0]))
+
+        return (row[0], row[1], row[2], json.loads(row[3]))
+
+    def complete(self, item_id, worker, result):
+        """SQLite implementation of this method"""
+        self.transaction(self.finish, item_id, 'done', json.dumps(result),
+                         None, worker)
+
+    def fail(self, item_id, worker, error):
+        """SQLite implementation of this method"""
+        self.transaction(self.fail_item, item_id, worker, error)
+
+    def fail_item(self, cursor, item_id, worker, error):
+        """Retry or give up on an item in a transaction"""
+
+        cursor.execute('''SELECT attempts, max_attempts FROM items
+                          WHERE id = ? AND state = 'leased' AND worker = ?''',
+                       (item_id, worker))
+        row = cursor.fetchone()
+
+        if row is None:
+            return
+
+        if row[0] < row[1]:
+            cursor.execute('''UPDATE items SET state = 'pending', error = ?,
+                                     lease_until = NULL
+                              WHERE id = ?''', (error, item_id))
+        else:
+            self.finish(cursor, item_id, 'failed', None, error, worker)
+
+    def finished(self, run, after=0):
+        """SQLite implementation of this method"""
+        cursor = self.conn.execute('''SELECT sequence, id, kind, payload,
+                                             result, error
+                                      FROM items
+                                      WHERE run = ? AND sequence > ?
+                                      ORDER BY sequence''', (run, after))
+
+        return [(sequence, item_id, kind, json.loads(payload),
+                 None if result is None else json.loads(result), error)
+                for sequence, item_id, kind, payload, result, error in cursor]
+
+    def outstanding(self, run):
+        """SQLite implementation of this method"""
+        cursor = self.conn.execute('''SELECT COUNT(*) FROM items
+                                      WHERE run = ? AND sequence IS NULL''',
+                                   (run,))
+        return cursor.fetchone()[0]
+
+    def purge(self, run):
+        """SQLite implementation of this method"""
+        self.conn.execute('DELETE FROM items WHERE run = ?', (run,))